@@ -0,0 +1,67 @@
+"""Compare mongodb_shell.loads with json.loads(clean_json()) on shell output
+
+Run from the layer root:
+
+    python benchmarks/bench_shell_decode.py
+"""
+import os
+import sys
+import json
+import timeit
+
+sys.path.append('lib')
+
+from charms.layer import mongodb  # noqa: E402
+from charms.layer import mongodb_shell  # noqa: E402
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def recorded(name):
+    with open(os.path.join(DATA, name), 'rb') as f:
+        return f.read()
+
+
+def enlarge(output, size):
+    """Repeat the members of a recorded rs.status() until it reaches size"""
+    head, rest = output.split(b'"members" : [', 1)
+    members, tail = rest.rsplit(b']', 1)
+    copies = max(1, size // len(members))
+    body = b','.join([members.strip()] * copies)
+    return head + b'"members" : [' + body + b']' + tail
+
+
+def legacy(out):
+    return json.loads(mongodb.clean_json(out))
+
+
+def bench(label, out, number):
+    results = {'input': label, 'bytes': len(out)}
+    for name, fn in (('clean_json', legacy), ('loads', mongodb_shell.loads)):
+        try:
+            fn(out)
+        except ValueError:
+            results[name] = None
+            continue
+        best = min(timeit.repeat(lambda: fn(out), number=number, repeat=3))
+        results[name] = best / number
+    return results
+
+
+def main():
+    rs30 = recorded('rs_status_30.txt')
+    cases = [
+        ('rs.status() 3.0', rs30, 2000),
+        ('rs.status() 3.2', recorded('rs_status_32.txt'), 2000),
+        ('rs.status() 3.0 x2MB', enlarge(rs30, 2 * 1024 * 1024), 3),
+    ]
+    for label, out, number in cases:
+        r = bench(label, out, number)
+        print('{input:<24} {bytes:>9}B  clean_json: {0:>12}  loads: {1:>12}'
+              .format(*['{:.6f}s'.format(r[k]) if r[k] is not None
+                        else 'fails' for k in ('clean_json', 'loads')],
+                      **r))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""Offline benchmarks for the layer's hot paths
+
+Shell output comes from benchmarks/data and every subprocess, apt and
+service call is stubbed, so nothing here needs a machine with MongoDB.
+Run from the layer root; results are written as JSON so runs can be
+compared between commits:
+
+    python benchmarks/suite.py --output before.json
+    python benchmarks/suite.py --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import contextlib
+import statistics
+import timeit
+
+# Unit state and reactive flags live in memory for the whole run
+os.environ['UNIT_STATE_DB'] = ':memory:'
+os.environ['JUJU_HOOK_NAME'] = 'config-changed'
+sys.path[:0] = ['.', 'lib']
+
+from mock import patch  # noqa: E402
+
+from charmhelpers.core import hookenv  # noqa: E402
+from charms.reactive import bus, set_state, remove_state  # noqa: E402
+
+from charms.layer import mongodb  # noqa: E402
+from charms.layer import mongodb_backup  # noqa: E402
+from charms.layer import mongodb_bson  # noqa: E402
+from charms.layer import mongodb_replicaset  # noqa: E402
+from charms.layer import mongodb_restart  # noqa: E402
+from charms.layer import mongodb_shell  # noqa: E402
+from charms.layer import mongodb_trace  # noqa: E402
+from reactive import mongodb as handlers  # noqa: E402
+
+from bench_shell_decode import recorded, enlarge, legacy  # noqa: E402
+
+
+class Config(dict):
+    """Stand-in for hookenv.config() with every option changed"""
+
+    def previous(self, key):
+        return None
+
+    def changed(self, key):
+        return True
+
+
+CONFIG = Config(version='3.2.10', dbpath='/var/lib/mongodb',
+                logpath='/var/log/mongodb/mongodb.log', logappend=True,
+                bind_ip='0.0.0.0', port=27017, journal=True,
+                replicaset='myset', host_tuning=False,
+                wiredtiger_cache_size='auto',
+                wiredtiger_collection_compressor='snappy',
+                wiredtiger_journal_compressor='snappy')
+
+
+def measure(fn, min_time=0.2, repeat=5):
+    """Best and median seconds per call of fn"""
+    number = 1
+    while True:
+        elapsed = timeit.timeit(fn, number=number)
+        if elapsed >= min_time / repeat or number >= 10 ** 6:
+            break
+        number *= 10
+    runs = [t / number for t in timeit.repeat(fn, number=number,
+                                              repeat=repeat)]
+    return {'best': min(runs), 'median': statistics.median(runs),
+            'number': number}
+
+
+@contextlib.contextmanager
+def stubbed(tmp):
+    """Stub everything that would touch the machine, apt or a network"""
+    conf = os.path.join(tmp, 'mongodb.conf')
+    stubs = [
+        patch.object(hookenv, 'log'),
+        patch.object(handlers, 'log'),
+        patch.object(handlers, 'config', return_value=CONFIG),
+        patch.object(handlers, 'status_set'),
+        patch.object(handlers, 'open_port'),
+        patch.object(handlers, 'close_port'),
+        patch.object(handlers, 'service_running', return_value=True),
+        patch.object(handlers, 'service_restart'),
+        patch.object(handlers, 'unit_private_ip', return_value='10.0.0.1'),
+        patch.object(handlers, 'relation_ids', return_value=[]),
+        patch.object(handlers, 'relation_set'),
+        patch.object(handlers, 'is_leader', return_value=False),
+        patch.object(handlers, 'related_units', return_value=[]),
+        patch.object(mongodb_replicaset, 'members',
+                     side_effect=lambda local: [local]),
+        patch.object(mongodb, 'installed', return_value=False),
+        patch.object(mongodb, 'apt_install'),
+        patch.object(mongodb, 'apt_key'),
+        patch.object(mongodb, 'apt_update_source'),
+        patch.object(mongodb, 'lsb_release',
+                     return_value={'DISTRIB_CODENAME': 'xenial',
+                                   'DISTRIB_RELEASE': '16.04'}),
+        patch.object(mongodb, 'host_memory', return_value=16 * mongodb.GB),
+        patch.object(mongodb.MongoDB, 'config_file', conf),
+        patch.object(mongodb.MongoDB, 'upstream_list',
+                     os.path.join(tmp, 'mongodb.list')),
+        patch.object(mongodb.MongoDB, 'logrotate_file',
+                     os.path.join(tmp, 'logrotate')),
+        patch.object(mongodb.MongoDB, 'logrotate_cron',
+                     os.path.join(tmp, 'logrotate.cron')),
+        patch.object(mongodb_backup, 'CRON_FILE',
+                     os.path.join(tmp, 'backup.cron')),
+        patch.object(mongodb_trace, 'SPANS_FILE',
+                     os.path.join(tmp, 'spans.jsonl')),
+        patch.object(mongodb_restart, 'take_turn', return_value=True),
+        patch.object(mongodb_restart, 'release'),
+        patch.object(mongodb_restart, 'step_down', return_value=False),
+        patch.object(mongodb_restart, 'wait_serving'),
+    ]
+    for s in stubs:
+        s.start()
+    try:
+        yield
+    finally:
+        for s in reversed(stubs):
+            s.stop()
+
+
+def config_changed():
+    """One config-changed hook through the reactive bus"""
+    remove_state('mongodb.installed')
+    remove_state('mongodb.ready')
+    set_state('config.changed')
+    set_state('config.changed.version')
+    bus.dispatch()
+    # A changed file forces the full render and restart path every time
+    os.unlink(mongodb.MongoDB.config_file)
+
+
+def cases():
+    rs30 = recorded('rs_status_30.txt')
+    rs32 = recorded('rs_status_32.txt')
+    rs30_large = enlarge(rs30, 2 * 1024 * 1024)
+    rs32_large = enlarge(rs32, 2 * 1024 * 1024)
+    status = mongodb_shell.loads(rs32_large)
+    encoded = mongodb_bson.encode(status)
+    legacy_cfg = dict(CONFIG, version='2.6.10')
+
+    return [
+        ('decode.clean_json.small', lambda: legacy(rs30)),
+        ('decode.clean_json.large', lambda: legacy(rs30_large)),
+        ('decode.shell.small', lambda: mongodb_shell.loads(rs32)),
+        ('decode.shell.large', lambda: mongodb_shell.loads(rs32_large)),
+        ('decode.bson.large', lambda: mongodb_bson.decode(encoded)),
+        ('encode.bson.large', lambda: mongodb_bson.encode(status)),
+        ('resolve.upstream', lambda: mongodb.mongodb('3.2.10')),
+        ('resolve.archive', lambda: mongodb.mongodb('archive')),
+        ('configure.legacy', lambda: mongodb.server(legacy_cfg)._render_config(
+            {k: v for k, v in legacy_cfg.items()
+             if k in mongodb.MongoDB.config_options})),
+        ('configure.yaml', lambda: mongodb.server(CONFIG).configure(CONFIG)),
+        ('dispatch.config-changed', config_changed),
+    ]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print('{:<28} {:>12} {:>12} {:>8}'.format('case', 'baseline', 'current',
+                                              'ratio'))
+    for name, r in sorted(results.items()):
+        old = baseline.get(name)
+        if not old:
+            print('{:<28} {:>12} {:>12.6f}'.format(name, '-', r['best']))
+            continue
+        print('{:<28} {:>12.6f} {:>12.6f} {:>7.2f}x'.format(
+            name, old['best'], r['best'], r['best'] / old['best']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results to compare against')
+    parser.add_argument('--filter', default='',
+                        help='only run cases whose name contains this')
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        with stubbed(tmp):
+            results = {}
+            for name, fn in cases():
+                if args.filter in name:
+                    results[name] = measure(fn)
+                    print('{:<28} {:.6f}s'.format(name,
+                                                  results[name]['best']))
+    finally:
+        shutil.rmtree(tmp)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
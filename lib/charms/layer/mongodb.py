@@ -1,39 +1,276 @@
 
 import os
-import warnings
+import re
+import time
+import bisect
+import contextlib
 import subprocess
 import platform
-import json
+
+from collections import namedtuple, OrderedDict
+
+import yaml
 
 from charmhelpers.fetch import (
-    apt_install,
+    apt_install as _apt_install,
     apt_purge,
-    apt_update,
 )
 
+from charmhelpers.core import unitdata
 from charmhelpers.core.host import (
     lsb_release,
+    service_start,
+    service_stop,
 )
 
+from charms.layer import mongodb_client
+from charms.layer import mongodb_replicaset
+from charms.layer import mongodb_shell
+from charms.layer import mongodb_trace
+
+
+MONGO_BIN = '/usr/bin/mongo'
+LSB_RELEASE = '/etc/lsb-release'
+MEMINFO = '/proc/meminfo'
+CGROUP_MEMORY_LIMITS = [
+    '/sys/fs/cgroup/memory.max',
+    '/sys/fs/cgroup/memory/memory.limit_in_bytes',
+]
+CGROUP_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_CPU_QUOTA = ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us',
+                    '/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+COMPRESSORS = ('snappy', 'zlib', 'none')
+# Juju option: (mongo setting, first series, last series or None), from 3.0
+CONCURRENCY = OrderedDict([
+    ('wiredtiger_read_transactions',
+     ('setParameter.wiredTigerConcurrentReadTransactions', (3, 0), None)),
+    ('wiredtiger_write_transactions',
+     ('setParameter.wiredTigerConcurrentWriteTransactions', (3, 0), None)),
+    ('max_incoming_connections',
+     ('net.maxIncomingConnections', (3, 0), None)),
+    ('task_executor_pool_size',
+     ('setParameter.taskExecutorPoolSize', (3, 2), None)),
+    ('service_executor', ('net.serviceExecutor', (3, 6), (4, 4))),
+])
+SERVICE_EXECUTORS = ('synchronous', 'adaptive')
+# mongod's default number of read and write tickets
+DEFAULT_TICKETS = 128
+# Connections stay below the open files limit set for mongod
+MAX_CONNECTIONS = 51200
+# operationProfiling.mode for each profile level
+PROFILE_MODES = ('off', 'slowOp', 'all')
+APT_OPTIONS = ['--option=Dpkg::Options::=--force-confold']
+# Stable release series in order; data files only support upgrading one
+# step along this path at a time
+UPGRADE_PATH = [(2, 0), (2, 2), (2, 4), (2, 6), (3, 0), (3, 2), (3, 4),
+                (3, 6)]
+# featureCompatibilityVersion was introduced with 3.4
+FCV_SERIES = (3, 4)
+# replSetResizeOplog was introduced with 3.6
+RESIZE_OPLOG_SERIES = (3, 6)
+# Sharded cluster roles; config servers run as replica sets from 3.2
+CLUSTER_ROLES = ('shardsvr', 'configsvr', 'mongos')
+MONGOS_UNIT = '''# Managed by juju, changes will be overwritten
+[Unit]
+Description=MongoDB sharded cluster query router
+After=network.target
+
+[Service]
+User=mongodb
+ExecStart=/usr/bin/mongos --config {0}
+LimitNOFILE=64000
+
+[Install]
+WantedBy=multi-user.target
+'''
+GB = 1024 ** 3
+LOGROTATE_FREQUENCIES = ('hourly', 'daily', 'weekly', 'monthly', 'yearly')
+# logrotate runs hourly at the lowest priority so maxsize is honoured
+# without compression competing with mongod for CPU and disk
+LOGROTATE_CRON = ('# Managed by juju, changes will be overwritten\n'
+                  '17 * * * * root nice -n 19 ionice -c3 '
+                  '/usr/sbin/logrotate {0}\n')
+PROBE_KEY = 'mongodb.probe'
+APT_KEYS_KEY = 'mongodb.apt-keys'
+APT_REFRESHED_KEY = 'mongodb.apt-refreshed'
+
 
 def _as_text(bytestring):
     """Naive conversion of subprocess output to Python string"""
     return bytestring.decode("utf-8", "replace")
 
 
-# FIXME: Do this as a JSONDecoder, if possible
 def clean_json(s):
+    """Strip shell helpers from output so json.loads accepts it
+
+    Superseded by mongodb_shell.loads, which keeps the typed values and does
+    not mangle strings containing ``)`` or ``, 1``.
+    """
     return _as_text(s).replace('ISODate(',
                                '').replace(', 1',
                                            '').replace('Timestamp(',
                                                        '').replace(')', '')
 
 
+class UnsupportedVersion(Exception):
+    pass
+
+
+class Version(namedtuple('Version', ['major', 'minor', 'patch',
+                                     'prerelease'])):
+    __slots__ = ()
+
+    @property
+    def series(self):
+        return (self.major, self.minor)
+
+    @property
+    def unstable(self):
+        # Odd minors were development series until 5.0 went to rapid releases
+        return bool(self.prerelease or
+                    (self.major < 5 and self.minor % 2))
+
+
+_version_re = re.compile(r'\s*(\d+)\.(\d+)(?:\.(\d+))?(?:-(rc\d+))?')
+_shell_version_re = re.compile(r'version:? v?(\d+\.\d+\S*)')
+
+
+def parse_version(ver):
+    """Parse a MongoDB version string such as 3.2.1, 3.10.0 or 3.2.0-rc3
+
+    Distribution suffixes like ``-ubuntu1`` are ignored.
+    """
+    m = _version_re.match(ver)
+    if not m:
+        raise UnsupportedVersion('{!r} is not a MongoDB version'.format(ver))
+    major, minor, patch, prerelease = m.groups()
+    return Version(int(major), int(minor), int(patch or 0), prerelease)
+
+
+def set_parameter(name, value):
+    return OrderedDict([('setParameter', 1), (name, value)])
+
+
+def _notablescan(value):
+    return set_parameter('notablescan', bool(value))
+
+
+def _slowms(value):
+    if value is None:
+        return None
+    # Level -1 leaves the profiler as it is and only sets the threshold
+    return OrderedDict([('profile', -1), ('slowms', int(value))])
+
+
+def profile_mode(level):
+    """operationProfiling.mode of a profile level"""
+    if int(level) not in range(len(PROFILE_MODES)):
+        raise Exception('{0} is not a valid profile level, use 0, 1 or '
+                        '2'.format(level))
+    return PROFILE_MODES[int(level)]
+
+
+def _tickets(name):
+    def build(value):
+        if value is None:
+            return None
+        return set_parameter(name, int(value))
+    return build
+
+
+def auto_concurrency(cpus, memory):
+    """Concurrency settings scaled to cpus and memory bytes
+
+    Tickets bound the operations running inside WiredTiger at once; the
+    default 128 leaves cores idle on large hosts, so reads get four per
+    core and writes two. Every connection costs a thread and up to 1MB of
+    stack, which caps them at one per 2MB of memory.
+    """
+    return {
+        'wiredtiger_read_transactions': max(DEFAULT_TICKETS, 4 * cpus),
+        'wiredtiger_write_transactions': max(DEFAULT_TICKETS, 2 * cpus),
+        'max_incoming_connections': max(1000, min(
+            MAX_CONNECTIONS, memory // (2 * 1024 ** 2))),
+        'task_executor_pool_size': min(max(cpus // 8, 1), 8),
+        'service_executor': 'adaptive' if cpus >= 16 else 'synchronous',
+    }
+
+
+def _wiredtiger_cache(size_gb):
+    if size_gb is None:
+        # Going back to the default size needs the server to work it out
+        return None
+    return set_parameter('wiredTigerEngineRuntimeConfig',
+                         'cache_size={}M'.format(int(float(size_gb) * 1024)))
+
+
+def check_upgrade(current, target):
+    """Raise UnsupportedVersion unless target is one upgrade hop away"""
+    a, b = parse_version(current), parse_version(target)
+    if b[:3] < a[:3]:
+        raise UnsupportedVersion('Downgrading from {} to {} is not '
+                                 'supported'.format(current, target))
+    if a.series == b.series:
+        return
+    if a.series not in UPGRADE_PATH or b.series not in UPGRADE_PATH:
+        raise UnsupportedVersion('Upgrading from {} to {} is not '
+                                 'supported'.format(current, target))
+    step = UPGRADE_PATH[UPGRADE_PATH.index(a.series) + 1]
+    if b.series != step:
+        raise UnsupportedVersion('Upgrade from {} to {}.{} before moving to '
+                                 '{}'.format(current, step[0], step[1],
+                                             target))
+
+
+@contextlib.contextmanager
+def timed(timings, phase):
+    """Record the seconds spent in the with block as timings[phase]"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[phase] = round(time.monotonic() - start, 3)
+
+
+apt_install = mongodb_trace.traced('apt_install')(_apt_install)
+
+
+@mongodb_trace.traced()
 def apt_key(key_id):
     subprocess.check_call(['apt-key', 'adv', '--keyserver',
                            'hkps://keyserver.ubuntu.com', '--recv', key_id])
 
 
+@mongodb_trace.traced()
+def apt_update_source(source_list):
+    """Refresh the apt index of a single sources list, not the whole box"""
+    subprocess.check_call(['apt-get', 'update',
+                           '-o', 'Dir::Etc::sourcelist={}'.format(source_list),
+                           '-o', 'Dir::Etc::sourceparts=-',
+                           '-o', 'APT::Get::List-Cleanup=0'])
+
+
+def local_repo(path):
+    """Flat apt repository line for a directory of pre-fetched packages
+
+    path may be a directory or a file:// URL. A Packages index is generated
+    with apt-ftparchive when the directory does not ship one. The index
+    mtime is part of the line so that adding packages refreshes apt.
+    """
+    if path.startswith('file://'):
+        path = path[len('file://'):]
+    path = os.path.abspath(path)
+    index = os.path.join(path, 'Packages')
+    if not os.path.exists(index) and not os.path.exists(index + '.gz'):
+        with open(index, 'wb') as f:
+            subprocess.check_call(['apt-ftparchive', 'packages', '.'],
+                                  cwd=path, stdout=f)
+    if not os.path.exists(index):
+        index += '.gz'
+    return '# index {0}\ndeb [trusted=yes] file:{1} ./'.format(
+        os.stat(index).st_mtime_ns, path)
+
+
 class MongoDB(object):
     upstream_list = '/etc/apt/sources.list.d/mongodb.list'
     config_file = '/etc/mongodb.conf'
@@ -41,12 +278,31 @@ class MongoDB(object):
     config_options = ['dbpath', 'logpath', 'logappend', 'bind_ip', 'port',
                       'journal', 'cpu', 'auth', 'verbose', 'objcheck', 'quota',
                       'oplog', 'nocursors', 'nohints', 'noscripting',
-                      'notablescans', 'noprealloc', 'nssize',
-                      'oplogSize', 'opIdMem', 'replicaset']
+                      'notablescan', 'noprealloc', 'nssize',
+                      'oplogSize', 'opIdMem', 'replicaset', 'slowms',
+                      'profile']
     config_map = {
         # JUJU CFG: MONGO CFG
         'replicaset': 'replSet',
     }
+    # Mongo settings a running server accepts without a restart, mapped to
+    # a function building the admin command for the new value
+    runtime_parameters = {
+        'slowms': _slowms,
+    }
+    # Where admin commands are sent, updated by configure()
+    host = '127.0.0.1'
+    port = 27017
+    # Local directory of pre-fetched packages used instead of upstream
+    package_cache = None
+    # Whether mongodump can stream to a gzipped --archive, new in 3.2
+    archive_dumps = False
+    # Whether mongod reopens its log on logRotate, new in 3.0
+    log_reopen = False
+    # Whether config server replica sets and mongos can be deployed
+    sharding = False
+    logrotate_file = '/etc/logrotate.d/mongodb'
+    logrotate_cron = '/etc/cron.d/mongodb-logrotate'
 
     def __init__(self, source, version=None):
         if source not in self.package_map.keys():
@@ -54,9 +310,68 @@ class MongoDB(object):
         self.source = source
         self.version = version
 
+    def prepare(self):
+        """Make the packages for this version available to apt"""
+        pass
+
     def install(self):
         apt_install(self.packages())
 
+    def download(self, current):
+        """Fetch the packages to upgrade from current, returns phase timings
+
+        Unsupported upgrades are refused before anything changes, the old
+        server keeps running meanwhile.
+        """
+        check_upgrade(current, self.version)
+        timings = OrderedDict()
+        with timed(timings, 'prepare'):
+            self.prepare()
+        with timed(timings, 'download'):
+            apt_install(self.packages(), APT_OPTIONS + ['--download-only'],
+                        fatal=True)
+        return timings
+
+    def upgrade(self, config):
+        """Swap in the downloaded packages, returns phase timings
+
+        mongod is stopped only for the package swap and restarted once with
+        config rendered for the new version. dbpath is left untouched and
+        featureCompatibilityVersion is raised once every member upgraded.
+        A mongos unit restarts mongos instead, its config is unchanged.
+        """
+        mongos = config.get('cluster_role') == 'mongos'
+        service = 'mongos' if mongos else 'mongodb'
+        timings = OrderedDict()
+        with timed(timings, 'stop'):
+            service_stop(service)
+        with timed(timings, 'install'):
+            apt_install(self.packages(), APT_OPTIONS, fatal=True)
+            if not mongos:
+                self.configure(config)
+        with timed(timings, 'start'):
+            service_start(service)
+        return timings
+
+    def set_feature_compatibility(self, version):
+        """Set featureCompatibilityVersion, returns False if refused
+
+        Sent to the primary of a replica set, a set without one refuses.
+        Nothing is sent for series before featureCompatibilityVersion.
+        """
+        if version.series < FCV_SERIES:
+            return True
+        spec = {'setFeatureCompatibilityVersion': '{}.{}'.format(
+            *version.series)}
+        hello = self.command({'isMaster': 1})
+        if not hello.get('setName'):
+            return bool(self.command(spec).get('ok'))
+        if not hello.get('primary'):
+            return False
+        host, port = hello['primary'].rsplit(':', 1)
+        r = mongodb_client.connection(host, int(port)).command(spec)
+        return bool(r.get('ok'))
+
     def uninstall(self):
         apt_purge(self.packages())
         subprocess.check_call([
@@ -67,26 +382,123 @@ class MongoDB(object):
         ])
 
     def configure(self, config):
+        """Render config, returns the mongod settings that changed"""
+        self.cluster_role(config)
+        profile_mode(config.get('profile') or 0)
         cfg = {
             self.config_map.get(k, k): v
             for k, v in iter(config.items()) if v and k in self.config_options
         }
-
-        self._render_config(cfg)
+        self.host, self.port = local_address(config)
+
+        return self._update_config(cfg)
+
+    def cluster_role(self, config):
+        """The configured sharded cluster role, None outside a cluster"""
+        role = config.get('cluster_role') or None
+        if role is None:
+            return None
+        if role not in CLUSTER_ROLES:
+            raise Exception('{0} is not a valid cluster role, use one of '
+                            '{1}'.format(role, ', '.join(CLUSTER_ROLES)))
+        if not self.sharding:
+            raise UnsupportedVersion('The {0} role needs MongoDB 3.2 or '
+                                     'later'.format(role))
+        return role
+
+    def configure_mongos(self, config, config_db):
+        """Render the mongos config, returns whether it changed"""
+        raise UnsupportedVersion('mongos needs MongoDB 3.2 or later')
+
+    def _update_config(self, cfg):
+        changes = config_changes(self._read_config(), cfg)
+        if changes:
+            self._render_config(cfg)
+        return changes
+
+    def _read_config(self):
+        cfg = {}
+        for line in (_read(self.config_file) or '').splitlines():
+            k, sep, v = line.partition('=')
+            if sep and not line.lstrip().startswith('#'):
+                cfg[k.strip()] = v.strip()
+        return cfg
+
+    def needs_restart(self, changes):
+        """Whether any of the changed settings only apply on restart"""
+        return any(k not in self.runtime_parameters or
+                   self.runtime_parameters[k](v) is None
+                   for k, v in changes.items())
+
+    def apply_runtime(self, changes):
+        """Apply changed settings to the running server, see configure"""
+        for k, v in sorted(changes.items()):
+            r = self.command(self.runtime_parameters[k](v))
+            if not r.get('ok'):
+                raise IOError('Unable to set {} at runtime: {}'.format(
+                    k, r.get('errmsg')))
 
     def packages(self):
         return [p.format(self.version) for p in self.package_map[self.source]]
 
     def add_upstream(self):
+        """Write the apt source for this version, returns True if changed"""
+        if self.package_cache:
+            source = local_repo(self.package_cache)
+        else:
+            distrib = lsb_info()['DISTRIB_CODENAME']
+            source = self.upstream_repo.format(distrib)
+        if _read(self.upstream_list) == source:
+            return False
+
         with open(self.upstream_list, 'w') as f:
-            distrib = lsb_release()['DISTRIB_CODENAME']
-            f.write(self.upstream_repo.format(distrib))
+            f.write(source)
+        return True
+
+    def refresh_upstream(self, changed):
+        """Update the apt index of the upstream source unless up to date
+
+        The source refreshed is recorded only once apt-get update succeeded,
+        so an update that failed is retried even though the file is unchanged.
+        """
+        source = _read(self.upstream_list)
+        db = unitdata.kv()
+        if not changed and db.get(APT_REFRESHED_KEY) == source:
+            return
+        apt_update_source(self.upstream_list)
+        db.set(APT_REFRESHED_KEY, source)
+
+    def add_key(self, key_id):
+        """Import an apt key once per unit, returns True if it was fetched"""
+        if self.package_cache:
+            return False
+        db = unitdata.kv()
+        keys = set(db.get(APT_KEYS_KEY) or [])
+        if key_id in keys:
+            return False
+
+        apt_key(key_id)
+        db.set(APT_KEYS_KEY, sorted(keys | {key_id}))
+        return True
 
     def _render_config(self, cfg):
         with open(self.config_file, 'w') as f:
             f.write('\n'.join(
                     sorted(['%s = %s' % (k, v) for (k, v) in cfg.items()])))
 
+    def logrotate(self, config):
+        """Install the logrotate policy for logpath, returns if it changed"""
+        reopen = self.log_reopen and bool(config.get('logappend'))
+        policy = logrotate_policy(config, self.host, self.port, reopen)
+        if _read(self.logrotate_file) == policy:
+            return False
+        with open(self.logrotate_file, 'w') as f:
+            f.write(policy)
+        with open(self.logrotate_cron, 'w') as f:
+            f.write(LOGROTATE_CRON.format(self.logrotate_file))
+        return True
+
+    @mongodb_trace.traced('mongo')
     def run(self, cmd):
         """Run a mongo command returns result of command as obj"""
 
@@ -96,10 +508,98 @@ class MongoDB(object):
         if p.returncode:
             raise IOError("mongo command failed {!r}:\n"
                           "{}".format(cmd, _as_text(err)))
-        return json.loads(clean_json(out))
+        return mongodb_shell.loads(out)
+
+    def command(self, spec, shell=None):
+        """Run an admin command, returns the reply document as dict
+
+        The command is sent over a pooled wire protocol connection. Should
+        mongod not be reachable that way, the equivalent ``shell`` javascript
+        is run through the mongo shell instead, when given.
+        """
+        try:
+            conn = mongodb_client.connection(self.host, self.port)
+            return conn.command(spec)
+        except mongodb_client.ConnectionFailure:
+            if shell is None:
+                raise
+            return self.run(shell)
+
+    def replicaset_config(self):
+        """The replica set config document, None before it is initiated"""
+        r = self.command({'replSetGetConfig': 1})
+        if r.get('ok'):
+            return r['config']
+        if r.get('code') == mongodb_replicaset.NOT_YET_INITIALIZED:
+            return None
+        # replSetGetConfig is new in 3.0, older servers only have the helper
+        return self.run('rs.conf()')
+
+    def primary(self):
+        """Host and port of the replica set primary, None without one"""
+        hello = self.command({'isMaster': 1})
+        if not hello.get('primary'):
+            return None
+        host, port = hello['primary'].rsplit(':', 1)
+        return host, int(port)
+
+    def server_series(self):
+        """Release series of the server, the class series for archive"""
+        if self.version:
+            return parse_version(self.version).series
+        return getattr(self, 'series', None) or (0, 0)
+
+    def reconfigure_replicaset(self, name, hosts, configsvr=False,
+                               roles=None):
+        """Make hosts the members of replica set name with one reconfig
+
+        The set is initiated with all of them when neither this member nor
+        any of hosts is part of one yet. Returns the config sent, or None
+        when the members were already right. roles are the member roles of
+        mongodb_replicaset.roles().
+        """
+        current = self.replicaset_config()
+        if current is None:
+            primary = existing_primary(hosts)
+        else:
+            primary = self.primary()
+        if current is None and primary is None:
+            cfg = mongodb_replicaset.plan(name, hosts, configsvr=configsvr,
+                                          roles=roles)
+            r = self.command({'replSetInitiate': cfg})
+        else:
+            if primary is None:
+                raise IOError('Replica set {} has no primary'.format(name))
+            # Only the primary accepts a reconfig and has the latest config
+            conn = mongodb_client.connection(*primary)
+            current = conn.command({'replSetGetConfig': 1}).get(
+                'config', current)
+            cfg = mongodb_replicaset.plan(name, hosts, current,
+                                          '{}:{}'.format(*primary),
+                                          roles=roles)
+            if cfg is None:
+                return None
+            r = conn.command({'replSetReconfig': cfg})
+
+        if not r.get('ok'):
+            raise IOError('Unable to configure replica set {}: {}'.format(
+                name, r.get('errmsg')))
+        return cfg
+
+    def resize_oplog(self, size_mb):
+        """Resize the oplog of the running member without a restart"""
+        current = self.version or version()
+        if parse_version(current).series < RESIZE_OPLOG_SERIES:
+            raise UnsupportedVersion('Resizing the oplog needs MongoDB 3.6 '
+                                     'or later, not {}'.format(current))
+        r = self.command(OrderedDict([('replSetResizeOplog', 1),
+                                      ('size', float(size_mb))]))
+        if not r.get('ok'):
+            raise IOError('Unable to resize the oplog to {}MB: {}'.format(
+                size_mb, r.get('errmsg')))
 
     def init_replicaset(self):
-        r = self.run('rs.initiate()')
+        r = self.command({'replSetInitiate': None}, 'rs.initiate()')
         if r['ok']:
             return True
 
@@ -110,6 +610,8 @@ class MongoDB(object):
 
 
 class MongoDB20(MongoDB):
+    series = (2, 0)
+
     package_map = {
         'upstream': [
             'mongodb-10gen={}',
@@ -122,16 +624,17 @@ class MongoDB20(MongoDB):
     upstream_repo = ('deb http://downloads-distro.mongodb.org'
                      '/repo/ubuntu-upstart dist 10gen')
 
-    def install(self):
+    def prepare(self):
         if self.source == 'upstream':
-            self.add_upstream()
-            apt_update()
+            self.refresh_upstream(self.add_upstream())
 
+    def install(self):
+        self.prepare()
         super(MongoDB20, self).install()
 
     def add_upstream(self):
-        apt_key('7F0CEB10')
-        super(MongoDB20, self).add_upstream()
+        fetched = self.add_key('7F0CEB10')
+        return super(MongoDB20, self).add_upstream() or fetched
 
     def uninstall(self):
         super(MongoDB20, self).uninstall()
@@ -140,14 +643,16 @@ class MongoDB20(MongoDB):
 
 
 class MongoDB22(MongoDB20):
-    pass
+    series = (2, 2)
 
 
 class MongoDB24(MongoDB20):
-    pass
+    series = (2, 4)
 
 
 class MongoDB26(MongoDB20):
+    series = (2, 6)
+
     package_map = {
         'upstream': [
             'mongodb-org-server={}',
@@ -161,6 +666,8 @@ class MongoDB26(MongoDB20):
 
 
 class MongoDB30(MongoDB):
+    series = (3, 0)
+
     package_map = {
         'upstream': [
             'mongodb-org-server={}',
@@ -172,9 +679,171 @@ class MongoDB30(MongoDB):
     upstream_repo = ('deb http://repo.mongodb.org/apt/ubuntu '
                      '{0}/mongodb-org/3.0 multiverse')
 
+    config_options = MongoDB.config_options + [
+        'storage_engine', 'wiredtiger_cache_size',
+        'wiredtiger_collection_compressor', 'wiredtiger_journal_compressor',
+        'wiredtiger_directory_for_indexes']
+    yaml_map = {
+        # JUJU CFG: (MONGO YAML PATH, VALUE CONVERSION)
+        'dbpath': ('storage.dbPath', None),
+        'logpath': ('systemLog.path', None),
+        'logappend': ('systemLog.logAppend', None),
+        'bind_ip': ('net.bindIp', None),
+        'port': ('net.port', int),
+        'journal': ('storage.journal.enabled', None),
+        'auth': ('security.authorization', lambda v: 'enabled'),
+        'objcheck': ('net.wireObjectCheck', None),
+        'quota': ('storage.quota.enforced', None),
+        'noscripting': ('security.javascriptEnabled', lambda v: False),
+        'notablescan': ('setParameter.notablescan', None),
+        'noprealloc': ('storage.mmapv1.preallocDataFiles', lambda v: False),
+        'nssize': ('storage.mmapv1.nsSize', int),
+        'oplogSize': ('replication.oplogSizeMB', int),
+        'replicaset': ('replication.replSetName', None),
+        'storage_engine': ('storage.engine', None),
+        'slowms': ('operationProfiling.slowOpThresholdMs', int),
+        'profile': ('operationProfiling.mode', profile_mode),
+    }
+    default_engine = 'mmapv1'
+    log_reopen = True
+    # cacheSizeGB only accepts whole gigabytes before 3.4
+    fractional_cache_size = False
+    runtime_parameters = {
+        'setParameter.notablescan': _notablescan,
+        'storage.wiredTiger.engineConfig.cacheSizeGB': _wiredtiger_cache,
+        'operationProfiling.slowOpThresholdMs': _slowms,
+        'setParameter.wiredTigerConcurrentReadTransactions': _tickets(
+            'wiredTigerConcurrentReadTransactions'),
+        'setParameter.wiredTigerConcurrentWriteTransactions': _tickets(
+            'wiredTigerConcurrentWriteTransactions'),
+    }
+
+    def configure(self, config):
+        role = self.cluster_role(config)
+        if role == 'mongos':
+            # mongod is not run, configure_mongos() renders the router
+            raise Exception('mongod cannot take the mongos role')
+        cfg = {}
+        for k, v in config.items():
+            if not v or k not in self.config_options or k not in self.yaml_map:
+                continue
+            path, convert = self.yaml_map[k]
+            set_path(cfg, path, convert(v) if convert else v)
+
+        if 'path' in cfg.get('systemLog', {}):
+            cfg['systemLog']['destination'] = 'file'
+            # Let logrotate move the file, mongod reopens it on logRotate
+            if cfg['systemLog'].get('logAppend'):
+                cfg['systemLog']['logRotate'] = 'reopen'
+
+        engine = config.get('storage_engine') or self.default_engine
+        if engine == 'wiredTiger':
+            set_path(cfg, 'storage.wiredTiger', self._wiredtiger(config))
+        for path, value in self.concurrency(config, engine).items():
+            set_path(cfg, path, value)
+
+        if role:
+            set_path(cfg, 'sharding.clusterRole', role)
+
+        self.host, self.port = local_address(config)
+        return self._update_config(cfg)
+
+    def _read_config(self):
+        try:
+            cfg = yaml.safe_load(_read(self.config_file) or '')
+        except yaml.YAMLError:
+            return {}
+        return cfg if isinstance(cfg, dict) else {}
+
+    def _wiredtiger(self, config):
+        compressors = {}
+        for kind in ('collection', 'journal'):
+            c = config.get('wiredtiger_{}_compressor'.format(kind)) or 'snappy'
+            if c not in COMPRESSORS:
+                raise Exception('{0} is not a valid {1} compressor, use one '
+                                'of {2}'.format(c, kind, COMPRESSORS))
+            compressors[kind] = c
+
+        cache = config.get('wiredtiger_cache_size') or 'auto'
+        if cache == 'auto':
+            cache = self.cache_size_gb(host_memory())
+        elif self.fractional_cache_size:
+            cache = float(cache)
+        else:
+            cache = max(1, int(float(cache)))
+
+        engine = {
+            'cacheSizeGB': cache,
+            'journalCompressor': compressors['journal'],
+        }
+        if config.get('wiredtiger_directory_for_indexes'):
+            engine['directoryForIndexes'] = True
+
+        return {
+            'engineConfig': engine,
+            'collectionConfig': {
+                'blockCompressor': compressors['collection'],
+            },
+        }
+
+    def concurrency(self, config, engine):
+        """Concurrency settings configured, auto ones scaled to the host
+
+        auto leaves out what this series or engine does not have, while a
+        value set explicitly for it raises UnsupportedVersion.
+        """
+        series = self.server_series()
+        auto = None
+        settings = OrderedDict()
+        for option, (path, since, until) in CONCURRENCY.items():
+            value = config.get(option)
+            if not value:
+                continue
+            supported = since <= series and (until is None or
+                                             series <= until)
+            if 'wiredTiger' in path and engine != 'wiredTiger':
+                supported = False
+            if value == 'auto':
+                if not supported:
+                    continue
+                if auto is None:
+                    auto = auto_concurrency(host_cpus(), host_memory())
+                value = auto[option]
+            elif not supported:
+                raise UnsupportedVersion('{0} is not supported by MongoDB '
+                                         '{1}.{2} with {3}'.format(
+                                             option, series[0], series[1],
+                                             engine))
+            elif option == 'service_executor':
+                if value not in SERVICE_EXECUTORS:
+                    raise Exception('{0} is not a valid service executor, '
+                                    'use one of {1}'.format(
+                                        value, ', '.join(SERVICE_EXECUTORS)))
+            else:
+                value = int(value)
+            settings[path] = value
+        return settings
+
+    def cache_size_gb(self, memory):
+        """WiredTiger cache for memory bytes: half of (memory - 1GB)
+
+        This is the rule mongod 3.4+ applies itself, but older servers size
+        against the host rather than the container and are given it here.
+        """
+        size = max((memory - GB) / 2.0, GB / 4.0) / GB
+        if self.fractional_cache_size:
+            return round(size, 2)
+        return max(1, int(size))
+
+    def _render_config(self, cfg):
+        with open(self.config_file, 'w') as f:
+            f.write(yaml.safe_dump(cfg, default_flow_style=False))
+
+    def prepare(self):
+        self.refresh_upstream(self.add_upstream())
+
     def install(self):
-        self.add_upstream()
-        apt_update()
+        self.prepare()
         super(MongoDB30, self).install()
 
     def uninstall(self):
@@ -184,6 +853,8 @@ class MongoDB30(MongoDB):
 
 
 class MongoDB31(MongoDB30):
+    series = (3, 1)
+
     package_map = {
         'upstream': [
             'mongodb-org-unstable-server={}',
@@ -197,15 +868,93 @@ class MongoDB31(MongoDB30):
 
 
 class MongoDB32(MongoDB30):
+    series = (3, 2)
+    default_engine = 'wiredTiger'
+    archive_dumps = True
+    sharding = True
+    mongos_config_file = '/etc/mongos.conf'
+    mongos_unit_file = '/etc/systemd/system/mongos.service'
+
+    package_map = {
+        'upstream': [
+            'mongodb-org-server={}',
+            'mongodb-org-shell={}',
+            'mongodb-org-tools={}',
+            # /usr/bin/mongos, run by MONGOS_UNIT for the mongos role
+            'mongodb-org-mongos={}',
+        ],
+    }
+
     upstream_repo = ('deb http://repo.mongodb.org/apt/ubuntu '
                      '{0}/mongodb-org/3.2 multiverse')
 
+    upstream_key = 'EA312927'
+
     def add_upstream(self):
-        apt_key('EA312927')
-        super(MongoDB32, self).add_upstream()
+        fetched = self.add_key(self.upstream_key)
+        return super(MongoDB32, self).add_upstream() or fetched
+
+    def configure_mongos(self, config, config_db):
+        """Render the mongos config, returns whether it changed
+
+        config_db is the config server replica set as name/host:port,...
+        mongos follows membership changes of that set by itself, so the
+        seed list already rendered is kept while the set name is the same.
+        """
+        cfg = {}
+        for k in ('logpath', 'logappend', 'bind_ip', 'port'):
+            if config.get(k):
+                path, convert = self.yaml_map[k]
+                set_path(cfg, path, convert(config[k]) if convert else
+                         config[k])
+        if 'path' in cfg.get('systemLog', {}):
+            cfg['systemLog']['destination'] = 'file'
+
+        try:
+            current = yaml.safe_load(_read(self.mongos_config_file) or '')
+        except yaml.YAMLError:
+            current = None
+        current = current if isinstance(current, dict) else {}
+        rendered = current.get('sharding', {}).get('configDB', '')
+        if rendered.split('/')[0] == config_db.split('/')[0]:
+            config_db = rendered
+        set_path(cfg, 'sharding.configDB', config_db)
+
+        self.host, self.port = local_address(config)
+        if cfg == current:
+            return False
+        with open(self.mongos_config_file, 'w') as f:
+            f.write(yaml.safe_dump(cfg, default_flow_style=False))
+        unit = MONGOS_UNIT.format(self.mongos_config_file)
+        if _read(self.mongos_unit_file) != unit:
+            with open(self.mongos_unit_file, 'w') as f:
+                f.write(unit)
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+            subprocess.check_call(['systemctl', 'enable', 'mongos'])
+        return True
+
+
+class MongoDB34(MongoDB32):
+    series = (3, 4)
+    fractional_cache_size = True
+
+    upstream_repo = ('deb http://repo.mongodb.org/apt/ubuntu '
+                     '{0}/mongodb-org/3.4 multiverse')
+    upstream_key = 'A15703C6'
+
+
+class MongoDB36(MongoDB34):
+    series = (3, 6)
+
+    upstream_repo = ('deb http://repo.mongodb.org/apt/ubuntu '
+                     '{0}/mongodb-org/3.6 multiverse')
+    upstream_key = '91FA4AD5'
 
 
 class MongoDBzSeries(MongoDB32):
+    # Selected by architecture, never by version
+    series = None
+
     package_map = {
         'archive': [
             'mongodb-server',
@@ -216,7 +965,7 @@ class MongoDBzSeries(MongoDB32):
                      '/mongodb/ubuntu {0} main')
 
     def __init__(self, source, version=None):
-        lsb = lsb_release()
+        lsb = lsb_info()
         year = lsb['DISTRIB_RELEASE'].split('.')[0]
         if int(year) < 16:
             distrib = lsb['DISTRIB_CODENAME']
@@ -225,20 +974,187 @@ class MongoDBzSeries(MongoDB32):
         super(MongoDBzSeries, self).__init__(source, version)
 
     def add_upstream(self):
-        apt_key('3427B191')
-        super(MongoDBzSeries, self).add_upstream()
+        fetched = self.add_key('3427B191')
+        return super(MongoDBzSeries, self).add_upstream() or fetched
+
+
+def set_path(cfg, path, value):
+    """Set a dotted path such as storage.dbPath in a nested dict"""
+    keys = path.split('.')
+    for k in keys[:-1]:
+        cfg = cfg.setdefault(k, {})
+    cfg[keys[-1]] = value
+
+
+def flatten(cfg, prefix=''):
+    """Flatten nested config into {'storage.dbPath': ...}"""
+    flat = {}
+    for k, v in cfg.items():
+        if isinstance(v, dict):
+            flat.update(flatten(v, '{}{}.'.format(prefix, k)))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+
+def config_changes(old, new):
+    """Settings that differ between two configs, None when removed
+
+    Values are compared as rendered, so the strings read back from the
+    legacy format match the typed values they were written from.
+    """
+    old, new = flatten(old), flatten(new)
+    return {k: new.get(k) for k in set(old) | set(new)
+            if str(old.get(k)) != str(new.get(k))}
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def logrotate_policy(config, host, port, reopen=True):
+    """logrotate policy for the configured logpath
+
+    With reopen, logrotate renames the log and the postrotate script has
+    mongod open a new one through the logRotate admin command, or SIGUSR1
+    when the shell cannot reach it. Servers that always rename their own
+    log on logRotate get copytruncate instead.
+    """
+    frequency = config.get('logrotate-frequency') or 'daily'
+    if frequency not in LOGROTATE_FREQUENCIES:
+        raise Exception('{0} is not a valid logrotate frequency, use one '
+                        'of {1}'.format(frequency, ', '.join(
+                            LOGROTATE_FREQUENCIES)))
+
+    lines = [frequency,
+             'rotate {}'.format(int(config.get('logrotate-rotate') or 0)),
+             'missingok',
+             'notifempty']
+    if config.get('logrotate-maxsize'):
+        lines.append('maxsize {}'.format(config.get('logrotate-maxsize')))
+    if config.get('logrotate-compress', True):
+        # The newest rotated file is compressed on the next run instead
+        lines += ['compress', 'delaycompress']
+    if reopen:
+        lines += [
+            'nocreate',
+            'sharedscripts',
+            'postrotate',
+            '    /usr/bin/mongo --quiet --host {0} --port {1} --eval '
+            '"db.adminCommand({{logRotate: 1}})" >/dev/null 2>&1 || '
+            '/usr/bin/pkill -USR1 -x mongod'.format(host, port),
+            'endscript',
+        ]
+    else:
+        lines.append('copytruncate')
+
+    return ('# Managed by juju, changes will be overwritten\n'
+            '{0} {{\n{1}\n}}\n').format(
+        config.get('logpath'), '\n'.join('    ' + line for line in lines))
+
+
+def host_memory():
+    """Bytes of memory available to this unit, honouring cgroup limits"""
+    memory = None
+    for line in (_read(MEMINFO) or '').splitlines():
+        if line.startswith('MemTotal:'):
+            memory = int(line.split()[1]) * 1024
+    for path in CGROUP_MEMORY_LIMITS:
+        limit = (_read(path) or '').strip()
+        if limit.isdigit() and (memory is None or int(limit) < memory):
+            memory = int(limit)
+    if memory is None:
+        raise Exception('Unable to determine available memory')
+    return memory
+
+
+def host_cpus():
+    """CPUs available to this unit, honouring affinity and cgroup quotas"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = (_read(CGROUP_CPU_MAX) or '').split()
+    if not quota:
+        quota = [(_read(p) or '').strip() for p in CGROUP_CPU_QUOTA]
+    if len(quota) == 2 and all(q.isdigit() for q in quota):
+        cpus = min(cpus, max(1, int(quota[0]) // int(quota[1])))
+    return cpus
+
+
+def local_address(config):
+    """Host and port this unit's mongod can be reached on locally"""
+    host = (config.get('bind_ip') or '').split(',')[0].strip()
+    if host in ('', '0.0.0.0', '::'):
+        host = '127.0.0.1'
+    return host, config.get('port') or MongoDB.port
+
+
+def _fingerprint(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_mtime_ns, st.st_size]
+
+
+def probe(name, sources, fn):
+    """Return fn(), cached in unit state until any of sources change
+
+    The cached value is keyed on the inode, mtime and size of each source
+    path, so repeat hooks skip the work entirely until a package upgrade or
+    release upgrade replaces one of them.
+    """
+    db = unitdata.kv()
+    key = '{}.{}'.format(PROBE_KEY, name)
+    fingerprint = [_fingerprint(p) for p in sources]
+    cached = db.get(key)
+    if cached and cached.get('fingerprint') == fingerprint:
+        db.set(PROBE_KEY + '.hits', probe_stats()['hits'] + 1)
+        return cached['value']
+
+    value = fn()
+    db.set(key, {'fingerprint': fingerprint, 'value': value})
+    db.set(PROBE_KEY + '.misses', probe_stats()['misses'] + 1)
+    return value
+
+
+def probe_stats():
+    """Probe cache hit and miss counters for this unit"""
+    db = unitdata.kv()
+    return {
+        'hits': db.get(PROBE_KEY + '.hits', 0),
+        'misses': db.get(PROBE_KEY + '.misses', 0),
+    }
+
+
+def lsb_info():
+    return probe('lsb', [LSB_RELEASE], lsb_release)
 
 
 def installed():
-    return os.path.isfile('/usr/bin/mongo')
+    return os.path.isfile(MONGO_BIN)
+
+
+def _mongo_version():
+    out = subprocess.check_output(
+        [MONGO_BIN, '--version'], stderr=subprocess.STDOUT).decode('UTF-8')
+    # "MongoDB shell version: 3.2.22", from 3.4 "... version v3.4.24"
+    match = _shell_version_re.search(out)
+    if not match:
+        raise UnsupportedVersion('Unable to tell the mongo version from: '
+                                 '{}'.format(out.strip()))
+    return match.group(1)
 
 
 def version():
     if not installed():
         return None
-    return subprocess.check_output(
-               ['/usr/bin/mongo', '--version'],
-               stderr=subprocess.STDOUT).decode('UTF-8').split(': ')[1]
+    return probe('version', [MONGO_BIN], _mongo_version)
 
 
 _distro_map = {
@@ -253,36 +1169,87 @@ _arch_map = {
 }
 
 
+def _build_registry():
+    """Sorted (series, class) pairs for stable and development series"""
+    stable, unstable = [], []
+    todo = [MongoDB]
+    while todo:
+        cls = todo.pop()
+        todo.extend(cls.__subclasses__())
+        series = cls.__dict__.get('series')
+        if series:
+            v = Version(series[0], series[1], 0, None)
+            (unstable if v.unstable else stable).append((series, cls))
+
+    def index(pairs):
+        pairs.sort(key=lambda p: p[0])
+        return [p[0] for p in pairs], [p[1] for p in pairs]
+
+    return index(stable), index(unstable)
+
+
+_registry = _build_registry()
+
+
+def lookup(ver):
+    """Find the MongoDB class that installs ver
+
+    Resolves to the closest series at or below ver within the same major
+    version. Development series and release candidates only resolve to
+    development series classes. A stable series past the newest class of
+    its major is refused, its packages are in a repository none uses.
+    """
+    v = parse_version(ver)
+    series, classes = _registry[1 if v.unstable else 0]
+    i = bisect.bisect_right(series, v.series)
+    newer = i < len(series) and series[i][0] == v.major
+    if i and series[i - 1][0] == v.major and (
+            v.unstable or newer or series[i - 1] == v.series):
+        return classes[i - 1]
+
+    raise UnsupportedVersion('No MongoDB {} series class can install {}'
+                             .format('development' if v.unstable else
+                                     'stable', ver))
+
+
+def existing_primary(hosts):
+    """Primary of a replica set any of hosts is a member of, None if none is
+
+    Raises IOError when a host cannot tell or its set has no primary, as
+    initiating another set then would split the deployment.
+    """
+    for member in hosts:
+        host, port = member.rsplit(':', 1)
+        hello = mongodb_client.connection(host, int(port)).command(
+            {'isMaster': 1})
+        if not hello.get('setName'):
+            continue
+        if not hello.get('primary'):
+            raise IOError('Replica set {} of {} has no primary'.format(
+                hello['setName'], member))
+        host, port = hello['primary'].rsplit(':', 1)
+        return host, int(port)
+    return None
+
+
+def server(config):
+    """The MongoDB for the configured version, addressed as configured"""
+    m = mongodb(config.get('version'))
+    m.host, m.port = local_address(config)
+    return m
+
+
 def mongodb(ver=None):
     if not ver and installed():
         ver = version()
     if platform.machine() in _arch_map:
         return _arch_map[platform.machine()]('archive')
     if not ver or ver == 'archive':
-        distro = lsb_release()['DISTRIB_CODENAME']
+        distro = lsb_info()['DISTRIB_CODENAME']
         if distro not in _distro_map.keys():
             _msg = 'Unknown distribution: {0}. Please deploy only on: {1}'
             raise Exception(_msg.format(distro, _distro_map.keys()))
 
         return _distro_map[distro]('archive')
 
-    def subclasses(cls):
-        return cls.__subclasses__() + [g for s in cls.__subclasses__()
-                                       for g in subclasses(s)]
-
-    def search(version):
-        # Does a count down search of version until next lowest match. So
-        # long as it doesn't drop below a major version things should be good.
-        major, minor = [c for c in version.replace('.', '')[:2]]
-        minor_range = reversed(range(0, int(minor) + 1))
-        needles = ['MongoDB{0}{1}'.format(major, v) for v in minor_range]
-
-        for needle in needles:
-            for m in subclasses(MongoDB):
-                if m.__name__ == needle:
-                    return m('upstream', version)
-
-        warnings.warn('No viable major version found')
-        return None
-
-    return search(ver)
+    return lookup(ver)('upstream', ver)
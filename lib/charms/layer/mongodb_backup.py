@@ -0,0 +1,228 @@
+"""Scheduled mongodump backups
+
+Every unit gets the same cron entries and each run works out from
+replSetGetStatus whether it is on the member backups are taken from, the
+first healthy secondary, so the primary is only dumped when it is alone.
+Full backups are streamed by mongodump straight into a gzipped archive.
+Optional oplog slices capture the writes made between full backups.
+
+Run by cron from the charm directory:
+
+    python3 -m charms.layer.mongodb_backup full --directory /srv/backups
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import argparse
+import contextlib
+import subprocess
+
+from charms.layer import mongodb_client
+
+
+CRON_FILE = '/etc/cron.d/mongodb-backup'
+STATE_FILE = 'state.json'
+LOCK_FILE = '.lock'
+PARTIAL = '.partial'
+FULL = 'full'
+OPLOG = 'oplog'
+
+PRIMARY = 1
+SECONDARY = 2
+
+
+def source(status):
+    """The replica set member backups are taken on, None when standalone"""
+    if not status or not status.get('ok'):
+        return None
+    members = sorted(status.get('members', []), key=lambda m: m['_id'])
+    for state in (SECONDARY, PRIMARY):
+        for m in members:
+            if m.get('state') == state and m.get('health', 1):
+                return m
+    return None
+
+
+def optime(member):
+    """Timestamp of the last oplog entry a member applied"""
+    ts = member['optime']
+    # Protocol version 1 sets wrap the timestamp with the election term
+    if isinstance(ts, dict):
+        ts = ts['ts']
+    return ts
+
+
+def _timestamp(ts):
+    return {'$timestamp': {'t': ts[0], 'i': ts[1]}}
+
+
+def oplog_query(after, until):
+    """mongodump --query selecting oplog entries in (after, until]"""
+    return json.dumps({'ts': {'$gt': _timestamp(after),
+                              '$lte': _timestamp(until)}},
+                      sort_keys=True)
+
+
+def _name(kind, archive):
+    name = '{}-{}'.format(kind, time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()))
+    return name + '.archive.gz' if archive else name
+
+
+def _taken(name):
+    return name.split('-', 1)[1]
+
+
+def dump(args, path, archive=True):
+    """Run mongodump into path, which only appears once the dump is whole"""
+    partial = path + PARTIAL
+    if archive:
+        args = args + ['--archive={}'.format(partial), '--gzip']
+    else:
+        args = args + ['--out', partial]
+    subprocess.check_call(args)
+    os.rename(partial, path)
+    return path
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def prune(directory, keep):
+    """Keep the newest keep full backups and the oplog slices after them"""
+    names = sorted(os.listdir(directory))
+    # Anything partial is left over from an interrupted run
+    stale = [n for n in names if n.endswith(PARTIAL)]
+    names = [n for n in names if n not in stale]
+    full = [n for n in names if n.startswith(FULL + '-')]
+    removed = full[:-keep] if keep and len(full) > keep else []
+    if removed:
+        oldest = _taken(full[len(removed)])
+        removed += [n for n in names if n.startswith(OPLOG + '-') and
+                    _taken(n) < oldest]
+    for n in removed + stale:
+        _remove(os.path.join(directory, n))
+    return removed
+
+
+def _state(directory):
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_state(directory, state):
+    path = os.path.join(directory, STATE_FILE)
+    with open(path + PARTIAL, 'w') as f:
+        json.dump(state, f)
+    os.rename(path + PARTIAL, path)
+
+
+@contextlib.contextmanager
+def _locked(directory):
+    with open(os.path.join(directory, LOCK_FILE), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def backup(kind, directory, host='127.0.0.1', port=27017, keep=7,
+           parallel=4, archive=True):
+    """Take a full backup or an oplog slice when this member is the source
+
+    Returns the path written, or None when there was nothing to do here.
+    """
+    conn = mongodb_client.connection(host, port)
+    member = source(conn.command({'replSetGetStatus': 1}))
+    if member is not None and not member.get('self'):
+        return None
+    if kind == OPLOG and member is None:
+        return None
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with _locked(directory):
+        state = _state(directory)
+        args = ['mongodump', '--host', host, '--port', str(port)]
+        if kind == FULL:
+            if archive:
+                args.append('--numParallelCollections={}'.format(parallel))
+            if member is not None:
+                args.append('--oplog')
+            path = dump(args, os.path.join(directory, _name(FULL, archive)),
+                        archive)
+            prune(directory, keep)
+        else:
+            # Slices continue from the last backup taken on this unit
+            if not state.get('ts'):
+                return None
+            args += ['--db', 'local', '--collection', 'oplog.rs',
+                     '--query', oplog_query(state['ts'], optime(member))]
+            path = dump(args, os.path.join(directory, _name(OPLOG, archive)),
+                        archive)
+
+        if member is not None:
+            _save_state(directory, {'ts': list(optime(member))})
+        return path
+
+
+def cron(config, host, archive=True, charm_dir=None, python=None):
+    """/etc/cron.d entries running the backups configured"""
+    command = ('root cd {} && PYTHONPATH=lib {} -m charms.layer.mongodb_backup'
+               ' {{}} --directory {} --host {} --port {} --keep {}'
+               ' --parallel {}').format(
+        charm_dir or os.environ.get('CHARM_DIR', os.getcwd()),
+        python or sys.executable, config.get('backup_directory'), host,
+        config.get('port'), config.get('backup_copies_kept'),
+        config.get('backup_parallel_collections'))
+    if not archive:
+        command += ' --no-archive'
+
+    lines = ['# Managed by juju, changes will be overwritten',
+             '{} {}'.format(config.get('backup_schedule'),
+                            command.format('full'))]
+    interval = config.get('backup_oplog_interval')
+    if interval:
+        lines.append('*/{} * * * * {}'.format(interval,
+                                              command.format('oplog')))
+    return '\n'.join(lines) + '\n'
+
+
+def schedule(config, host, archive=True):
+    """Install or remove the cron entries for the backups configured"""
+    if not config.get('backups_enabled'):
+        if os.path.exists(CRON_FILE):
+            os.unlink(CRON_FILE)
+        return False
+    with open(CRON_FILE, 'w') as f:
+        f.write(cron(config, host, archive))
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Back up mongodb')
+    parser.add_argument('kind', choices=[FULL, OPLOG])
+    parser.add_argument('--directory', required=True)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--keep', type=int, default=7)
+    parser.add_argument('--parallel', type=int, default=4)
+    parser.add_argument('--no-archive', dest='archive', action='store_false',
+                        help='dump to a directory, for mongodump before 3.2')
+    args = parser.parse_args(argv)
+
+    path = backup(args.kind, args.directory, args.host, args.port,
+                  args.keep, args.parallel, args.archive)
+    if path:
+        print(path)
+
+
+if __name__ == '__main__':
+    main()  # pragma: no cover
@@ -0,0 +1,193 @@
+import binascii
+import struct
+import datetime
+
+from collections import namedtuple, OrderedDict
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+_INT32_MIN, _INT32_MAX = -2 ** 31, 2 ** 31 - 1
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+_int32 = struct.Struct('<i')
+_int64 = struct.Struct('<q')
+_double = struct.Struct('<d')
+_timestamp = struct.Struct('<II')
+
+
+class BSONError(ValueError):
+    pass
+
+
+Timestamp = namedtuple('Timestamp', ['time', 'inc'])
+Binary = namedtuple('Binary', ['subtype', 'data'])
+Regex = namedtuple('Regex', ['pattern', 'flags'])
+
+
+class ObjectId(object):
+    """12 byte MongoDB object id"""
+    __slots__ = ('binary',)
+
+    def __init__(self, oid):
+        if isinstance(oid, str):
+            oid = binascii.unhexlify(oid)
+        if len(oid) != 12:
+            raise BSONError('{!r} is not a valid ObjectId'.format(oid))
+        self.binary = bytes(oid)
+
+    def __str__(self):
+        return binascii.hexlify(self.binary).decode('ascii')
+
+    def __repr__(self):
+        return "ObjectId('{}')".format(self)
+
+    def __eq__(self, other):
+        return isinstance(other, ObjectId) and self.binary == other.binary
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.binary)
+
+
+def from_millis(ms):
+    return EPOCH + datetime.timedelta(milliseconds=ms)
+
+
+def to_millis(dt):
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000 + \
+        delta.microseconds // 1000
+
+
+def _cstring(s):
+    b = s.encode('utf-8')
+    if b'\x00' in b:
+        raise BSONError('{!r} contains a NUL byte'.format(s))
+    return b + b'\x00'
+
+
+def _string(s):
+    b = s.encode('utf-8')
+    return _int32.pack(len(b) + 1) + b + b'\x00'
+
+
+def _element(key, value):
+    name = _cstring(key)
+    if value is None:
+        return b'\x0A' + name
+    if isinstance(value, bool):
+        return b'\x08' + name + (b'\x01' if value else b'\x00')
+    if isinstance(value, int):
+        if _INT32_MIN <= value <= _INT32_MAX:
+            return b'\x10' + name + _int32.pack(value)
+        if _INT64_MIN <= value <= _INT64_MAX:
+            return b'\x12' + name + _int64.pack(value)
+        raise BSONError('{} does not fit in 64 bits'.format(value))
+    if isinstance(value, float):
+        return b'\x01' + name + _double.pack(value)
+    if isinstance(value, str):
+        return b'\x02' + name + _string(value)
+    if isinstance(value, Timestamp):
+        return b'\x11' + name + _timestamp.pack(value.inc, value.time)
+    if isinstance(value, Regex):
+        return b'\x0B' + name + _cstring(value.pattern) + \
+            _cstring(value.flags)
+    if isinstance(value, (bytes, bytearray)):
+        value = Binary(0, value)
+    if isinstance(value, Binary):
+        return (b'\x05' + name + _int32.pack(len(value.data)) +
+                bytes([value.subtype]) + bytes(value.data))
+    if isinstance(value, ObjectId):
+        return b'\x07' + name + value.binary
+    if isinstance(value, datetime.datetime):
+        return b'\x09' + name + _int64.pack(to_millis(value))
+    if isinstance(value, dict):
+        return b'\x03' + name + encode(value)
+    if isinstance(value, (list, tuple)):
+        return b'\x04' + name + encode(
+            OrderedDict((str(i), v) for i, v in enumerate(value)))
+    raise BSONError('Cannot encode {!r} as BSON'.format(value))
+
+
+def encode(doc):
+    """Encode a mapping as a BSON document, keeping the key order"""
+    body = b''.join(_element(k, v) for k, v in doc.items())
+    return _int32.pack(len(body) + 5) + body + b'\x00'
+
+
+def _read_cstring(buf, pos):
+    end = buf.index(b'\x00', pos)
+    return buf[pos:end].decode('utf-8', 'replace'), end + 1
+
+
+def _read_document(buf, pos, as_list=False):
+    size = _int32.unpack_from(buf, pos)[0]
+    end = pos + size - 1
+    if size < 5 or end >= len(buf) or buf[end] != 0:
+        raise BSONError('Malformed BSON document at offset {}'.format(pos))
+    pos += 4
+    doc = [] if as_list else {}
+    while pos < end:
+        kind = buf[pos]
+        key, pos = _read_cstring(buf, pos + 1)
+        value, pos = _read_value(kind, buf, pos)
+        if as_list:
+            doc.append(value)
+        else:
+            doc[key] = value
+    return doc, end + 1
+
+
+def _read_value(kind, buf, pos):
+    if kind == 0x01:
+        return _double.unpack_from(buf, pos)[0], pos + 8
+    if kind in (0x02, 0x0D, 0x0E):
+        size = _int32.unpack_from(buf, pos)[0]
+        pos += 4
+        return buf[pos:pos + size - 1].decode('utf-8', 'replace'), \
+            pos + size
+    if kind == 0x03:
+        return _read_document(buf, pos)
+    if kind == 0x04:
+        return _read_document(buf, pos, as_list=True)
+    if kind == 0x05:
+        size = _int32.unpack_from(buf, pos)[0]
+        subtype = buf[pos + 4]
+        data = bytes(buf[pos + 5:pos + 5 + size])
+        return Binary(subtype, data), pos + 5 + size
+    if kind in (0x06, 0x0A, 0x7F, 0xFF):
+        # undefined, null, max key and min key carry no payload
+        return None, pos
+    if kind == 0x07:
+        return ObjectId(bytes(buf[pos:pos + 12])), pos + 12
+    if kind == 0x08:
+        return buf[pos] == 1, pos + 1
+    if kind == 0x09:
+        return from_millis(_int64.unpack_from(buf, pos)[0]), pos + 8
+    if kind == 0x0B:
+        pattern, pos = _read_cstring(buf, pos)
+        flags, pos = _read_cstring(buf, pos)
+        return Regex(pattern, flags), pos
+    if kind == 0x10:
+        return _int32.unpack_from(buf, pos)[0], pos + 4
+    if kind == 0x11:
+        inc, time = _timestamp.unpack_from(buf, pos)
+        return Timestamp(time, inc), pos + 8
+    if kind == 0x12:
+        return _int64.unpack_from(buf, pos)[0], pos + 8
+    raise BSONError('Unsupported BSON type 0x{:02x}'.format(kind))
+
+
+def decode(data, pos=0):
+    """Decode a single BSON document starting at pos, returns (doc, end)"""
+    try:
+        return _read_document(data, pos)
+    except BSONError:
+        raise
+    except (struct.error, IndexError, ValueError) as e:
+        raise BSONError('Truncated BSON document: {}'.format(e))
@@ -0,0 +1,232 @@
+import atexit
+import itertools
+import socket
+import struct
+
+from collections import OrderedDict
+
+from charms.layer import mongodb_bson as bson
+
+
+OP_REPLY = 1
+OP_QUERY = 2004
+OP_MSG = 2013
+
+# OP_MSG was introduced with MongoDB 3.6 (wire version 6)
+OP_MSG_WIRE_VERSION = 6
+# The find command was introduced with MongoDB 3.2 (wire version 4)
+FIND_WIRE_VERSION = 4
+
+QUERY_SECONDARY_OK = 1 << 2
+REPLY_QUERY_FAILURE = 1 << 1
+MSG_CHECKSUM_PRESENT = 1 << 0
+
+# Opcode a server answers each request opcode with
+REPLIES = {OP_QUERY: OP_REPLY, OP_MSG: OP_MSG}
+
+HEADER = struct.Struct('<iiii')
+_request_id = itertools.count(1)
+
+
+class ConnectionFailure(IOError):
+    pass
+
+
+class Connection(object):
+    """Single socket to a mongod speaking the wire protocol directly
+
+    Commands are sent as OP_MSG when the server supports it and as OP_QUERY
+    against ``<db>.$cmd`` otherwise. A socket that cannot be opened or
+    written to is reopened once per command before giving up.
+    """
+
+    def __init__(self, host='127.0.0.1', port=27017, timeout=10.0):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.sock = None
+        self.max_wire_version = 0
+
+    def connect(self):
+        try:
+            self.sock = socket.create_connection((self.host, self.port),
+                                                 self.timeout)
+        except (socket.error, socket.timeout) as e:
+            raise ConnectionFailure('Unable to connect to {}:{}: {}'.format(
+                self.host, self.port, e))
+        self.sock.settimeout(self.timeout)
+        hello = self._query({'isMaster': 1}, 'admin')
+        self.max_wire_version = hello.get('maxWireVersion', 0)
+        return hello
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+
+    def command(self, spec, db='admin'):
+        """Run a command document against db, returns the reply as dict
+
+        Failing to connect or to send the request is retried once on a new
+        socket. Once the request is sent the server may have run it, so a
+        failure is raised rather than running the command again.
+        """
+        for attempt in range(2):
+            sent = False
+            try:
+                if self.sock is None:
+                    self.connect()
+                op_msg = self.max_wire_version >= OP_MSG_WIRE_VERSION
+                opcode, body = encode_command(spec, db, op_msg=op_msg)
+                request_id = self._send(opcode, body)
+                sent = True
+                return self._reply(opcode, request_id)
+            except (socket.error, socket.timeout, ConnectionFailure) as e:
+                self.close()
+                if attempt or sent:
+                    raise ConnectionFailure(
+                        'mongo command failed {!r}: {}'.format(spec, e))
+
+    def find_one(self, collection, db, sort=None, projection=None):
+        """First document of collection in sort order, None if it is empty
+
+        Read with the find command from 3.2 and with an OP_QUERY on the
+        collection before it. Raises IOError when the server refuses.
+        """
+        try:
+            if self.sock is None:
+                self.connect()
+            if self.max_wire_version < FIND_WIRE_VERSION:
+                query = {'$query': {}, '$orderby': sort} if sort else {}
+                opcode, body = encode_query(collection, db, query,
+                                            projection)
+                docs = decode_documents(
+                    self._read_reply(opcode, self._send(opcode, body)))
+                return docs[0] if docs else None
+        except (socket.error, socket.timeout, ConnectionFailure) as e:
+            self.close()
+            raise ConnectionFailure('query of {}.{} failed: {}'.format(
+                db, collection, e))
+
+        spec = OrderedDict([('find', collection)])
+        if sort:
+            spec['sort'] = sort
+        if projection:
+            spec['projection'] = projection
+        spec['limit'] = 1
+        spec['singleBatch'] = True
+        r = self.command(spec, db)
+        if not r.get('ok'):
+            raise IOError('find on {}.{} failed: {}'.format(
+                db, collection, r.get('errmsg')))
+        batch = r['cursor']['firstBatch']
+        return batch[0] if batch else None
+
+    def _query(self, spec, db):
+        return self._roundtrip(*encode_command(spec, db))
+
+    def _roundtrip(self, opcode, body):
+        return self._reply(opcode, self._send(opcode, body))
+
+    def _send(self, opcode, body):
+        request_id, data = message(opcode, body)
+        self.sock.sendall(data)
+        return request_id
+
+    def _reply(self, opcode, request_id):
+        return decode_reply(REPLIES[opcode],
+                            self._read_reply(opcode, request_id))
+
+    def _read_reply(self, opcode, request_id):
+        """Body of the reply to request_id"""
+        size, _, response_to, op = HEADER.unpack(self._recv(16))
+        if response_to != request_id or op != REPLIES[opcode]:
+            raise ConnectionFailure('unexpected reply to request {}'.format(
+                request_id))
+        return self._recv(size - 16)
+
+    def _recv(self, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        pos = 0
+        while pos < size:
+            n = self.sock.recv_into(view[pos:])
+            if not n:
+                raise ConnectionFailure('connection closed by server')
+            pos += n
+        return bytes(buf)
+
+
+def encode_command(spec, db, op_msg=False):
+    """Opcode and message body running command spec against db"""
+    if op_msg:
+        spec = OrderedDict(spec)
+        spec['$db'] = db
+        spec.setdefault('$readPreference', {'mode': 'primaryPreferred'})
+        return OP_MSG, struct.pack('<I', 0) + b'\x00' + bson.encode(spec)
+    return encode_query('$cmd', db, spec)
+
+
+def encode_query(collection, db, query, projection=None):
+    """OP_QUERY message body for the first batch of query on collection"""
+    body = (struct.pack('<i', QUERY_SECONDARY_OK) +
+            '{}.{}\x00'.format(db, collection).encode('utf-8') +
+            struct.pack('<ii', 0, -1) + bson.encode(query))
+    if projection:
+        body += bson.encode(projection)
+    return OP_QUERY, body
+
+
+def message(opcode, body):
+    """Request id and the framed message to send for body"""
+    request_id = next(_request_id)
+    return request_id, HEADER.pack(16 + len(body), request_id, 0,
+                                   opcode) + body
+
+
+def decode_reply(opcode, data):
+    """Command reply document from the body of an OP_REPLY or OP_MSG"""
+    if opcode == OP_REPLY:
+        flags, _, _, returned = struct.unpack_from('<iqii', data, 0)
+        if flags & REPLY_QUERY_FAILURE or not returned:
+            raise ConnectionFailure('query failure')
+        return bson.decode(data, 20)[0]
+    flags = struct.unpack_from('<I', data, 0)[0]
+    if data[4] != 0:
+        raise ConnectionFailure('unexpected OP_MSG section kind {}'.format(
+            data[4]))
+    end = len(data) - 4 if flags & MSG_CHECKSUM_PRESENT else len(data)
+    return bson.decode(data[:end], 5)[0]
+
+
+def decode_documents(data):
+    """Documents returned in the body of an OP_REPLY to a query"""
+    flags, _, _, returned = struct.unpack_from('<iqii', data, 0)
+    docs, pos = [], 20
+    for _ in range(returned):
+        doc, pos = bson.decode(data, pos)
+        docs.append(doc)
+    if flags & REPLY_QUERY_FAILURE:
+        raise ConnectionFailure('query failure: {}'.format(
+            docs[0].get('$err') if docs else 'no reason given'))
+    return docs
+
+
+_pool = {}
+
+
+def connection(host='127.0.0.1', port=27017, timeout=10.0):
+    """Return the pooled connection for host:port, one per hook run"""
+    key = (host, int(port))
+    if key not in _pool:
+        _pool[key] = Connection(host, port, timeout)
+    return _pool[key]
+
+
+@atexit.register
+def close_all():
+    for conn in _pool.values():
+        conn.close()
+    _pool.clear()
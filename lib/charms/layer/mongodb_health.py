@@ -0,0 +1,157 @@
+"""Deadline bounded health probes of mongod servers
+
+Every server is probed concurrently over its own connection: isMaster to
+learn its replica set state, then ping to time a round trip. Nothing takes
+longer than the deadline, so a wedged server cannot hang a hook.
+
+Written against asyncio protocols and futures rather than coroutines, so
+the same code runs on the Python 3.4 of trusty and on later releases.
+"""
+import time
+import asyncio
+
+from collections import namedtuple
+
+from charms.layer import mongodb_client
+
+
+Health = namedtuple('Health', ['host', 'port', 'ok', 'state', 'latency',
+                               'error'])
+
+
+def state(hello):
+    """Role of a server from its isMaster reply"""
+    if hello.get('msg') == 'isdbgrid':
+        return 'mongos'
+    if not hello.get('setName'):
+        return 'standalone'
+    if hello.get('ismaster'):
+        return 'primary'
+    if hello.get('secondary'):
+        return 'secondary'
+    if hello.get('arbiterOnly'):
+        return 'arbiter'
+    return 'recovering'
+
+
+class _Probe(asyncio.Protocol):
+    """isMaster then ping over one connection, resolving result with both"""
+
+    def __init__(self, result):
+        self.result = result
+        self.transport = None
+        self.buffer = b''
+        self.hello = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # The handshake stays OP_QUERY, which every server version accepts
+        self.send({'isMaster': 1}, op_msg=False)
+
+    def send(self, spec, op_msg):
+        opcode, body = mongodb_client.encode_command(spec, 'admin', op_msg)
+        self.request_id, data = mongodb_client.message(opcode, body)
+        self.reply_opcode = mongodb_client.REPLIES[opcode]
+        self.sent = time.monotonic()
+        self.transport.write(data)
+
+    def data_received(self, data):
+        self.buffer += data
+        if len(self.buffer) < mongodb_client.HEADER.size:
+            return
+        size, _, response_to, op = mongodb_client.HEADER.unpack_from(
+            self.buffer)
+        if len(self.buffer) < size:
+            return
+        latency = time.monotonic() - self.sent
+        body = self.buffer[mongodb_client.HEADER.size:size]
+        self.buffer = self.buffer[size:]
+
+        try:
+            if response_to != self.request_id or op != self.reply_opcode:
+                raise mongodb_client.ConnectionFailure(
+                    'unexpected reply to request {}'.format(self.request_id))
+            reply = mongodb_client.decode_reply(op, body)
+        except (mongodb_client.ConnectionFailure, ValueError) as e:
+            self.finish(error=e)
+            return
+
+        if self.hello is None:
+            self.hello = reply
+            self.send({'ping': 1}, reply.get('maxWireVersion', 0) >=
+                      mongodb_client.OP_MSG_WIRE_VERSION)
+        else:
+            self.finish((self.hello, reply, latency))
+
+    def connection_lost(self, exc):
+        self.finish(error=exc or mongodb_client.ConnectionFailure(
+            'connection closed by server'))
+
+    def finish(self, value=None, error=None):
+        if not self.result.done():
+            if error is None:
+                self.result.set_result(value)
+            else:
+                self.result.set_exception(error)
+        if self.transport is not None:
+            self.transport.close()
+
+
+def _health(host, port, result):
+    if not result.done():
+        return Health(host, port, False, None, None, 'timed out')
+    if result.exception() is not None:
+        return Health(host, port, False, None, None, str(result.exception()))
+    hello, ping, latency = result.result()
+    return Health(host, port, bool(ping.get('ok')), state(hello), latency,
+                  ping.get('errmsg'))
+
+
+def probe(servers, timeout=5.0):
+    """Health of every (host, port) in servers, in the same order
+
+    Returns within timeout seconds; servers that did not answer in time
+    are reported as timed out.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results, connects = [], []
+        for host, port in servers:
+            result = asyncio.Future(loop=loop)
+            connect = loop.create_task(loop.create_connection(
+                lambda result=result: _Probe(result), host, int(port)))
+            connect.add_done_callback(
+                lambda task, result=result: _connected(task, result))
+            results.append(result)
+            connects.append(connect)
+
+        if results:
+            loop.run_until_complete(asyncio.wait(results, timeout=timeout))
+        health = [_health(host, port, result)
+                  for (host, port), result in zip(servers, results)]
+
+        # Drop whatever is still in flight before closing the loop
+        for result in results:
+            result.cancel()
+        pending = [c for c in connects if not c.done()]
+        for connect in pending:
+            connect.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.wait(pending))
+        for connect in connects:
+            if not connect.cancelled() and connect.exception() is None:
+                connect.result()[0].close()
+        loop.run_until_complete(asyncio.sleep(0))
+        return health
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def _connected(task, result):
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None and not result.done():
+        result.set_exception(error)
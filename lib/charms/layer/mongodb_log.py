@@ -0,0 +1,167 @@
+"""Counting events in the mongod log without rescanning it
+
+The inode and byte offset read up to are checkpointed in unit state, so
+every update-status only reads what was appended since. Large deltas are
+read through mmap rather than into one buffer. A new inode means the log
+was rotated by renaming it, the rest of the old file is then read from
+its rotated name first; a file shorter than the offset was truncated in
+place and is read from the start.
+
+Both the text log of MongoDB before 4.4 and the JSON log after it are
+understood. The counts of the last interval read are stored for the
+status message and the metrics textfile.
+"""
+import os
+import re
+import mmap
+import time
+import contextlib
+
+from collections import OrderedDict
+
+from charmhelpers.core import unitdata
+
+
+CHECKPOINT_KEY = 'mongodb.log.checkpoint'
+COUNTERS_KEY = 'mongodb.log.counters'
+ROTATED = '.1'
+# Deltas at least this large are read through mmap
+MMAP_THRESHOLD = 1024 ** 2
+# Most read in one run, the rest is left for the next
+MAX_READ = 256 * 1024 ** 2
+
+COUNTERS = ('lines', 'errors', 'warnings', 'slow_queries', 'elections',
+            'assertions', 'connections')
+# Severities of the text and JSON logs
+ERRORS = (b'E', b'F')
+WARNINGS = (b'W',)
+# Text log components reporting slow operations, which end in "<n>ms"
+SLOW_COMPONENTS = (b'COMMAND', b'QUERY', b'WRITE')
+SLOW_MS = re.compile(br'\d+ms$')
+
+JSON_FIELDS = re.compile(br'"s":"(\w+)",\s*"c":"(\w+)"')
+JSON_MSG = re.compile(br'"msg":"((?:[^"\\]|\\.)*)"')
+JSON_PRIMARY = b'"newState":"PRIMARY"'
+
+
+def new_counters():
+    return OrderedDict((k, 0) for k in COUNTERS)
+
+
+def _text(line):
+    parts = line.split(None, 4)
+    if len(parts) < 5 or len(parts[1]) != 1:
+        # Before 3.0 lines had no severity or component
+        return None, None, line
+    return parts[1], parts[2], parts[4]
+
+
+def _json(line):
+    fields = JSON_FIELDS.search(line)
+    msg = JSON_MSG.search(line)
+    return (fields.group(1) if fields else None,
+            fields.group(2) if fields else None,
+            msg.group(1) if msg else b'')
+
+
+def count(line, counters):
+    """Add what line of a text or JSON mongod log reports to counters"""
+    structured = line.startswith(b'{')
+    severity, component, msg = _json(line) if structured else _text(line)
+    counters['lines'] += 1
+    if severity in ERRORS:
+        counters['errors'] += 1
+    elif severity in WARNINGS:
+        counters['warnings'] += 1
+
+    if structured:
+        slow = msg == b'Slow query'
+        election = (msg == b'Replica set state transition' and
+                    JSON_PRIMARY in line)
+        assertion = component == b'ASSERT' or b'Assertion' in msg
+        connection = msg == b'Connection accepted'
+    else:
+        slow = (component in SLOW_COMPONENTS and
+                SLOW_MS.search(msg) is not None)
+        election = b'transition to PRIMARY' in msg
+        assertion = b'Assertion' in msg
+        connection = b'connection accepted' in msg
+    counters['slow_queries'] += slow
+    counters['elections'] += election
+    counters['assertions'] += assertion
+    counters['connections'] += connection
+
+
+def _count_lines(buf, pos, end, counters):
+    """Count the complete lines of buf[pos:end], returns where they stop"""
+    while pos < end:
+        nl = buf.find(b'\n', pos, end)
+        if nl < 0:
+            break
+        count(buf[pos:nl].rstrip(b'\r'), counters)
+        pos = nl + 1
+    return pos
+
+
+def _read(path, offset, counters, limit=MAX_READ):
+    """Count the lines of path from offset, returns the offset read to"""
+    with open(path, 'rb') as f:
+        end = min(os.fstat(f.fileno()).st_size, offset + limit)
+        if end <= offset:
+            return offset
+        if end - offset >= MMAP_THRESHOLD:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with contextlib.closing(m):
+                return _count_lines(m, offset, end, counters)
+        f.seek(offset)
+        buf = f.read(end - offset)
+        return offset + _count_lines(buf, 0, len(buf), counters)
+
+
+def scan(path, checkpoint=None, limit=MAX_READ):
+    """Counters of the lines appended to path since checkpoint
+
+    Returns them with the checkpoint to pass next time. Without a
+    checkpoint reading starts at the end, the history is not counted.
+    """
+    counters = new_counters()
+    checkpoint = checkpoint or {}
+    try:
+        st = os.stat(path)
+    except OSError:
+        return counters, checkpoint
+
+    inode, offset = checkpoint.get('inode'), checkpoint.get('offset', 0)
+    if inode is None:
+        offset = st.st_size
+    elif inode != st.st_ino:
+        try:
+            if os.stat(path + ROTATED).st_ino == inode:
+                _read(path + ROTATED, offset, counters, limit)
+        except OSError:
+            pass
+        offset = 0
+    elif st.st_size < offset:
+        offset = 0
+    offset = _read(path, offset, counters, limit)
+    return counters, {'inode': st.st_ino, 'offset': offset}
+
+
+def ingest(path):
+    """Count what was appended to path since the last call and store it"""
+    db = unitdata.kv()
+    now = time.time()
+    counters, checkpoint = scan(path, db.get(CHECKPOINT_KEY))
+    previous = db.get(COUNTERS_KEY) or {}
+    db.set(CHECKPOINT_KEY, checkpoint)
+    db.set(COUNTERS_KEY, {
+        'time': now,
+        'seconds': now - previous['time'] if previous else None,
+        'counters': counters,
+    })
+    return counters
+
+
+def stored():
+    """Counters of the last interval ingested"""
+    return (unitdata.kv().get(COUNTERS_KEY) or {}).get('counters', {})
@@ -0,0 +1,163 @@
+import os
+import time
+import datetime
+import subprocess
+
+from collections import OrderedDict
+
+from charmhelpers.core import unitdata
+
+
+SAMPLE_KEY = 'mongodb.metrics.sample'
+METRICS_KEY = 'mongodb.metrics'
+
+# serverStatus counters reported as per second rates between samples
+COUNTERS = OrderedDict([
+    ('opcounters_insert', ('opcounters', 'insert')),
+    ('opcounters_query', ('opcounters', 'query')),
+    ('opcounters_update', ('opcounters', 'update')),
+    ('opcounters_delete', ('opcounters', 'delete')),
+    ('opcounters_getmore', ('opcounters', 'getmore')),
+    ('opcounters_command', ('opcounters', 'command')),
+    ('page_faults', ('extra_info', 'page_faults')),
+])
+
+# serverStatus values reported as they are
+GAUGES = OrderedDict([
+    ('connections_current', ('connections', 'current')),
+    ('connections_available', ('connections', 'available')),
+    ('queue_readers', ('globalLock', 'currentQueue', 'readers')),
+    ('queue_writers', ('globalLock', 'currentQueue', 'writers')),
+    ('queue_total', ('globalLock', 'currentQueue', 'total')),
+])
+
+CACHE = ('wiredTiger', 'cache')
+CACHE_MAX = 'maximum bytes configured'
+CACHE_USED = 'bytes currently in the cache'
+CACHE_DIRTY = 'tracked dirty bytes in the cache'
+
+# Juju metric name, as declared in metrics.yaml: sampled metric
+JUJU_METRICS = OrderedDict([
+    ('ops-per-second', 'opcounters_total'),
+    ('connections', 'connections_current'),
+    ('queue-length', 'queue_total'),
+    ('page-faults-per-second', 'page_faults'),
+    ('cache-used-ratio', 'cache_used_ratio'),
+    ('cache-dirty-ratio', 'cache_dirty_ratio'),
+    ('replication-lag', 'replication_lag_seconds'),
+])
+
+PRIMARY = 1
+
+
+def _get(doc, path):
+    for k in path:
+        if not isinstance(doc, dict) or k not in doc:
+            return None
+        doc = doc[k]
+    return doc
+
+
+def replication_lag(rs_status):
+    """Seconds this member's optime trails the primary, None outside a set"""
+    if not rs_status or not rs_status.get('ok'):
+        return None
+    members = rs_status.get('members', [])
+    primary = [m for m in members if m.get('state') == PRIMARY]
+    me = [m for m in members if m.get('self')]
+    if not primary or not me:
+        return None
+    lag = primary[0]['optimeDate'] - me[0]['optimeDate']
+    if isinstance(lag, datetime.timedelta):
+        lag = lag.total_seconds()
+    return max(0.0, lag)
+
+
+def sample(server_status, rs_status=None):
+    """Counters and gauges of interest from serverStatus and rs.status"""
+    counters = {k: _get(server_status, p) for k, p in COUNTERS.items()}
+    gauges = {k: _get(server_status, p) for k, p in GAUGES.items()}
+
+    cache = _get(server_status, CACHE)
+    if cache and cache.get(CACHE_MAX):
+        gauges['cache_used_ratio'] = cache[CACHE_USED] / cache[CACHE_MAX]
+        gauges['cache_dirty_ratio'] = cache[CACHE_DIRTY] / cache[CACHE_MAX]
+    gauges['replication_lag_seconds'] = replication_lag(rs_status)
+
+    return {
+        'time': time.time(),
+        'counters': {k: v for k, v in counters.items() if v is not None},
+        'gauges': {k: v for k, v in gauges.items() if v is not None},
+    }
+
+
+def rates(previous, current):
+    """Per second rate of each counter between two samples
+
+    A counter going backwards means mongod restarted in between, in which
+    case nothing is reported for it.
+    """
+    if not previous:
+        return {}
+    elapsed = current['time'] - previous['time']
+    if elapsed <= 0:
+        return {}
+    result = {}
+    for k, v in current['counters'].items():
+        old = previous['counters'].get(k)
+        if old is not None and v >= old:
+            result[k] = (v - old) / elapsed
+    ops = [v for k, v in result.items() if k.startswith('opcounters_')]
+    if ops:
+        result['opcounters_total'] = sum(ops)
+    return result
+
+
+def collect(m):
+    """Sample the local server through m and store the result
+
+    Returns the metrics derived from this and the previous stored sample.
+    """
+    status = m.command({'serverStatus': 1})
+    rs_status = m.command({'replSetGetStatus': 1})
+    current = sample(status, rs_status)
+
+    db = unitdata.kv()
+    metrics = dict(current['gauges'])
+    metrics.update(rates(db.get(SAMPLE_KEY), current))
+    db.set(SAMPLE_KEY, current)
+    db.set(METRICS_KEY, metrics)
+    return metrics
+
+
+def stored():
+    """Metrics from the last collect(), for the collect-metrics hook"""
+    return unitdata.kv().get(METRICS_KEY) or {}
+
+
+def prometheus(metrics, prefix='mongodb_'):
+    """Render metrics in the Prometheus text exposition format"""
+    lines = []
+    for k in sorted(metrics):
+        lines.append('# TYPE {}{} gauge'.format(prefix, k))
+        lines.append('{}{} {}'.format(prefix, k, float(metrics[k])))
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path, metrics):
+    """Atomically replace path with metrics for a textfile collector"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(prometheus(metrics))
+    os.rename(tmp, path)
+
+
+def add_metrics(metrics):
+    """Hand stored metrics to Juju, only valid in the collect-metrics hook"""
+    values = ['{}={}'.format(name, metrics[k])
+              for name, k in JUJU_METRICS.items() if k in metrics]
+    if values:
+        subprocess.check_call(['add-metric'] + values)
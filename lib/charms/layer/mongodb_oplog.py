@@ -0,0 +1,83 @@
+"""Sizing the oplog to hold a target window of writes
+
+The oplog holds the writes from its first to its last entry in the bytes
+it uses, which gives the rate the set is written at without waiting for
+the oplog to fill. Rates are sampled on every update-status and the peak
+of the recent samples is what the oplog is sized for, so a quiet hour does
+not shrink it below what a busy one needs.
+"""
+import math
+import time
+
+from collections import namedtuple
+
+from charmhelpers.core import unitdata
+
+
+SAMPLES_KEY = 'mongodb.oplog.samples'
+# update-status runs every 5 minutes, this is a day of samples
+MAX_SAMPLES = 288
+# Samples needed before the oplog is resized automatically, an hour
+MIN_SAMPLES = 12
+MB = 1024 ** 2
+# Smallest oplog replSetResizeOplog accepts
+MIN_SIZE_MB = 990
+# Room for bursts above the sampled peak
+HEADROOM = 1.2
+# Sizes within this ratio of the current one are left alone
+TOLERANCE = 0.25
+
+
+class Oplog(namedtuple('Oplog', ['size', 'max_size', 'first', 'last'])):
+    @property
+    def window(self):
+        """Seconds of writes the oplog holds"""
+        return self.last[0] - self.first[0]
+
+    @property
+    def rate(self):
+        """Bytes written per second over the window, None if too short"""
+        return self.size / self.window if self.window > 0 else None
+
+
+def _end(conn, direction):
+    doc = conn.find_one('oplog.rs', 'local', sort={'$natural': direction},
+                        projection={'ts': 1})
+    return doc['ts'] if doc else None
+
+
+def stats(conn):
+    """Size and time span of the local oplog, None without one"""
+    r = conn.command({'collStats': 'oplog.rs'}, 'local')
+    if not r.get('ok'):
+        return None
+    first, last = _end(conn, 1), _end(conn, -1)
+    if first is None or last is None:
+        return None
+    return Oplog(r['size'], r['maxSize'], first, last)
+
+
+def sample(oplog):
+    """Store the write rate of oplog, returns the recent samples"""
+    db = unitdata.kv()
+    samples = db.get(SAMPLES_KEY) or []
+    if oplog.rate is not None:
+        samples = (samples + [[time.time(), oplog.rate]])[-MAX_SAMPLES:]
+        db.set(SAMPLES_KEY, samples)
+    return samples
+
+
+def recommend(samples, hours):
+    """Oplog size in MB holding hours of writes at the peak sampled rate"""
+    if not samples or not hours:
+        return None
+    peak = max(rate for _, rate in samples)
+    size = peak * hours * 3600 * HEADROOM / MB
+    return max(MIN_SIZE_MB, int(math.ceil(size)))
+
+
+def needs_resize(current_mb, recommended_mb):
+    """Whether recommended_mb is far enough from current_mb to resize"""
+    if recommended_mb is None:
+        return False
+    return abs(recommended_mb - current_mb) > current_mb * TOLERANCE
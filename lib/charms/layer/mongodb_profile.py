@@ -0,0 +1,154 @@
+"""Slow operations recorded by the database profiler, by query shape
+
+Operations are grouped by namespace, operation and the shape of their
+filter and sort, that is the documents with every value replaced by '?',
+so queries differing only in the values they look for add up. Shapes that
+examine far more documents than they return without using an index are
+the collection scans notablescan would refuse.
+"""
+import json
+import math
+
+from collections import OrderedDict
+
+
+PROFILE = 'system.profile'
+# Databases whose profile is never of interest
+SKIP_DATABASES = ('local', 'config')
+VALUE = '?'
+# Plan stages that read from an index
+INDEX_STAGES = ('IXSCAN', 'IDHACK', 'COUNT_SCAN', 'DISTINCT_SCAN',
+                'EXPRESS_IXSCAN', 'EXPRESS_CLUSTERED_IXSCAN')
+
+
+def normalize(value):
+    """value with every literal replaced, operators and fields are kept"""
+    if isinstance(value, dict):
+        return OrderedDict((k, normalize(value[k])) for k in sorted(value))
+    if isinstance(value, (list, tuple)):
+        # $in and $nin lists match the same shape whatever their length
+        if all(not isinstance(v, (dict, list, tuple)) for v in value):
+            return VALUE
+        return [normalize(v) for v in value]
+    return VALUE
+
+
+def _command(entry):
+    """Command document of an entry, whichever field the version used"""
+    if entry.get('op') == 'getmore' and entry.get('originatingCommand'):
+        return entry['originatingCommand']
+    return entry.get('command') or entry.get('query') or {}
+
+
+def shape(entry):
+    """Query shape of a profile entry as compact JSON"""
+    doc = _command(entry)
+    s = OrderedDict()
+    if entry.get('op') == 'command' and doc:
+        s['command'] = next(iter(doc))
+    for key in ('filter', 'q', 'query', '$query', 'pipeline'):
+        if key in doc:
+            s['pipeline' if key == 'pipeline' else 'filter'] = normalize(
+                doc[key])
+            break
+    else:
+        if entry.get('op') in ('query', 'update', 'remove') and doc:
+            # Legacy opcodes record the filter itself
+            s['filter'] = normalize(doc)
+    for key in ('sort', 'orderby', '$orderby'):
+        if key in doc:
+            # The sort order is part of the shape, not a value
+            s['sort'] = doc[key]
+            break
+    return json.dumps(s, separators=(',', ':'), default=str)
+
+
+def index_used(plan):
+    """Whether a planSummary reads an index, None if it was not recorded"""
+    if not plan:
+        return None
+    return any(stage in plan for stage in INDEX_STAGES)
+
+
+def percentile(values, p):
+    """Nearest rank percentile of values"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[max(int(math.ceil(p / 100.0 * len(ordered))) - 1, 0)]
+
+
+def _first(entry, keys):
+    for k in keys:
+        if entry.get(k) is not None:
+            return entry[k]
+    return 0
+
+
+def aggregate(entries, top=10):
+    """Statistics of the top shapes by time spent, slowest first"""
+    shapes = OrderedDict()
+    for e in entries:
+        key = (e.get('ns', ''), e.get('op', ''), shape(e))
+        s = shapes.setdefault(key, {'millis': [], 'examined': 0,
+                                    'returned': 0, 'plans': set()})
+        s['millis'].append(e.get('millis', 0))
+        s['examined'] += _first(e, ('docsExamined', 'nscannedObjects',
+                                    'nscanned'))
+        s['returned'] += _first(e, ('nreturned', 'nModified', 'ndeleted'))
+        if e.get('planSummary'):
+            s['plans'].add(e['planSummary'])
+
+    rows = []
+    for (ns, op, query), s in shapes.items():
+        used = [index_used(p) for p in sorted(s['plans'])]
+        rows.append(OrderedDict([
+            ('ns', ns),
+            ('op', op),
+            ('shape', query),
+            ('count', len(s['millis'])),
+            ('total_ms', sum(s['millis'])),
+            ('p50_ms', percentile(s['millis'], 50)),
+            ('p99_ms', percentile(s['millis'], 99)),
+            ('docs_examined', s['examined']),
+            ('docs_returned', s['returned']),
+            ('index', all(used) if used else None),
+            ('plan', ', '.join(sorted(s['plans']))),
+        ]))
+    rows.sort(key=lambda r: (-r['total_ms'], -r['count']))
+    return rows[:top] if top else rows
+
+
+def entries(conn, databases=None, limit=1000):
+    """The newest limit profile entries of each database
+
+    Reads with the find command, available from MongoDB 3.2.
+    """
+    if not databases:
+        r = conn.command(OrderedDict([('listDatabases', 1),
+                                      ('nameOnly', True)]))
+        databases = [d['name'] for d in r.get('databases', [])
+                     if d['name'] not in SKIP_DATABASES]
+    found = []
+    for db in databases:
+        r = conn.command(OrderedDict([
+            ('find', PROFILE),
+            ('sort', {'$natural': -1}),
+            ('limit', limit),
+            ('singleBatch', True),
+        ]), db)
+        if not r.get('ok'):
+            raise IOError('Unable to read {}.{}: {}'.format(
+                db, PROFILE, r.get('errmsg')))
+        found += r['cursor']['firstBatch']
+    return found
+
+
+def results(rows):
+    """Action results for rows, keyed shape-1 onwards"""
+    out = OrderedDict()
+    for i, row in enumerate(rows, 1):
+        out['shape-{}'.format(i)] = OrderedDict(
+            (k.replace('_', '-'), 'unknown' if v is None else str(v))
+            for k, v in row.items())
+    return out
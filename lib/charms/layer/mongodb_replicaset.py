@@ -0,0 +1,278 @@
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+import yaml
+
+from charmhelpers.core import hookenv
+
+
+RELATION = 'replica-set'
+
+# Limits of a replica set, beyond these mongod rejects the config
+MAX_MEMBERS = 50
+MAX_VOTING_MEMBERS = 7
+
+# replSetGetConfig error code before replSetInitiate
+NOT_YET_INITIALIZED = 94
+
+# Connections each member is expected to serve, split between the client
+# units of a relation to suggest their maxPoolSize
+CONNECTIONS_PER_MEMBER = 1000
+MIN_POOL_SIZE = 5
+MAX_POOL_SIZE = 100
+
+# Roles member_roles gives units, the others are ordinary members
+ANALYTICS = 'analytics'
+HIDDEN = 'hidden'
+DELAYED = 'delayed'
+ROLES = (ANALYTICS, HIDDEN, DELAYED)
+# Roles never voting, so they cannot hold up elections or majority writes
+NON_VOTING = (ANALYTICS, DELAYED)
+# Tag telling analytics members from those serving applications, once a
+# set has analytics members
+NODE_TYPE = 'nodeType'
+NODE_TYPES = {ANALYTICS: 'ANALYTICS', None: 'ELECTABLE'}
+# Member setting of the seconds a delayed member trails by
+DELAY_FIELD = 'slaveDelay'
+
+
+def _unit_number(unit):
+    return int(unit.split('/')[-1])
+
+
+def _units(local):
+    units = {hookenv.local_unit(): local}
+    for rid in hookenv.relation_ids(RELATION):
+        for unit in hookenv.related_units(rid):
+            member = hookenv.relation_get('member', unit, rid)
+            if member:
+                units[unit] = member
+    return units
+
+
+def versions(version):
+    """Server version of this unit and of every peer, None if unpublished"""
+    found = {hookenv.local_unit(): version}
+    for rid in hookenv.relation_ids(RELATION):
+        for unit in hookenv.related_units(rid):
+            found[unit] = hookenv.relation_get('version', unit, rid)
+    return found
+
+
+def members(local):
+    """host:port of this unit and of every peer that published one
+
+    Units are ordered oldest first so votes go to long standing members.
+    """
+    units = _units(local)
+    return [units[u] for u in sorted(units, key=_unit_number)]
+
+
+def parse_roles(text):
+    """Role of each unit number from the member_roles option
+
+    member_roles is YAML mapping units to a role, or to a role with the
+    seconds a delayed member trails by and tags for read preferences:
+
+        mongodb/3: analytics
+        mongodb/4: {role: delayed, delay: 3600}
+        mongodb/5: {tags: {dc: east}}
+
+    Raises ValueError when it is not valid.
+    """
+    try:
+        spec = yaml.safe_load(text or '') or {}
+    except yaml.YAMLError as e:
+        raise ValueError('member_roles is not valid YAML: {}'.format(e))
+    if not isinstance(spec, dict):
+        raise ValueError('member_roles must map units to roles')
+
+    roles = {}
+    for unit, value in spec.items():
+        if not isinstance(value, dict):
+            value = {'role': value}
+        role = value.get('role')
+        if role is not None and role not in ROLES:
+            raise ValueError('{} is not a valid member role, use one of {}'
+                             .format(role, ', '.join(ROLES)))
+        delay = int(value.get('delay') or 0)
+        if (role == DELAYED) != (delay > 0):
+            raise ValueError('{}: delayed members and only those need a '
+                             'delay in seconds'.format(unit))
+        tags = value.get('tags') or {}
+        if not isinstance(tags, dict):
+            raise ValueError('{}: tags must map names to values'.format(unit))
+        roles[_unit_number(str(unit))] = OrderedDict([
+            ('role', role),
+            ('delay', delay),
+            ('tags', OrderedDict((str(k), str(tags[k])) for k in
+                                 sorted(tags))),
+        ])
+    return roles
+
+
+def roles(local, spec):
+    """Roles from parse_roles keyed by the host:port of each member"""
+    if not spec:
+        return {}
+    return {host: spec[_unit_number(unit)]
+            for unit, host in _units(local).items()
+            if _unit_number(unit) in spec}
+
+
+def voters(count):
+    """Voting members for a set of count members, always an odd number"""
+    n = min(count, MAX_VOTING_MEMBERS)
+    if n and not n % 2:
+        n -= 1
+    return n
+
+
+def _role(roles, m):
+    return (roles.get(m['host']) or {}).get('role')
+
+
+def _assign_role(m, role, tagged):
+    """Set the member settings of role, reverting those of a former one"""
+    role = role or {}
+    kind = role.get('role')
+    hidden = kind in (HIDDEN, DELAYED)
+    if kind:
+        m['priority'] = 0
+    elif m.get('hidden') and m['votes']:
+        # Hidden members had priority 0 only because they were hidden
+        m['priority'] = 1
+    if hidden or 'hidden' in m:
+        m['hidden'] = hidden
+    if role.get('delay') or DELAY_FIELD in m:
+        m[DELAY_FIELD] = role.get('delay', 0)
+    tags = OrderedDict(role.get('tags', {}))
+    if tagged and not hidden:
+        tags[NODE_TYPE] = NODE_TYPES[kind]
+    if tags or 'tags' in m:
+        m['tags'] = tags
+
+
+def plan(name, hosts, current=None, primary=None, configsvr=False,
+         roles=None):
+    """Replica set config with exactly hosts as members, None if unchanged
+
+    Members already in current keep their _id and settings and new ones
+    get fresh ids, so a single reconfig adds and removes any number of
+    hosts. Members voting today, the primary first, keep their vote so the
+    reconfig does not cause an election. Remaining votes go to the other
+    members in order; the rest join with no vote and priority 0. A set
+    initiated with configsvr holds the config of a sharded cluster.
+
+    roles, from roles(), makes members hidden, delayed by slaveDelay
+    seconds or analytics members, all with priority 0. Analytics and
+    delayed members never vote.
+    """
+    if len(hosts) > MAX_MEMBERS:
+        raise ValueError('A replica set has at most {} members, got {}'
+                         .format(MAX_MEMBERS, len(hosts)))
+
+    existing = OrderedDict()
+    for m in (current or {}).get('members', []):
+        existing[m['host']] = m
+    next_id = max([m['_id'] for m in existing.values()] + [-1]) + 1
+
+    new = []
+    for host in hosts:
+        if host in existing:
+            new.append(dict(existing[host]))
+        else:
+            new.append(OrderedDict([('_id', next_id), ('host', host)]))
+            next_id += 1
+
+    def rank(m):
+        old = existing.get(m['host'])
+        if m['host'] == primary:
+            return 0
+        return 1 if old and old.get('votes', 1) else 2
+
+    roles = roles or {}
+    eligible = [m for m in new if _role(roles, m) not in NON_VOTING]
+    if new and not eligible:
+        raise ValueError('A replica set needs a member that votes')
+    count = voters(len(eligible))
+    for i, m in enumerate(sorted(eligible, key=rank) +
+                          [m for m in new if m not in eligible]):
+        if i < count:
+            old = existing.get(m['host'])
+            m['votes'] = 1
+            m['priority'] = m.get('priority', 1) if old and rank(m) < 2 else 1
+        else:
+            m['votes'] = 0
+            m['priority'] = 0
+
+    tagged = any(_role(roles, m) == ANALYTICS for m in new)
+    for m in new:
+        _assign_role(m, roles.get(m['host']), tagged)
+
+    new.sort(key=lambda m: m['_id'])
+    if current and new == sorted(current['members'], key=lambda m: m['_id']):
+        return None
+
+    cfg = OrderedDict([('_id', name), ('version', 1)])
+    if configsvr:
+        cfg['configsvr'] = True
+    if current:
+        cfg.update(current)
+        cfg['version'] = current['version'] + 1
+    cfg['members'] = new
+    return cfg
+
+
+def client_settings(hosts, replset=None, clients=1, roles=None):
+    """Relation settings telling clients how to connect to hosts
+
+    The seed list names every member so drivers fail over and spread
+    reads. With three or more members reads prefer secondaries, and writes
+    wait for a majority whenever there is a replica set. maxPoolSize
+    shares the connections all members can take between the client units.
+
+    Hidden and delayed members in roles are left out. Analytics members
+    only get the reads of analytics_uri, which targets them by tag.
+    """
+    roles = roles or {}
+    kinds = {h: (roles.get(h) or {}).get('role') for h in hosts}
+    serving = [h for h in hosts if kinds[h] is None]
+    analytics = [h for h in hosts if kinds[h] == ANALYTICS]
+    seeds = ','.join(serving + analytics)
+
+    read_preference = 'primary'
+    if len(serving) >= 3:
+        read_preference = 'secondaryPreferred'
+    elif len(serving) == 2:
+        read_preference = 'primaryPreferred'
+    write_concern = 'majority' if replset or len(hosts) > 1 else '1'
+    pool = CONNECTIONS_PER_MEMBER * len(serving) // max(clients, 1)
+    pool = max(MIN_POOL_SIZE, min(MAX_POOL_SIZE, pool))
+
+    options = []
+    if replset:
+        options.append(('replicaSet', replset))
+    options.append(('readPreference', read_preference))
+    if analytics and read_preference != 'primary':
+        options.append(('readPreferenceTags', '{}:{}'.format(
+            NODE_TYPE, NODE_TYPES[None])))
+    tail = [('w', write_concern), ('maxPoolSize', pool)]
+
+    analytics_uri = ''
+    if analytics:
+        analytics_uri = 'mongodb://{}/?{}'.format(seeds, urlencode(
+            options[:1 if replset else 0] + [
+                ('readPreference', 'secondary'),
+                ('readPreferenceTags', '{}:{}'.format(
+                    NODE_TYPE, NODE_TYPES[ANALYTICS]))] + tail))
+
+    return OrderedDict([
+        ('hosts', seeds),
+        ('replset', replset or ''),
+        ('read_preference', read_preference),
+        ('write_concern', write_concern),
+        ('max_pool_size', pool),
+        ('uri', 'mongodb://{}/?{}'.format(seeds, urlencode(options + tail))),
+        ('analytics_uri', analytics_uri),
+    ])
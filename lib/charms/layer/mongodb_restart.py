@@ -0,0 +1,157 @@
+"""Restarting replica set members one at a time, never as primary
+
+Units wanting to restart mongod ask for a turn on the peer relation and
+the leader hands turns out one unit at a time through leadership
+settings. In its turn a primary waits for a secondary to be within a few
+seconds of its oplog and steps down before restarting, so clients only
+see an election they were told about instead of waiting out the election
+timeout. The turn is held until the member is back as a secondary.
+Each hook waits only briefly for either, a later hook checks again.
+"""
+import time
+
+from collections import OrderedDict
+
+from charmhelpers.core import hookenv
+
+from charms.layer import mongodb_backup
+from charms.layer import mongodb_client
+from charms.layer import mongodb_replicaset
+
+
+# Peer relation setting of a unit waiting for a turn, when it asked
+REQUEST = 'restart-requested'
+# Leadership setting naming the unit whose turn it is
+TURN = 'restart-turn'
+# Seconds a stepped down primary cannot be elected again
+STEP_DOWN_SECONDS = 60
+POLL_SECONDS = 1.0
+# replSetGetStatus myState of a member serving reads again
+SERVING = (mongodb_backup.PRIMARY, mongodb_backup.SECONDARY)
+
+
+def _relation_id():
+    rids = hookenv.relation_ids(mongodb_replicaset.RELATION)
+    return rids[0] if rids else None
+
+
+def requests():
+    """When each unit waiting for a turn asked for it"""
+    rid = _relation_id()
+    if rid is None:
+        return {}
+    found = {}
+    for unit in [hookenv.local_unit()] + hookenv.related_units(rid):
+        requested = hookenv.relation_get(REQUEST, unit, rid)
+        if requested:
+            found[unit] = float(requested)
+    return found
+
+
+def grant():
+    """Give the turn to the longest waiting unit, leader only
+
+    The unit holding the turn keeps it until it stops waiting.
+    """
+    waiting = requests()
+    holder = hookenv.leader_get(TURN)
+    if holder in waiting:
+        return holder
+    turn = min(waiting, key=lambda u: (waiting[u], u)) if waiting else None
+    if turn != holder:
+        hookenv.leader_set({TURN: turn})
+    return turn
+
+
+def take_turn(leader):
+    """Ask for a turn, whether this unit has it"""
+    rid = _relation_id()
+    if rid is None:
+        # Without peers there is nobody to take turns with
+        return True
+    if not hookenv.relation_get(REQUEST, hookenv.local_unit(), rid):
+        hookenv.relation_set(rid, {REQUEST: time.time()})
+    if leader:
+        grant()
+    return hookenv.leader_get(TURN) == hookenv.local_unit()
+
+
+def release(leader):
+    """Stop waiting for or holding a turn"""
+    rid = _relation_id()
+    if rid is not None:
+        hookenv.relation_set(rid, {REQUEST: None})
+    if leader:
+        grant()
+
+
+def _lag(status):
+    """Seconds the most caught up healthy secondary trails the primary"""
+    members = status.get('members', [])
+    primary = [m for m in members if m.get('state') == mongodb_backup.PRIMARY]
+    secondaries = [mongodb_backup.optime(m)[0] for m in members
+                   if m.get('state') == mongodb_backup.SECONDARY and
+                   m.get('health', 1)]
+    if not primary or not secondaries:
+        return None
+    return max(0, mongodb_backup.optime(primary[0])[0] - max(secondaries))
+
+
+def step_down(conn, max_lag, timeout):
+    """Hand the primary role over once a secondary is within max_lag
+
+    Returns False without stepping down when conn is not to the primary
+    or there is no secondary to take over. Raises IOError when none is
+    within max_lag seconds after timeout seconds.
+    """
+    if not conn.command({'isMaster': 1}).get('ismaster'):
+        return False
+    deadline = time.monotonic() + timeout
+    while True:
+        lag = _lag(conn.command({'replSetGetStatus': 1}))
+        if lag is None:
+            return False
+        if lag <= max_lag:
+            break
+        if time.monotonic() > deadline:
+            raise IOError('no secondary within {}s of the primary, the '
+                          'closest is {}s behind'.format(max_lag, lag))
+        time.sleep(POLL_SECONDS)
+
+    try:
+        r = conn.command(OrderedDict([
+            ('replSetStepDown', STEP_DOWN_SECONDS),
+            ('secondaryCatchUpPeriodSecs', max(int(max_lag), 1)),
+        ]))
+    except mongodb_client.ConnectionFailure as e:
+        # Before 4.2 stepping down closes every connection, the command
+        # is then retried against a member that is no longer primary
+        r = {'errmsg': str(e)}
+    if not r.get('ok') and conn.command({'isMaster': 1}).get('ismaster'):
+        raise IOError('Unable to step down: {}'.format(r.get('errmsg')))
+    return True
+
+
+def wait_serving(host, port, timeout):
+    """Wait for a restarted member to be a primary or secondary again
+
+    Raises IOError when it is not after timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    reason = None
+    while True:
+        try:
+            r = mongodb_client.connection(host, port).command(
+                {'replSetGetStatus': 1})
+            if r.get('code') == mongodb_replicaset.NOT_YET_INITIALIZED:
+                # Not a member yet, there is nothing to rejoin
+                return
+            if r.get('myState') in SERVING:
+                return
+            reason = 'state {}'.format(r.get('myState', r.get('errmsg')))
+        except IOError as e:
+            reason = str(e)
+        if time.monotonic() > deadline:
+            raise IOError('not serving after {}s: {}'.format(
+                timeout, reason))
+        time.sleep(POLL_SECONDS)
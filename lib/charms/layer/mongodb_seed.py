@@ -0,0 +1,145 @@
+"""Seeding new replica set members from a file level snapshot
+
+A snapshot is a gzipped tar of a secondary's dbpath taken while it is
+fsyncLocked, next to a JSON file recording the replica set and the optime
+the copy holds. A joining member restored from it only has to replay the
+oplog written since, instead of an initial sync copying every document
+from the primary. That only works while the primary's oplog still goes
+back to the snapshot, which is checked before a snapshot is used.
+"""
+import os
+import json
+import time
+import shutil
+import subprocess
+
+from collections import OrderedDict
+
+from charms.layer import mongodb_backup
+from charms.layer import mongodb_client
+
+
+SUFFIX = '.tar.gz'
+META_SUFFIX = '.json'
+SNAPSHOT = 'snapshot'
+# Replaying must start this many seconds before the oldest oplog entry
+# would roll off, to allow for the restore and the start of mongod
+HEADROOM = 3600
+PRE_SEED = '.pre-seed'
+LOCK_FILE = 'mongod.lock'
+OWNER = 'mongodb:mongodb'
+# fsyncUnlock calls made at most to release stacked locks
+MAX_UNLOCKS = 10
+
+
+class StaleSnapshot(Exception):
+    pass
+
+
+def metadata(snapshot):
+    """The replica set and optime recorded with a snapshot"""
+    with open(snapshot + META_SUFFIX) as f:
+        return json.load(f)
+
+
+def oplog_start(conn):
+    """Timestamp of the oldest entry in a member's oplog"""
+    doc = conn.find_one('oplog.rs', 'local', sort={'$natural': 1},
+                        projection={'ts': 1})
+    if not doc:
+        raise IOError('Unable to read the oplog: it is empty')
+    return doc['ts']
+
+
+def check(meta, replset, start, headroom=HEADROOM):
+    """Raise StaleSnapshot unless the oplog from start covers meta"""
+    if meta.get('replset') != replset:
+        raise StaleSnapshot('snapshot is of replica set {}, not {}'.format(
+            meta.get('replset'), replset))
+    taken = meta['optime'][0]
+    if taken - start[0] < headroom:
+        raise StaleSnapshot(
+            'snapshot optime {} is not {}s newer than the oplog start {}'
+            .format(_utc(taken), headroom, _utc(start[0])))
+
+
+def _utc(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def _unlock_once(conn):
+    if conn.max_wire_version < mongodb_client.FIND_WIRE_VERSION:
+        # fsyncUnlock is a command from 3.2, before it a query unlocks
+        return conn.find_one('$cmd.sys.unlock', 'admin') or {}
+    return conn.command({'fsyncUnlock': 1})
+
+
+def unlock(conn):
+    """Release the fsync lock until none is held, each lock counts once"""
+    for _ in range(MAX_UNLOCKS):
+        r = _unlock_once(conn)
+        if not r.get('ok') or not r.get('lockCount'):
+            return
+
+
+def take(conn, dbpath, directory):
+    """Snapshot dbpath of the secondary conn is connected to
+
+    Writes are held with fsyncLock for as long as the copy takes, so the
+    files are consistent; the secondary catches up once unlocked.
+    """
+    status = conn.command({'replSetGetStatus': 1})
+    me = [m for m in status.get('members', []) if m.get('self')]
+    if not me or me[0].get('state') != mongodb_backup.SECONDARY:
+        raise IOError('Snapshots are only taken on a secondary')
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, '{}-{}{}'.format(
+        SNAPSHOT, time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), SUFFIX))
+    partial = path + mongodb_backup.PARTIAL
+
+    try:
+        r = conn.command(OrderedDict([('fsync', 1), ('lock', True)]))
+    except IOError:
+        # The lock may have been taken with only the reply lost
+        unlock(conn)
+        raise
+    if not r.get('ok'):
+        raise IOError('Unable to fsyncLock: {}'.format(r.get('errmsg')))
+    try:
+        # Nothing is applied while locked, so this is the optime copied
+        status = conn.command({'replSetGetStatus': 1})
+        member = [m for m in status['members'] if m.get('self')][0]
+        subprocess.check_call(['tar', '-czf', partial, '-C', dbpath,
+                               '--exclude', LOCK_FILE, '.'])
+    finally:
+        unlock(conn)
+
+    with open(path + META_SUFFIX, 'w') as f:
+        json.dump(OrderedDict([
+            ('replset', status['set']),
+            ('optime', list(mongodb_backup.optime(member))),
+            ('taken', _utc(time.time())),
+        ]), f)
+    os.rename(partial, path)
+    return path
+
+
+def restore(snapshot, dbpath):
+    """Replace the contents of dbpath with snapshot, mongod must be stopped
+
+    Whatever dbpath held is moved aside rather than deleted.
+    """
+    if not os.path.isdir(dbpath):
+        os.makedirs(dbpath)
+    entries = os.listdir(dbpath)
+    if entries:
+        # dbpath itself may be a mount point, so only its entries move
+        aside = '{}{}-{}'.format(dbpath.rstrip('/'), PRE_SEED,
+                                 int(time.time()))
+        os.makedirs(aside)
+        for name in entries:
+            shutil.move(os.path.join(dbpath, name), aside)
+    subprocess.check_call(['tar', '-xzf', snapshot, '-C', dbpath])
+    subprocess.check_call(['chown', '-R', OWNER, dbpath])
@@ -0,0 +1,64 @@
+from collections import OrderedDict
+
+from charmhelpers.core import hookenv
+
+
+# Relations a sharded cluster is wired with. Config servers and shards
+# provide theirs, mongos routers require both.
+CONFIGSVR = 'configsvr'
+SHARD = 'shard'
+CONFIG_SERVER = 'config-server'
+SHARDS = 'shards'
+
+# The relation each member role publishes its replica set on
+ROLE_RELATIONS = {
+    'configsvr': CONFIGSVR,
+    'shardsvr': SHARD,
+}
+
+
+def replica_sets(relation):
+    """Members published on relation, as {replica set name: [host:port]}"""
+    sets = {}
+    for rid in hookenv.relation_ids(relation):
+        for unit in hookenv.related_units(rid):
+            data = hookenv.relation_get(unit=unit, rid=rid) or {}
+            if data.get('replset') and data.get('member'):
+                sets.setdefault(data['replset'], set()).add(data['member'])
+    return {name: sorted(members) for name, members in sets.items()}
+
+
+def seed(name, members):
+    """Replica set connection string as mongos and addShard expect it"""
+    return '{}/{}'.format(name, ','.join(members))
+
+
+def config_db():
+    """sharding.configDB for mongos, None without exactly one config set"""
+    sets = replica_sets(CONFIG_SERVER)
+    if len(sets) != 1:
+        return None
+    return seed(*sets.popitem())
+
+
+def add_shards(m, shards):
+    """Register the replica sets in shards the cluster does not know yet
+
+    m is the local mongos; returns the names of the shards added.
+    """
+    r = m.command({'listShards': 1})
+    if not r.get('ok'):
+        raise IOError('Unable to list shards: {}'.format(r.get('errmsg')))
+    known = set(s['_id'] for s in r.get('shards', []))
+
+    added = []
+    for name, members in sorted(shards.items()):
+        if name in known:
+            continue
+        r = m.command(OrderedDict([('addShard', seed(name, members)),
+                                   ('name', name)]))
+        if not r.get('ok'):
+            raise IOError('Unable to add shard {}: {}'.format(
+                name, r.get('errmsg')))
+        added.append(name)
+    return added
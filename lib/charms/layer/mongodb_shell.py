@@ -0,0 +1,294 @@
+import re
+import json
+import base64
+import binascii
+import datetime
+import decimal
+
+from json.decoder import scanstring
+from json.scanner import NUMBER_RE
+
+from charms.layer import mongodb_bson as bson
+
+
+_WS = re.compile(r'[ \t\n\r]*')
+_NAME = re.compile(r'[A-Za-z_$][A-Za-z0-9_$]*')
+_ISODATE = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)'
+                      r'(?:\.(\d{1,6})\d*)?(?:Z|([+-])(\d\d):?(\d\d))?$')
+
+_LITERALS = {
+    'true': True,
+    'false': False,
+    'null': None,
+    'undefined': None,
+    'MinKey': None,
+    'MaxKey': None,
+    'NaN': float('nan'),
+    'Infinity': float('inf'),
+}
+
+
+def isodate(s):
+    """Parse the ISO-8601 string printed by the shell as an aware datetime"""
+    if len(s) in (20, 24) and s[-1] == 'Z' and s[10] == 'T':
+        # The shell always prints UTC, with or without milliseconds
+        try:
+            return datetime.datetime(
+                int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]),
+                int(s[14:16]), int(s[17:19]),
+                int(s[20:23]) * 1000 if len(s) == 24 else 0,
+                datetime.timezone.utc)
+        except ValueError:
+            pass
+    m = _ISODATE.match(s)
+    if not m:
+        raise ValueError('{!r} is not an ISODate'.format(s))
+    y, mo, d, h, mi, sec, frac, sign, oh, om = m.groups()
+    offset = datetime.timedelta(0)
+    if sign:
+        offset = datetime.timedelta(hours=int(oh), minutes=int(om))
+        if sign == '-':
+            offset = -offset
+    micro = int((frac or '0').ljust(6, '0'))
+    return datetime.datetime(int(y), int(mo), int(d), int(h), int(mi),
+                             int(sec), micro,
+                             datetime.timezone(offset)).astimezone(
+                                 datetime.timezone.utc)
+
+
+def _date(value=None):
+    if isinstance(value, str):
+        return isodate(value)
+    return bson.from_millis(value or 0)
+
+
+def _uuid(s):
+    return bson.Binary(4, binascii.unhexlify(s.replace('-', '')))
+
+
+_CONSTRUCTORS = {
+    'ISODate': _date,
+    'Date': _date,
+    'Timestamp': bson.Timestamp,
+    'NumberLong': int,
+    'NumberInt': int,
+    'NumberDecimal': decimal.Decimal,
+    'ObjectId': bson.ObjectId,
+    'BinData': lambda t, d: bson.Binary(t, base64.b64decode(d)),
+    'UUID': _uuid,
+}
+
+
+class DecodeError(ValueError):
+    """Shell output that does not parse, pos is where in doc it stopped
+
+    json.JSONDecodeError records the same but is new in Python 3.5.
+    """
+
+    def __init__(self, msg, doc, pos):
+        lineno = doc.count('\n', 0, pos) + 1
+        colno = pos - doc.rfind('\n', 0, pos)
+        super(DecodeError, self).__init__(
+            '{}: line {} column {} (char {})'.format(msg, lineno, colno, pos))
+        self.msg = msg
+        self.doc = doc
+        self.pos = pos
+        self.lineno = lineno
+        self.colno = colno
+
+
+def _error(msg, s, pos):
+    return DecodeError(msg, s, pos)
+
+
+def _string(s, pos):
+    try:
+        return scanstring(s, pos)
+    except ValueError as e:
+        # Only a json.JSONDecodeError from Python 3.5 knows where it stopped
+        raise _error(getattr(e, 'msg', str(e)), s, getattr(e, 'pos', pos))
+
+
+def _skip(s, pos):
+    return _WS.match(s, pos).end()
+
+
+def _value(s, pos):
+    pos = _skip(s, pos)
+    try:
+        c = s[pos]
+    except IndexError:
+        raise _error('Expecting value', s, pos)
+
+    if c == '"':
+        return _string(s, pos + 1)
+    if c == '{':
+        return _object(s, pos + 1)
+    if c == '[':
+        return _array(s, pos + 1)
+    if c == '-' and s.startswith('-Infinity', pos):
+        return float('-inf'), pos + 9
+
+    if c in '-0123456789':
+        m = NUMBER_RE.match(s, pos)
+        if not m:
+            raise _error('Expecting value', s, pos)
+        integer, frac, exp = m.groups()
+        if frac or exp:
+            return float(integer + (frac or '') + (exp or '')), m.end()
+        return int(integer), m.end()
+
+    m = _NAME.match(s, pos)
+    if not m:
+        raise _error('Expecting value', s, pos)
+    name, pos = m.group(), m.end()
+    if name in _LITERALS:
+        return _LITERALS[name], pos
+    if name == 'new':
+        m = _NAME.match(s, _skip(s, pos))
+        if not m:
+            raise _error('Expecting constructor', s, pos)
+        name, pos = m.group(), m.end()
+    if name not in _CONSTRUCTORS:
+        raise _error('Unknown constructor {}'.format(name), s, pos)
+
+    args, end = _arguments(s, pos)
+    try:
+        return _CONSTRUCTORS[name](*args), end
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise _error('Invalid {}: {}'.format(name, e), s, pos)
+
+
+def _arguments(s, pos):
+    pos = _skip(s, pos)
+    if s[pos:pos + 1] != '(':
+        raise _error("Expecting '('", s, pos)
+    args = []
+    pos = _skip(s, pos + 1)
+    if s[pos:pos + 1] == ')':
+        return args, pos + 1
+    while True:
+        value, pos = _value(s, pos)
+        args.append(value)
+        pos = _skip(s, pos)
+        c = s[pos:pos + 1]
+        if c == ')':
+            return args, pos + 1
+        if c != ',':
+            raise _error("Expecting ',' or ')'", s, pos)
+        pos += 1
+
+
+def _object(s, pos):
+    obj = {}
+    pos = _skip(s, pos)
+    if s[pos:pos + 1] == '}':
+        return obj, pos + 1
+    while True:
+        pos = _skip(s, pos)
+        if s[pos:pos + 1] == '"':
+            key, pos = _string(s, pos + 1)
+        else:
+            m = _NAME.match(s, pos)
+            if not m:
+                raise _error('Expecting property name', s, pos)
+            key, pos = m.group(), m.end()
+        pos = _skip(s, pos)
+        if s[pos:pos + 1] != ':':
+            raise _error("Expecting ':' delimiter", s, pos)
+        obj[key], pos = _value(s, pos + 1)
+        pos = _skip(s, pos)
+        c = s[pos:pos + 1]
+        if c == '}':
+            return obj, pos + 1
+        if c != ',':
+            raise _error("Expecting ',' delimiter", s, pos)
+        pos += 1
+
+
+def _array(s, pos):
+    arr = []
+    pos = _skip(s, pos)
+    if s[pos:pos + 1] == ']':
+        return arr, pos + 1
+    while True:
+        value, pos = _value(s, pos)
+        arr.append(value)
+        pos = _skip(s, pos)
+        c = s[pos:pos + 1]
+        if c == ']':
+            return arr, pos + 1
+        if c != ',':
+            raise _error("Expecting ',' delimiter", s, pos)
+        pos += 1
+
+
+_HELPER = re.compile(r'([A-Z][A-Za-z]*)\(((?:[^()"]|"[^"]*")*)\)')
+_TAG = '$$shell'
+
+
+def _tagged(d):
+    if len(d) == 1 and _TAG in d:
+        name, args = d[_TAG]
+        try:
+            return _CONSTRUCTORS[name](*args)
+        except (TypeError, ValueError, binascii.Error) as e:
+            raise ValueError('Invalid {}: {}'.format(name, e))
+    return d
+
+
+def _rewrite(s):
+    """Turn shell helpers outside of strings into tagged JSON objects
+
+    Only valid while no string in s contains an escaped quote, which is
+    checked by the caller.
+    """
+    pieces = []
+    emitted = scanned = 0
+    in_string = False
+    template = '{"' + _TAG + '": ["%s", [%s]]}'
+    for m in _HELPER.finditer(s):
+        start, end = m.span()
+        if s.count('"', scanned, start) % 2:
+            in_string = not in_string
+        scanned = start
+        name, args = m.groups()
+        if in_string or name not in _CONSTRUCTORS:
+            continue
+        pieces.append(s[emitted:start])
+        pieces.append(template % (name, args))
+        emitted = scanned = end
+    if not pieces:
+        return s
+    pieces.append(s[emitted:])
+    return ''.join(pieces)
+
+
+def _decode(s):
+    value, pos = _value(s, 0)
+    pos = _skip(s, pos)
+    if pos != len(s):
+        raise _error('Extra data', s, pos)
+    return value
+
+
+def loads(s):
+    """Decode mongo shell output into Python objects
+
+    Shell helpers are turned into typed values: ISODate and Date become
+    aware datetimes, Timestamp, ObjectId and BinData the matching
+    mongodb_bson types, NumberLong and NumberInt ints and NumberDecimal a
+    Decimal.
+
+    Output without backslash escapes, which is nearly all server output,
+    has its helpers rewritten in one regex pass and is then parsed by the C
+    json decoder. Anything else goes through the exact single pass parser.
+    """
+    if isinstance(s, (bytes, bytearray)):
+        s = s.decode('utf-8', 'replace')
+    if '\\' not in s:
+        try:
+            return json.loads(_rewrite(s), object_hook=_tagged)
+        except ValueError:
+            pass
+    return _decode(s)
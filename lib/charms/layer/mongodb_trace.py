@@ -0,0 +1,133 @@
+"""Timing spans of hooks and of the external commands they run
+
+Every span is appended to SPANS_FILE as one JSON object per line:
+
+    {"hook": "config-changed", "pid": 1234, "span": "apt_install",
+     "parent": "install", "start": 1500000000.1, "seconds": 12.3,
+     "ok": true}
+
+summarize() adds up the spans of the most recent hooks, which is what the
+timings action reports. Tracing never fails a hook, spans that cannot be
+written are dropped.
+"""
+import os
+import json
+import time
+import functools
+import contextlib
+
+from collections import OrderedDict
+
+from charmhelpers.core import hookenv
+from charms.reactive.bus import _action_id, _short_action_id
+
+
+SPANS_FILE = '/var/log/juju/mongodb-spans.jsonl'
+# The file is rotated once past this size, keeping one previous file
+MAX_SIZE = 4 * 1024 * 1024
+ROTATED = '.1'
+
+# Names of the spans open in this process, innermost last
+_open = []
+
+
+def _write(record):
+    try:
+        if os.path.getsize(SPANS_FILE) > MAX_SIZE:
+            os.rename(SPANS_FILE, SPANS_FILE + ROTATED)
+    except OSError:
+        pass
+    try:
+        with open(SPANS_FILE, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except (IOError, OSError):
+        pass
+
+
+@contextlib.contextmanager
+def span(name):
+    """Record the time spent in the with block as span name"""
+    record = OrderedDict([
+        ('hook', hookenv.hook_name()),
+        ('pid', os.getpid()),
+        ('span', name),
+        ('parent', _open[-1] if _open else None),
+        ('start', round(time.time(), 3)),
+    ])
+    start = time.monotonic()
+    ok = False
+    _open.append(name)
+    try:
+        yield
+        ok = True
+    finally:
+        _open.pop()
+        record['seconds'] = round(time.monotonic() - start, 6)
+        record['ok'] = ok
+        _write(record)
+
+
+def traced(name=None):
+    """Decorator recording every call as a span, named after the function"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name or fn.__name__):
+                return fn(*args, **kwargs)
+        # charms.reactive tells handlers apart by their code, which would
+        # otherwise be this wrapper for every traced handler
+        wrapper._action_id = _action_id(fn)
+        wrapper._short_action_id = _short_action_id(fn)
+        return wrapper
+    return decorator
+
+
+def read(path=None):
+    """Spans recorded so far, oldest first"""
+    path = path or SPANS_FILE
+    spans = []
+    for p in (path + ROTATED, path):
+        try:
+            with open(p) as f:
+                lines = f.readlines()
+        except (IOError, OSError):
+            continue
+        for line in lines:
+            try:
+                spans.append(json.loads(line))
+            except ValueError:
+                # A hook killed mid write leaves a partial line
+                continue
+    return spans
+
+
+def summarize(spans, hooks=20, top=10):
+    """Spans of the last hooks run added up by name, most time first"""
+    runs = OrderedDict()
+    for s in spans:
+        runs.setdefault((s.get('hook'), s.get('pid')), []).append(s)
+    recent = list(runs.values())[-hooks:] if hooks else runs.values()
+
+    phases = OrderedDict()
+    for run in recent:
+        for s in run:
+            p = phases.setdefault(s['span'], {'count': 0, 'total': 0.0,
+                                              'max': 0.0, 'hook': None,
+                                              'failed': 0})
+            p['count'] += 1
+            p['total'] += s['seconds']
+            p['failed'] += 0 if s.get('ok') else 1
+            if p['hook'] is None or s['seconds'] > p['max']:
+                p['max'], p['hook'] = s['seconds'], s.get('hook')
+
+    rows = [OrderedDict([
+        ('span', name),
+        ('count', p['count']),
+        ('total_seconds', round(p['total'], 3)),
+        ('mean_seconds', round(p['total'] / p['count'], 3)),
+        ('max_seconds', round(p['max'], 3)),
+        ('slowest_hook', p['hook']),
+        ('failed', p['failed']),
+    ]) for name, p in phases.items()]
+    rows.sort(key=lambda r: -r['total_seconds'])
+    return rows[:top] if top else rows
@@ -0,0 +1,204 @@
+"""Host settings recommended for running mongod
+
+tune() applies them to the running host through sysfs and sysctl and
+persists them with a systemd drop-in for the mongodb service, a udev rule
+for the dbpath device and a sysctl.d file. check() reports the settings
+still off, for instance in a container that cannot change them.
+"""
+import os
+import glob
+import shutil
+import subprocess
+
+from charmhelpers.core.host import init_is_systemd
+
+
+THP = '/sys/kernel/mm/transparent_hugepage/{0}'
+THP_FILES = ('enabled', 'defrag')
+NUMA_NODES = '/sys/devices/system/node/node[0-9]*'
+SYS_DEV_BLOCK = '/sys/dev/block/{0}:{1}'
+ZONE_RECLAIM = '/proc/sys/vm/zone_reclaim_mode'
+PROC_LIMITS = '/proc/{0}/limits'
+
+DROP_IN = '/etc/systemd/system/mongodb.service.d/juju-tuning.conf'
+UDEV_RULE = '/etc/udev/rules.d/60-mongodb-readahead.rules'
+SYSCTL_FILE = '/etc/sysctl.d/60-mongodb.conf'
+MONGOD = '/usr/bin/mongod'
+NUMACTL = 'numactl'
+
+# Readahead in KB on the dbpath device, production notes allow 8 to 32
+# sectors for WiredTiger
+READAHEAD_KB = 8
+MAX_READAHEAD_KB = 16
+NOFILE = 64000
+NPROC = 64000
+
+HEADER = '# Managed by juju, changes will be overwritten\n'
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _write(path, content):
+    """Write content to path, returns False when that was not possible"""
+    try:
+        with open(path, 'w') as f:
+            f.write(content)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _update(path, content):
+    """Replace path with content, returns whether it changed"""
+    if _read(path) == content.strip():
+        return False
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        f.write(content)
+    return True
+
+
+def hugepages():
+    """Selected transparent hugepage modes, e.g. {'enabled': 'always'}"""
+    modes = {}
+    for name in THP_FILES:
+        current = _read(THP.format(name))
+        if current and '[' in current:
+            modes[name] = current.split('[', 1)[1].split(']', 1)[0]
+    return modes
+
+
+def numa_nodes():
+    return len(glob.glob(NUMA_NODES))
+
+
+def block_device(path):
+    """sysfs directory of the block device holding path, None if virtual"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    device = os.path.realpath(SYS_DEV_BLOCK.format(os.major(st.st_dev),
+                                                   os.minor(st.st_dev)))
+    # Partitions share the queue of the disk they are on
+    if not os.path.isdir(os.path.join(device, 'queue')):
+        device = os.path.dirname(device)
+    if not os.path.isdir(os.path.join(device, 'queue')):
+        return None
+    return device
+
+
+def readahead(device):
+    value = _read(os.path.join(device, 'queue', 'read_ahead_kb'))
+    return int(value) if value else None
+
+
+def mongod_limits():
+    """Soft open files and processes limits of the running mongod"""
+    try:
+        pid = subprocess.check_output(['pidof', '-s', 'mongod']).split()[0]
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    limits = {}
+    for line in (_read(PROC_LIMITS.format(pid.decode())) or '').splitlines():
+        for name in ('Max open files', 'Max processes'):
+            if line.startswith(name):
+                soft = line[len(name):].split()[0]
+                limits[name] = None if soft == 'unlimited' else int(soft)
+    return limits
+
+
+def drop_in(config_file, numa=False):
+    """systemd drop-in setting limits, hugepages and NUMA for mongod"""
+    thp = '; '.join('echo never > {}'.format(THP.format(name))
+                    for name in THP_FILES)
+    lines = [
+        '[Service]',
+        'LimitNOFILE={}'.format(NOFILE),
+        'LimitNPROC={}'.format(NPROC),
+        'PermissionsStartOnly=true',
+        # Failing to write sysfs, as in containers, must not stop mongod
+        "ExecStartPre=-/bin/sh -c '{}'".format(thp),
+    ]
+    if numa:
+        lines += [
+            'ExecStart=',
+            'ExecStart=/usr/bin/numactl --interleave=all {} --config {}'
+            .format(MONGOD, config_file),
+        ]
+    return HEADER + '\n'.join(lines) + '\n'
+
+
+def udev_rule(device):
+    return HEADER + ('ACTION=="add|change", KERNEL=="{}", '
+                     'ATTR{{bdi/read_ahead_kb}}="{}"\n').format(
+        os.path.basename(device), READAHEAD_KB)
+
+
+def tune(config_file, dbpath):
+    """Apply and persist the recommended settings
+
+    Returns whether the mongodb service definition changed, which takes a
+    restart of mongod to apply.
+    """
+    for name in THP_FILES:
+        _write(THP.format(name), 'never')
+
+    device = block_device(dbpath)
+    if device:
+        _write(os.path.join(device, 'queue', 'read_ahead_kb'),
+               str(READAHEAD_KB))
+        _update(UDEV_RULE, udev_rule(device))
+
+    numa = numa_nodes() > 1
+    if numa:
+        if _update(SYSCTL_FILE, HEADER + 'vm.zone_reclaim_mode = 0\n'):
+            try:
+                subprocess.check_call(['sysctl', '-p', SYSCTL_FILE])
+            except subprocess.CalledProcessError:
+                pass
+
+    if not init_is_systemd():
+        return False
+    numactl = numa and shutil.which(NUMACTL) is not None
+    if not _update(DROP_IN, drop_in(config_file, numactl)):
+        return False
+    subprocess.check_call(['systemctl', 'daemon-reload'])
+    return True
+
+
+def check(dbpath):
+    """Short descriptions of the recommended settings not in effect"""
+    issues = []
+    modes = hugepages()
+    if any(mode != 'never' for mode in modes.values()):
+        issues.append('transparent hugepages {}'.format(
+            modes.get('enabled', modes.get('defrag'))))
+
+    device = block_device(dbpath)
+    ra = readahead(device) if device else None
+    if ra is not None and ra > MAX_READAHEAD_KB:
+        issues.append('readahead {}KB'.format(ra))
+
+    if numa_nodes() > 1:
+        if shutil.which(NUMACTL) is None:
+            issues.append('numactl missing')
+        if _read(ZONE_RECLAIM) not in (None, '0'):
+            issues.append('zone_reclaim_mode')
+
+    limits = mongod_limits()
+    for name, wanted in (('Max open files', NOFILE),
+                         ('Max processes', NPROC)):
+        soft = limits.get(name, wanted)
+        if soft is not None and soft < wanted:
+            issues.append('{} {}'.format(name.lower().replace('max ', ''),
+                                         soft))
+    return issues
@@ -1,11 +1,24 @@
+from collections import OrderedDict
+
 from charmhelpers.core.hookenv import (
     config,
+    log,
     status_set,
     open_port,
     close_port,
+    is_leader,
+    relation_ids,
+    relation_set,
+    related_units,
+    unit_private_ip,
 )
 
-from charmhelpers.core.host import service_restart
+from charmhelpers.core import host
+from charmhelpers.core.host import (
+    service_pause,
+    service_running,
+    service_stop,
+)
 
 from charms.reactive import (
     hook,
@@ -13,15 +26,47 @@ from charms.reactive import (
     when_not,
     set_state,
     remove_state,
+    is_state,
     main,
 )
 
 from charms.layer import mongodb
+from charms.layer import mongodb_backup
+from charms.layer import mongodb_client
+from charms.layer import mongodb_health
+from charms.layer import mongodb_log
+from charms.layer import mongodb_metrics
+from charms.layer import mongodb_oplog
+from charms.layer import mongodb_replicaset
+from charms.layer import mongodb_restart
+from charms.layer import mongodb_seed
+from charms.layer import mongodb_sharding
+from charms.layer import mongodb_trace
+from charms.layer import mongodb_tuning
+
+
+service_restart = mongodb_trace.traced('service_restart')(
+    host.service_restart)
+
+# Logged events named in the status message when there were any
+LOG_EVENTS = OrderedDict([
+    ('elections', 'elections'),
+    ('assertions', 'assertions'),
+    ('slow_queries', 'slow'),
+    ('errors', 'errors'),
+])
 
 
 @when('config.changed.version')
+@mongodb_trace.traced()
 def install():
     cfg = config()
+    if mongodb.installed() and cfg.get('version') != 'archive':
+        # What was downloaded may be for an earlier version setting
+        remove_state('mongodb.upgrade.downloaded')
+        set_state('mongodb.upgrade.pending')
+        return
+
     if mongodb.installed():
         status_set('maintenance',
                    'uninstalling mongodb {}'.format(mongodb.version()))
@@ -30,18 +75,79 @@ def install():
         remove_state('mongodb.ready')
 
     m = mongodb.mongodb(cfg.get('version'))
+    m.package_cache = cfg.get('package_cache') or None
     status_set('maintenance', 'installing mongodb')
     m.install()
     set_state('mongodb.installed')
 
 
+@when('mongodb.installed', 'mongodb.upgrade.pending')
+@mongodb_trace.traced()
+def upgrade():
+    """Move the installed server to the configured version in place
+
+    Packages are downloaded before asking for a turn, replica set members
+    then swap them in one at a time, as a secondary.
+    """
+    cfg = config()
+    current = mongodb.version()
+    m = mongodb.mongodb(cfg.get('version'))
+    m.package_cache = cfg.get('package_cache') or None
+
+    def swap():
+        status_set('maintenance', 'upgrading mongodb {} to {}'.format(
+            current, cfg.get('version')))
+        log_timings('Upgraded', m.upgrade(cfg))
+
+    def log_timings(done, timings):
+        log('{} mongodb {} to {}: {}'.format(
+            done, current, m.version,
+            ', '.join('{} {}s'.format(k, v) for k, v in timings.items())))
+
+    try:
+        if not is_state('mongodb.upgrade.downloaded'):
+            # Refused before a primary steps down for it
+            status_set('maintenance', 'downloading mongodb {}'.format(
+                cfg.get('version')))
+            log_timings('Downloaded', m.download(current))
+            set_state('mongodb.upgrade.downloaded')
+        if not rolling_restart(cfg, swap):
+            return
+    except mongodb.UnsupportedVersion as e:
+        mongodb_restart.release(is_leader())
+        remove_state('mongodb.upgrade.pending')
+        status_set('blocked', str(e))
+        return
+
+    remove_state('mongodb.upgrade.pending')
+    remove_state('mongodb.upgrade.downloaded')
+    remove_state('mongodb.ready')
+    # Peers learn the new version, then featureCompatibilityVersion follows
+    remove_state('replicaset.configured')
+    remove_state('mongodb.fcv.current')
+    set_state('mongodb.installed')
+
+
 @when('mongodb.installed')
 @when_not('mongodb.ready')
+@mongodb_trace.traced()
 def configure():
     c = config()
     m = mongodb.mongodb(c.get('version'))
-    m.configure(c)
-    service_restart('mongodb')
+    try:
+        if c.get('cluster_role') == 'mongos':
+            if not configure_mongos(m, c):
+                return
+        else:
+            mongodb_replicaset.parse_roles(c.get('member_roles'))
+            changes = m.configure(c)
+            if not seed_member(c):
+                return
+            if not apply_config(m, changes):
+                return
+    except (mongodb.UnsupportedVersion, ValueError) as e:
+        status_set('blocked', str(e))
+        return
 
     if c.changed('port') and c.previous('port'):
         close_port(c.previous('port'))
@@ -50,18 +156,475 @@ def configure():
     set_state('mongodb.ready')
 
 
+def configure_mongos(m, c):
+    """Route through mongos instead of running mongod on this unit"""
+    config_db = mongodb_sharding.config_db()
+    if not config_db:
+        status_set('blocked', 'mongos needs a config-server relation')
+        return False
+
+    changed = m.configure_mongos(c, config_db)
+    # Disabled too, or the packaged mongod takes the port after a reboot
+    service_pause('mongodb')
+    if changed or not service_running('mongos'):
+        log('Restarting mongos, config servers: {}'.format(config_db))
+        service_restart('mongos')
+    return True
+
+
+def seed_member(c):
+    """Restore seed_snapshot into dbpath when joining an existing set
+
+    Done at most once, before mongod first runs as a member, and only when
+    the primary's oplog reaches back to the snapshot. Without known peers
+    only the leader starts a new set. Returns False while that cannot be
+    decided yet or the snapshot is unusable.
+    """
+    snapshot = c.get('seed_snapshot')
+    if not snapshot or not c.get('replicaset'):
+        return True
+    if is_state('replicaset.seeded'):
+        return True
+
+    local = '{}:{}'.format(unit_private_ip(), c.get('port'))
+    peers = [p.rsplit(':', 1) for p in mongodb_replicaset.members(local)
+             if p != local]
+    health = mongodb_health.probe(peers, c.get('health_timeout'))
+    primary = [h for h in health if h.state == 'primary']
+    if not primary:
+        if not peers and not is_leader():
+            # Peers may run a set this unit has not heard of yet
+            status_set('waiting', 'waiting for replica set peers to seed '
+                       'from')
+            return False
+        if all(h.ok and h.state == 'standalone' for h in health):
+            # A new set, there is no data to seed from
+            set_state('replicaset.seeded')
+            return True
+        status_set('waiting', 'waiting for a primary to seed from')
+        return False
+
+    conn = mongodb_client.connection(primary[0].host, primary[0].port)
+    try:
+        cfg = conn.command({'replSetGetConfig': 1}).get('config', {})
+        if local in [m['host'] for m in cfg.get('members', [])]:
+            set_state('replicaset.seeded')
+            return True
+        mongodb_seed.check(mongodb_seed.metadata(snapshot),
+                           c.get('replicaset'),
+                           mongodb_seed.oplog_start(conn))
+    except (IOError, ValueError, mongodb_seed.StaleSnapshot) as e:
+        status_set('blocked', 'unable to seed from {}: {}'.format(snapshot,
+                                                                  e))
+        return False
+
+    status_set('maintenance', 'restoring {}'.format(snapshot))
+    service_stop('mongodb')
+    mongodb_seed.restore(snapshot, c.get('dbpath'))
+    log('Seeded {} from {}'.format(c.get('dbpath'), snapshot))
+    set_state('replicaset.seeded')
+    return True
+
+
+def apply_config(m, changes):
+    """Restart mongod only when a changed setting requires it
+
+    Returns False while the restart waits, see rolling_restart().
+    """
+    changed = ', '.join(sorted(changes))
+    if is_state('mongodb.restart.pending'):
+        log('Restarting mongodb, changed: {}'.format(changed or 'none'))
+    elif not service_running('mongodb'):
+        log('mongodb is not running, starting it')
+    elif m.needs_restart(changes):
+        log('Restarting mongodb, changed: {}'.format(changed))
+    elif changes:
+        try:
+            m.apply_runtime(changes)
+            log('Applied without restart: {}'.format(changed))
+            return True
+        except IOError as e:
+            log('Unable to apply {} at runtime, restarting: {}'.format(
+                changed, e))
+    else:
+        log('mongodb configuration unchanged, not restarting')
+        return True
+
+    set_state('mongodb.restart.pending')
+    if not rolling_restart(config(), lambda: service_restart('mongodb')):
+        return False
+    remove_state('mongodb.restart.pending')
+    return True
+
+
+def rolling_restart(c, restart):
+    """Call restart, which restarts mongod, in this unit's turn
+
+    A running replica set member waits for the leader to give it the
+    turn, steps down should it be the primary and holds the turn until it
+    is serving again. Returns False while waiting for any of these, to be
+    called again by a later hook.
+    """
+    rolling = (c.get('replicaset') and c.get('cluster_role') != 'mongos' and
+               (service_running('mongodb') or
+                is_state('mongodb.restart.rejoining')))
+    if not rolling:
+        restart()
+        return True
+
+    if not mongodb_restart.take_turn(is_leader()):
+        status_set('waiting', 'waiting for a turn to restart mongodb')
+        return False
+
+    m = mongodb.server(c)
+    if not is_state('mongodb.restart.rejoining'):
+        try:
+            if mongodb_restart.step_down(
+                    mongodb_client.connection(m.host, m.port),
+                    c.get('step_down_max_lag'), c.get('restart_timeout')):
+                log('Stepped down as primary to restart mongodb')
+        except IOError as e:
+            # Let the other members restart meanwhile
+            mongodb_restart.release(is_leader())
+            status_set('waiting', 'not restarting the primary: {}'.format(e))
+            return False
+        restart()
+        set_state('mongodb.restart.rejoining')
+
+    try:
+        mongodb_restart.wait_serving(m.host, m.port, c.get('restart_timeout'))
+    except IOError as e:
+        status_set('waiting', 'waiting for mongodb to rejoin the replica '
+                   'set: {}'.format(e))
+        return False
+    remove_state('mongodb.restart.rejoining')
+    mongodb_restart.release(is_leader())
+    return True
+
+
 @when('config.changed')
 @when_not('config.changed.version')
+@mongodb_trace.traced()
 def check_config():
     remove_state('mongodb.ready')
+    remove_state('replicaset.configured')
+    remove_state('mongodb.published')
+
+
+@hook('replica-set-relation-{joined,changed,departed}', 'leader-elected')
+@mongodb_trace.traced()
+def replicaset_changed():
+    remove_state('replicaset.configured')
+    remove_state('mongodb.published')
+    remove_state('mongodb.fcv.current')
+    if config().get('seed_snapshot') and not is_state('replicaset.seeded'):
+        # New peers may change whether and from where to seed
+        remove_state('mongodb.ready')
+
+
+@when('mongodb.ready')
+@when_not('mongodb.fcv.current')
+@mongodb_trace.traced()
+def feature_compatibility():
+    """Raise featureCompatibilityVersion once every member runs one series
+
+    Only the primary accepts it, so the leader sets it for a replica set
+    once all peers published the same series, a unit on its own sets it
+    after its upgrade.
+    """
+    c = config()
+    if c.get('cluster_role') == 'mongos':
+        set_state('mongodb.fcv.current')
+        return
+    current = mongodb.version()
+    if c.get('replicaset'):
+        if not is_leader():
+            set_state('mongodb.fcv.current')
+            return
+        versions = mongodb_replicaset.versions(current)
+    else:
+        versions = {None: current}
+
+    try:
+        series = set(mongodb.parse_version(v).series if v else None
+                     for v in versions.values())
+        if len(series) != 1 or None in series:
+            log('Not setting featureCompatibilityVersion, members run '
+                '{}'.format(', '.join(sorted(str(v)
+                                             for v in versions.values()))))
+            return
+        if not mongodb.server(c).set_feature_compatibility(
+                mongodb.parse_version(current)):
+            log('featureCompatibilityVersion refused, will retry')
+            return
+    except (IOError, mongodb.UnsupportedVersion) as e:
+        log('Unable to set featureCompatibilityVersion, will retry: '
+            '{}'.format(e))
+        return
+    set_state('mongodb.fcv.current')
+
+
+@hook('replica-set-relation-{changed,departed}', 'leader-elected')
+@mongodb_trace.traced()
+def restart_turns():
+    """Pass the restart turn on as units ask for it and give it back"""
+    if is_leader():
+        mongodb_restart.grant()
+
+
+@when('mongodb.ready')
+@when_not('replicaset.configured')
+@mongodb_trace.traced()
+def configure_replicaset():
+    """Publish this member, the leader then reconciles the whole set
+
+    Every peer known in this hook is added or removed with one reconfig.
+    """
+    c = config()
+    local = '{}:{}'.format(unit_private_ip(), c.get('port'))
+    for rid in relation_ids(mongodb_replicaset.RELATION):
+        relation_set(rid, member=local, version=mongodb.version())
+
+    role = c.get('cluster_role')
+    if not c.get('replicaset') or role == 'mongos' or not is_leader():
+        set_state('replicaset.configured')
+        return
+
+    m = mongodb.server(c)
+    roles = mongodb_replicaset.roles(
+        local, mongodb_replicaset.parse_roles(c.get('member_roles')))
+    try:
+        cfg = m.reconfigure_replicaset(c.get('replicaset'),
+                                       mongodb_replicaset.members(local),
+                                       configsvr=role == 'configsvr',
+                                       roles=roles)
+    except (IOError, ValueError) as e:
+        log('Unable to configure replica set, will retry: {}'.format(e))
+        return
+
+    if cfg:
+        log('Replica set {} version {}: {}'.format(
+            cfg['_id'], cfg['version'],
+            ', '.join(member['host'] for member in cfg['members'])))
+    set_state('replicaset.configured')
+
+
+@hook('{database,configsvr,shard}-relation-joined',
+      'database-relation-departed')
+@mongodb_trace.traced()
+def relation_joined():
+    remove_state('mongodb.published')
+
+
+@when('mongodb.ready')
+@when_not('mongodb.published')
+@mongodb_trace.traced()
+def publish():
+    """Hand the deployment's endpoints to clients and the sharded cluster
+
+    Clients get every member or router known to this unit as seed list,
+    with hints scaled to the deployment and to their own number of units.
+    Analytics consumers use analytics_uri to read from analytics members.
+    Only settings that changed since the last time reach the clients.
+    """
+    c = config()
+    host = unit_private_ip()
+    local = '{}:{}'.format(host, c.get('port'))
+    hosts = mongodb_replicaset.members(local)
+    replset, roles = None, None
+    if c.get('cluster_role') != 'mongos':
+        replset = c.get('replicaset') or None
+    if replset:
+        roles = mongodb_replicaset.roles(
+            local, mongodb_replicaset.parse_roles(c.get('member_roles')))
+    for rid in relation_ids('database'):
+        settings = mongodb_replicaset.client_settings(
+            hosts, replset, len(related_units(rid)), roles)
+        relation_set(rid, hostname=host, port=c.get('port'), **settings)
+
+    relation = mongodb_sharding.ROLE_RELATIONS.get(c.get('cluster_role'))
+    if relation:
+        for rid in relation_ids(relation):
+            relation_set(rid, replset=c.get('replicaset'), member=local)
+    set_state('mongodb.published')
+
+
+@hook('config-server-relation-{joined,changed,departed}')
+@mongodb_trace.traced()
+def config_servers_changed():
+    remove_state('mongodb.ready')
+
+
+@hook('shards-relation-{joined,changed,departed}', 'leader-elected')
+@mongodb_trace.traced()
+def shards_changed():
+    remove_state('sharding.registered')
+
+
+@when('mongodb.ready')
+@when_not('sharding.registered')
+@mongodb_trace.traced()
+def register_shards():
+    """Have the cluster add every related shard, from the mongos leader"""
+    c = config()
+    if c.get('cluster_role') != 'mongos' or not is_leader():
+        set_state('sharding.registered')
+        return
+
+    shards = mongodb_sharding.replica_sets(mongodb_sharding.SHARDS)
+    try:
+        added = mongodb_sharding.add_shards(mongodb.server(c), shards)
+    except IOError as e:
+        log('Unable to register shards, will retry: {}'.format(e))
+        return
+
+    if added:
+        log('Added shards: {}'.format(', '.join(added)))
+    set_state('sharding.registered')
+
+
+@when('mongodb.installed', 'config.changed')
+@mongodb_trace.traced()
+def configure_backups():
+    c = config()
+    m = mongodb.mongodb(c.get('version'))
+    host, _ = mongodb.local_address(c)
+    if mongodb_backup.schedule(c, host, m.archive_dumps):
+        log('Backups scheduled at {} to {}'.format(
+            c.get('backup_schedule'), c.get('backup_directory')))
+
+
+@when('mongodb.installed', 'config.changed')
+@mongodb_trace.traced()
+def configure_logrotate():
+    c = config()
+    if mongodb.server(c).logrotate(c):
+        log('Installed logrotate policy for {}'.format(c.get('logpath')))
+
+
+@when('mongodb.installed', 'config.changed')
+@mongodb_trace.traced()
+def tune_host():
+    c = config()
+    if not c.get('host_tuning'):
+        return
+    m = mongodb.mongodb(c.get('version'))
+    changed = mongodb_tuning.tune(m.config_file, c.get('dbpath'))
+    if changed and service_running('mongodb'):
+        log('mongodb needs a restart for the tuned service settings')
+        set_state('mongodb.restart.pending')
+        remove_state('mongodb.ready')
 
 
 @hook('update-status')
+@mongodb_trace.traced()
 def update_status():
-    if mongodb.installed():
-        status_set('active', 'mongodb {}'.format(mongodb.version()))
-    else:
+    if not mongodb.installed():
         status_set('blocked', 'unable to install mongodb')
+        return
+
+    c = config()
+    host, port = mongodb.local_address(c)
+    local = '{}:{}'.format(unit_private_ip(), port)
+    peers = [p.rsplit(':', 1) for p in mongodb_replicaset.members(local)
+             if p != local]
+    health = mongodb_health.probe([(host, port)] + peers,
+                                  c.get('health_timeout'))
+
+    me = health[0]
+    if not me.ok:
+        status_set('blocked', 'mongodb {} not responding: {}'.format(
+            mongodb.version(), me.error))
+        return
+
+    message = 'mongodb {} {}, ping {:.1f}ms'.format(
+        mongodb.version(), me.state, me.latency * 1000)
+    unreachable = ['{}:{}'.format(h.host, h.port) for h in health[1:]
+                   if not h.ok]
+    if unreachable:
+        message += ', unreachable: {}'.format(', '.join(unreachable))
+    if me.state in ('primary', 'secondary'):
+        message += oplog_status(c)
+    message += log_status(c)
+    if c.get('host_tuning'):
+        untuned = mongodb_tuning.check(c.get('dbpath'))
+        if untuned:
+            message += ', untuned: {}'.format(', '.join(untuned))
+    status_set('active', message)
+    sample_metrics()
+
+
+def oplog_status(c):
+    """Sample the oplog and size it for oplog_window hours of writes
+
+    Returns the window it holds for the status message, with the size
+    needed for the target while that is not applied.
+    """
+    m = mongodb.server(c)
+    try:
+        oplog = mongodb_oplog.stats(mongodb_client.connection(m.host, m.port))
+    except IOError as e:
+        log('Unable to sample the oplog: {}'.format(e))
+        return ''
+    if oplog is None:
+        return ''
+
+    message = ', oplog {:.1f}h'.format(oplog.window / 3600.0)
+    samples = mongodb_oplog.sample(oplog)
+    size = mongodb_oplog.recommend(samples, c.get('oplog_window'))
+    current = oplog.max_size // mongodb_oplog.MB
+    if not mongodb_oplog.needs_resize(current, size):
+        return message
+
+    if (c.get('oplog_autosize') and
+            len(samples) >= mongodb_oplog.MIN_SAMPLES):
+        try:
+            m.resize_oplog(size)
+            log('Resized the oplog from {}MB to {}MB for {}h'.format(
+                current, size, c.get('oplog_window')))
+            return message
+        except (IOError, mongodb.UnsupportedVersion) as e:
+            log('Unable to resize the oplog: {}'.format(e))
+    return message + ' ({}h needs {}MB)'.format(c.get('oplog_window'), size)
+
+
+def log_status(c):
+    """Count the events logged since the last update-status
+
+    Returns the ones worth a look for the status message.
+    """
+    if not c.get('logpath'):
+        return ''
+    try:
+        counters = mongodb_log.ingest(c.get('logpath'))
+    except (IOError, OSError) as e:
+        log('Unable to read the mongodb log: {}'.format(e))
+        return ''
+    events = ['{} {}'.format(counters[k], name)
+              for k, name in LOG_EVENTS.items() if counters.get(k)]
+    return ', log: {}'.format(', '.join(events)) if events else ''
+
+
+def sample_metrics():
+    """Store serverStatus metrics for collect-metrics and the textfile"""
+    c = config()
+    try:
+        metrics = mongodb_metrics.collect(mongodb.server(c))
+    except IOError as e:
+        log('Unable to sample mongodb metrics: {}'.format(e))
+        return
+
+    if c.get('metrics_textfile'):
+        logged = {'log_{}'.format(k): v
+                  for k, v in mongodb_log.stored().items()}
+        mongodb_metrics.write_textfile(c.get('metrics_textfile'),
+                                       dict(metrics, **logged))
+
+
+@hook('collect-metrics')
+@mongodb_trace.traced()
+def collect_metrics():
+    mongodb_metrics.add_metrics(mongodb_metrics.stored())
 
 
 if __name__ == '__main__':
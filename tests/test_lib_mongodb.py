@@ -1,11 +1,16 @@
 
+import os
 import sys
+import shutil
+import tempfile
 import json
 import unittest
-from mock import patch
+from mock import patch, MagicMock, call
 
 sys.path.append('lib')
 
+from charmhelpers.core import unitdata  # noqa: E402
+
 from charms.layer import mongodb  # noqa: E402
 
 
@@ -22,6 +27,37 @@ class ExtraTest(unittest.TestCase):
             '1111111'
         ])
 
+    @patch('charms.layer.mongodb.subprocess')
+    def test_apt_update_source(self, sp):
+        mongodb.apt_update_source('/etc/apt/sources.list.d/mongodb.list')
+        sp.check_call.assert_called_with([
+            'apt-get', 'update',
+            '-o', 'Dir::Etc::sourcelist=/etc/apt/sources.list.d/mongodb.list',
+            '-o', 'Dir::Etc::sourceparts=-',
+            '-o', 'APT::Get::List-Cleanup=0',
+        ])
+
+    def test_local_repo(self):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        index = os.path.join(d, 'Packages')
+        with open(index, 'w') as f:
+            f.write('Package: mongodb-org-server\n')
+        mtime = os.stat(index).st_mtime_ns
+        expected = '# index {}\ndeb [trusted=yes] file:{} ./'.format(mtime, d)
+        self.assertEqual(expected, mongodb.local_repo(d))
+        self.assertEqual(expected, mongodb.local_repo('file://' + d))
+
+    @patch('charms.layer.mongodb.subprocess')
+    def test_local_repo_index(self, sp):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        mongodb.local_repo(d)
+        sp.check_call.assert_called_once()
+        args, kwargs = sp.check_call.call_args
+        self.assertEqual(['apt-ftparchive', 'packages', '.'], args[0])
+        self.assertEqual(d, kwargs['cwd'])
+
     @patch('charms.layer.mongodb.os')
     def test_installed(self, mos):
         isfile = mos.path.isfile
@@ -29,15 +65,75 @@ class ExtraTest(unittest.TestCase):
         self.assertTrue(mongodb.installed())
         isfile.assert_called_with('/usr/bin/mongo')
 
+    @patch('charms.layer.mongodb.unitdata')
     @patch('charms.layer.mongodb.subprocess')
     @patch('charms.layer.mongodb.installed')
-    def test_version(self, mi, sp):
-        sp.check_output.return_value = b'mongo: 5.5.9'
+    def test_version(self, mi, sp, mkv):
+        sp.check_output.return_value = b'MongoDB shell version: 3.2.22\n'
         mi.return_value = True
-        self.assertEqual(mongodb.version(), '5.5.9')
+        self.assertEqual(mongodb.version(), '3.2.22')
         mi.return_value = False
         self.assertIsNone(mongodb.version())
 
+    @patch('charms.layer.mongodb.subprocess')
+    def test_mongo_version(self, sp):
+        sp.check_output.return_value = (
+            b'MongoDB shell version v3.4.24\n'
+            b'git version: 865b4f6a96d0f5425e39a18337105f33e8db504d\n'
+            b'OpenSSL version: OpenSSL 1.0.2g  1 Mar 2016\n'
+            b'allocator: tcmalloc\n')
+        self.assertEqual('3.4.24', mongodb._mongo_version())
+        sp.check_output.return_value = b'MongoDB shell version: 2.6.10\n'
+        self.assertEqual('2.6.10', mongodb._mongo_version())
+        sp.check_output.return_value = b'mongo: command not found\n'
+        self.assertRaises(mongodb.UnsupportedVersion, mongodb._mongo_version)
+
+    @patch('charms.layer.mongodb._fingerprint')
+    @patch('charms.layer.mongodb.unitdata')
+    def test_probe(self, mkv, mfp):
+        mkv.kv.return_value = unitdata.Storage(':memory:')
+        mfp.return_value = [1, 2, 3]
+        fn = MagicMock(return_value='3.2.1')
+
+        self.assertEqual('3.2.1', mongodb.probe('v', ['/bin/x'], fn))
+        self.assertEqual('3.2.1', mongodb.probe('v', ['/bin/x'], fn))
+        fn.assert_called_once_with()
+        self.assertEqual({'hits': 1, 'misses': 1}, mongodb.probe_stats())
+
+        mfp.return_value = [1, 5, 3]
+        fn.return_value = '3.2.2'
+        self.assertEqual('3.2.2', mongodb.probe('v', ['/bin/x'], fn))
+        mfp.assert_called_with('/bin/x')
+        self.assertEqual({'hits': 1, 'misses': 2}, mongodb.probe_stats())
+
+    @patch('charms.layer.mongodb.os')
+    def test_fingerprint(self, mos):
+        mos.stat.return_value.st_ino = 7
+        mos.stat.return_value.st_mtime_ns = 8
+        mos.stat.return_value.st_size = 9
+        self.assertEqual([7, 8, 9], mongodb._fingerprint('/usr/bin/mongo'))
+        mos.stat.side_effect = OSError
+        self.assertIsNone(mongodb._fingerprint('/usr/bin/mongo'))
+
+    def test_check_upgrade(self):
+        mongodb.check_upgrade('2.6.10-ubuntu1', '3.0.12')
+        mongodb.check_upgrade('3.0.12', '3.0.15')
+        mongodb.check_upgrade('3.2.10', '3.4.1')
+        mongodb.check_upgrade('3.4.9', '3.6.8')
+        for current, target in (('2.6.10', '3.2.1'), ('3.2.1', '3.0.1'),
+                                ('3.0.1', '3.0.0'), ('3.0.1', '3.1.9'),
+                                ('3.1.2', '3.2.0'), ('3.6.8', '4.0.1')):
+            self.assertRaises(mongodb.UnsupportedVersion,
+                              mongodb.check_upgrade, current, target)
+
+    @patch('charms.layer.mongodb.time')
+    def test_timed(self, mtime):
+        mtime.monotonic.side_effect = [10.0, 12.5]
+        timings = {}
+        with mongodb.timed(timings, 'stop'):
+            pass
+        self.assertEqual({'stop': 2.5}, timings)
+
     def test_as_text(self):
         self.assertEqual('yoooo', mongodb._as_text('yoooo'.encode('UTF-8')))
 
@@ -61,9 +157,10 @@ class ExtraTest(unittest.TestCase):
 
 
 class MongoDBMethodTest(unittest.TestCase):
+    @patch('charms.layer.mongodb.unitdata')
     @patch('charms.layer.mongodb.lsb_release')
     @patch('charms.layer.mongodb.platform')
-    def test_mongodb_archive(self, plt, lsb):
+    def test_mongodb_archive(self, plt, lsb, mkv):
         lsb.side_effect = [{'DISTRIB_CODENAME': 'xenial'}]
         self.assertEqual(type(mongodb.mongodb('archive')).__name__,
                          'MongoDB26')
@@ -91,16 +188,46 @@ class MongoDBMethodTest(unittest.TestCase):
         self.assertEqual(type(mongodb.mongodb()).__name__, 'MongoDB32')
 
         mv.return_value = '3.4.1'
-        self.assertEqual(type(mongodb.mongodb()).__name__, 'MongoDB32')
+        self.assertEqual(type(mongodb.mongodb()).__name__, 'MongoDB34')
 
-        with patch('charms.layer.mongodb.warnings') as mw:
-            mv.return_value = '1.0'
-            self.assertIsNone(mongodb.mongodb())
-            mw.warn.called_with('No viable major version found')
+        mv.return_value = '3.6.8'
+        self.assertEqual(type(mongodb.mongodb()).__name__, 'MongoDB36')
 
+        mv.return_value = '3.1.9\n'
+        self.assertEqual(type(mongodb.mongodb()).__name__, 'MongoDB31')
+
+        mv.return_value = '3.2.0-rc3'
+        self.assertEqual(type(mongodb.mongodb()).__name__, 'MongoDB31')
+
+        for bad in ('1.0', '2.7.1', '3.8.1', '3.10.2', '4.0.1', 'latest'):
+            mv.return_value = bad
+            self.assertRaises(mongodb.UnsupportedVersion, mongodb.mongodb)
+
+    def test_parse_version(self):
+        v = mongodb.parse_version('3.10.2')
+        self.assertEqual((3, 10, 2, None), v)
+        self.assertEqual((3, 10), v.series)
+        self.assertFalse(v.unstable)
+        self.assertTrue(mongodb.parse_version('3.3.1').unstable)
+        self.assertTrue(mongodb.parse_version('3.2.0-rc1').unstable)
+        self.assertFalse(mongodb.parse_version('5.1.0').unstable)
+        self.assertEqual((2, 6, 0, None),
+                         mongodb.parse_version('2.6-ubuntu1'))
+        self.assertRaises(mongodb.UnsupportedVersion,
+                          mongodb.parse_version, 'archive')
+
+    @patch('charms.layer.mongodb.installed')
+    def test_server(self, mi):
+        mi.return_value = False
+        m = mongodb.server({'version': '3.2.1', 'bind_ip': '10.0.0.2',
+                            'port': 27018})
+        self.assertEqual('MongoDB32', type(m).__name__)
+        self.assertEqual(('10.0.0.2', 27018), (m.host, m.port))
+
+    @patch('charms.layer.mongodb.unitdata')
     @patch('charms.layer.mongodb.lsb_release')
     @patch('charms.layer.mongodb.platform')
-    def test_mongodb_zseries(self, plat, lsb):
+    def test_mongodb_zseries(self, plat, lsb, mkv):
         lsb.side_effect = [{'DISTRIB_RELEASE': '16.04'}]
         plat.machine.return_value = 's390x'
         self.assertEqual(type(mongodb.mongodb('archive')).__name__,
@@ -150,15 +277,64 @@ class MongoDBTest(unittest.TestCase):
         w = mopen.return_value.__enter__.return_value.write
         w.assert_called_with(output)
 
+    @patch.object(mongodb.MongoDB, '_read_config')
     @patch.object(mongodb.MongoDB, '_render_config')
-    def test_configure(self, mcfg):
+    def test_configure(self, mcfg, mread):
+        mread.return_value = {'dbpath': 'foo', 'replSet': 'old'}
         m = mongodb.MongoDB('dummy')
-        m.configure({'dbpath': 'foo', 'replicaset': 'test', 'noop': True})
+        changes = m.configure({'dbpath': 'foo', 'replicaset': 'test',
+                               'noop': True})
         mcfg.assert_called_with({'dbpath': 'foo', 'replSet': 'test'})
+        self.assertEqual({'replSet': 'test'}, changes)
+
+        mcfg.reset_mock()
+        mread.return_value = {'dbpath': 'foo', 'replSet': 'test'}
+        self.assertEqual({}, m.configure({'dbpath': 'foo',
+                                          'replicaset': 'test',
+                                          'backups_enabled': True}))
+        mcfg.assert_not_called()
+
+    @patch('charms.layer.mongodb._read')
+    def test_read_config(self, mread):
+        mread.return_value = '# comment\ndbpath = /srv/db\njournal = True'
+        m = mongodb.MongoDB('dummy')
+        self.assertEqual({'dbpath': '/srv/db', 'journal': 'True'},
+                         m._read_config())
+        mread.return_value = None
+        self.assertEqual({}, m._read_config())
+
+    def test_config_changes(self):
+        old = {'port': '27017', 'journal': 'True', 'nssize': '16'}
+        new = {'port': 27017, 'journal': True, 'auth': True}
+        self.assertEqual({'auth': True, 'nssize': None},
+                         mongodb.config_changes(old, new))
+        self.assertEqual({'net.port': 1},
+                         mongodb.config_changes({'net': {'port': 2}},
+                                                {'net': {'port': 1}}))
+
+    def test_needs_restart(self):
+        m = mongodb.MongoDB('dummy')
+        m.runtime_parameters = {'a': lambda v: v and {'a': v}}
+        self.assertFalse(m.needs_restart({}))
+        self.assertFalse(m.needs_restart({'a': 1}))
+        self.assertTrue(m.needs_restart({'a': None}))
+        self.assertTrue(m.needs_restart({'a': 1, 'b': 2}))
+
+    @patch.object(mongodb.MongoDB, 'command')
+    def test_apply_runtime(self, mcmd):
+        m = mongodb.MongoDB('dummy')
+        m.runtime_parameters = {'a': lambda v: {'a': v}}
+        mcmd.return_value = {'ok': 1}
+        m.apply_runtime({'a': 5})
+        mcmd.assert_called_with({'a': 5})
 
+        mcmd.return_value = {'ok': 0, 'errmsg': 'nope'}
+        self.assertRaises(IOError, m.apply_runtime, {'a': 5})
+
+    @patch('charms.layer.mongodb.unitdata')
     @patch('builtins.open')
     @patch('charms.layer.mongodb.lsb_release')
-    def test_add_upstream(self, lsb, mopen):
+    def test_add_upstream(self, lsb, mopen, mkv):
         m = mongodb.MongoDB('dummy')
         m.upstream_repo = 'deb http://localhost {} dummy'
 
@@ -191,46 +367,299 @@ class MongoDBTest(unittest.TestCase):
 
         self.assertRaises(IOError, mongodb.MongoDB('dummy').run, 'fail()')
 
+    @patch('charms.layer.mongodb._read')
+    @patch('builtins.open')
+    @patch('charms.layer.mongodb.local_repo')
+    def test_add_upstream_cache(self, mrepo, mopen, mread):
+        m = mongodb.MongoDB('dummy')
+        m.package_cache = '/srv/debs'
+        mrepo.return_value = 'deb [trusted=yes] file:/srv/debs ./'
+        mread.return_value = mrepo.return_value
+        self.assertFalse(m.add_upstream())
+        mopen.assert_not_called()
+        mrepo.assert_called_with('/srv/debs')
+
+        mread.return_value = 'deb http://elsewhere'
+        self.assertTrue(m.add_upstream())
+        w = mopen.return_value.__enter__.return_value.write
+        w.assert_called_with(mrepo.return_value)
+
+    @patch('charms.layer.mongodb.apt_key')
+    @patch('charms.layer.mongodb.unitdata')
+    def test_add_key(self, mkv, mak):
+        mkv.kv.return_value = unitdata.Storage(':memory:')
+        m = mongodb.MongoDB('dummy')
+        self.assertTrue(m.add_key('AAAA'))
+        self.assertFalse(m.add_key('AAAA'))
+        mak.assert_called_once_with('AAAA')
+
+        m.package_cache = '/srv/debs'
+        self.assertFalse(m.add_key('BBBB'))
+        mak.assert_called_once_with('AAAA')
+
+    @patch('charms.layer.mongodb.mongodb_client')
+    def test_command(self, mcl):
+        mcl.connection.return_value.command.return_value = {'ok': 1}
+        m = mongodb.MongoDB('dummy')
+        self.assertEqual({'ok': 1}, m.command({'ping': 1}))
+        mcl.connection.assert_called_with('127.0.0.1', 27017)
+        mcl.connection.return_value.command.assert_called_with({'ping': 1})
+
     @patch.object(mongodb.MongoDB, 'run')
-    def test_init_replicaset(self, mrun):
+    @patch('charms.layer.mongodb.mongodb_client.connection')
+    def test_command_fallback(self, mconn, mrun):
+        failure = mongodb.mongodb_client.ConnectionFailure('nope')
+        mconn.return_value.command.side_effect = failure
         mrun.return_value = {'ok': 1}
+        m = mongodb.MongoDB('dummy')
+        self.assertEqual({'ok': 1}, m.command({'ping': 1}, 'db.ping()'))
+        mrun.assert_called_with('db.ping()')
+
+        mrun.reset_mock()
+        self.assertRaises(IOError, m.command, {'ping': 1})
+        mrun.assert_not_called()
+
+    def test_local_address(self):
+        self.assertEqual(('127.0.0.1', 27017), mongodb.local_address({}))
+        self.assertEqual(('127.0.0.1', 20),
+                         mongodb.local_address({'bind_ip': '0.0.0.0',
+                                                'port': 20}))
+        self.assertEqual(('10.0.0.1', 27017),
+                         mongodb.local_address({'bind_ip': '10.0.0.1,::1'}))
+
+    @patch.object(mongodb.MongoDB, 'command')
+    def test_init_replicaset(self, mcmd):
+        mcmd.return_value = {'ok': 1}
         self.assertTrue(mongodb.MongoDB('dummy').init_replicaset())
-        mrun.assert_called_with('rs.initiate()')
+        mcmd.assert_called_with({'replSetInitiate': None}, 'rs.initiate()')
 
-    @patch.object(mongodb.MongoDB, 'run')
-    def test_already_init_replicaset(self, mrun):
-        mrun.return_value = {'ok': 0, 'errmsg': 'already initialized'}
+    @patch.object(mongodb.MongoDB, 'command')
+    def test_already_init_replicaset(self, mcmd):
+        mcmd.return_value = {'ok': 0, 'errmsg': 'already initialized'}
         self.assertTrue(mongodb.MongoDB('dummy').init_replicaset())
 
-    @patch.object(mongodb.MongoDB, 'run')
-    def test_failed_init_replicaset(self, mrun):
-        mrun.return_value = {'ok': 0, 'errmsg': 'danger will robinson'}
+    @patch.object(mongodb.MongoDB, 'command')
+    def test_failed_init_replicaset(self, mcmd):
+        mcmd.return_value = {'ok': 0, 'errmsg': 'danger will robinson'}
         self.assertFalse(mongodb.MongoDB('dummy').init_replicaset())
 
+    @patch.object(mongodb.MongoDB, 'run')
+    @patch.object(mongodb.MongoDB, 'command')
+    def test_replicaset_config(self, mcmd, mrun):
+        m = mongodb.MongoDB('dummy')
+        mcmd.return_value = {'ok': 1, 'config': {'_id': 'myset'}}
+        self.assertEqual({'_id': 'myset'}, m.replicaset_config())
+
+        mcmd.return_value = {'ok': 0, 'code': 94}
+        self.assertIsNone(m.replicaset_config())
+        mrun.assert_not_called()
+
+        mcmd.return_value = {'ok': 0, 'errmsg': 'no such cmd'}
+        mrun.return_value = None
+        self.assertIsNone(m.replicaset_config())
+        mrun.assert_called_with('rs.conf()')
+
+    @patch('charms.layer.mongodb.mongodb_client.connection')
+    @patch.object(mongodb.MongoDB, 'replicaset_config')
+    @patch.object(mongodb.MongoDB, 'command')
+    def test_reconfigure_replicaset_initiate(self, mcmd, mconf, mconn):
+        mconf.return_value = None
+        mcmd.return_value = {'ok': 1}
+        mconn.return_value.command.return_value = {'ismaster': False}
+        cfg = mongodb.MongoDB('dummy').reconfigure_replicaset(
+            'myset', ['10.0.0.1:27017', '10.0.0.2:27017'])
+        self.assertEqual(2, len(cfg['members']))
+        mcmd.assert_called_with({'replSetInitiate': cfg})
+        mconn.assert_called_with('10.0.0.2', 27017)
+
+        mcmd.return_value = {'ok': 0, 'errmsg': 'member down'}
+        self.assertRaises(IOError, mongodb.MongoDB('dummy')
+                          .reconfigure_replicaset, 'myset', ['a:1'])
+
+    @patch('charms.layer.mongodb.mongodb_client.connection')
+    @patch.object(mongodb.MongoDB, 'replicaset_config')
+    @patch.object(mongodb.MongoDB, 'command')
+    def test_reconfigure_replicaset_existing(self, mcmd, mconf, mconn):
+        # A leader not yet in the set joins it instead of initiating one
+        mconf.return_value = None
+        current = mongodb.mongodb_replicaset.plan('myset', ['a:1', 'b:1'])
+        hello = {'setName': 'myset', 'primary': 'b:1'}
+        conn = mconn.return_value
+        conn.command.side_effect = [{'ismaster': False}, hello,
+                                    {'ok': 1, 'config': current}, {'ok': 1}]
+
+        cfg = mongodb.MongoDB('dummy').reconfigure_replicaset(
+            'myset', ['c:1', 'a:1', 'b:1'])
+
+        conn.command.assert_called_with({'replSetReconfig': cfg})
+        self.assertEqual(3, len(cfg['members']))
+        for spec, _ in mcmd.call_args_list:
+            self.assertNotIn('replSetInitiate', spec)
+
+        conn.command.side_effect = [{'setName': 'myset'}]
+        self.assertRaises(IOError, mongodb.MongoDB('dummy')
+                          .reconfigure_replicaset, 'myset', ['a:1', 'c:1'])
+        mcmd.assert_not_called()
+
+    @patch('charms.layer.mongodb.mongodb_client.connection')
+    @patch.object(mongodb.MongoDB, 'replicaset_config')
+    @patch.object(mongodb.MongoDB, 'command')
+    def test_reconfigure_replicaset_roles(self, mcmd, mconf, mconn):
+        mconf.return_value = None
+        mcmd.return_value = {'ok': 1}
+        mconn.return_value.command.return_value = {'ismaster': False}
+        roles = {'b:1': {'role': 'delayed', 'delay': 60}}
+        m = mongodb.MongoDB32('upstream', '3.6.2')
+        cfg = m.reconfigure_replicaset('myset', ['a:1', 'b:1'], roles=roles)
+        self.assertEqual(60, cfg['members'][1]['slaveDelay'])
+
+    @patch('charms.layer.mongodb.mongodb_client.connection')
+    @patch.object(mongodb.MongoDB, 'replicaset_config')
+    @patch.object(mongodb.MongoDB, 'command')
+    def test_reconfigure_replicaset(self, mcmd, mconf, mconn):
+        current = mongodb.mongodb_replicaset.plan('myset',
+                                                  ['a:1', 'b:1', 'c:1'])
+        mconf.return_value = current
+        mcmd.return_value = {'ismaster': False, 'primary': 'b:1'}
+        conn = mconn.return_value
+        conn.command.side_effect = [{'ok': 1, 'config': current}, {'ok': 1}]
+
+        m = mongodb.MongoDB('dummy')
+        cfg = m.reconfigure_replicaset('myset', ['a:1', 'b:1', 'c:1', 'd:1'])
+
+        mconn.assert_called_with('b', 1)
+        conn.command.assert_called_with({'replSetReconfig': cfg})
+        self.assertEqual(2, cfg['version'])
+
+        conn.command.side_effect = [{'ok': 1, 'config': current}]
+        self.assertIsNone(m.reconfigure_replicaset('myset',
+                                                   ['a:1', 'b:1', 'c:1']))
+
+        mcmd.return_value = {'ismaster': False}
+        self.assertRaises(IOError, m.reconfigure_replicaset, 'myset', ['a:1'])
+
+
+class MongoDBUpgradeTest(unittest.TestCase):
+    @patch('charms.layer.mongodb.service_start')
+    @patch('charms.layer.mongodb.service_stop')
+    @patch('charms.layer.mongodb.apt_install')
+    @patch.object(mongodb.MongoDB32, 'command')
+    @patch.object(mongodb.MongoDB32, 'configure')
+    @patch.object(mongodb.MongoDB32, 'prepare')
+    def test_upgrade(self, mprep, mconf, mcmd, mapt, mstop, mstart):
+        mcmd.return_value = {'ok': 1}
+        manager = MagicMock()
+        for name, m in (('prepare', mprep), ('configure', mconf),
+                        ('command', mcmd), ('apt_install', mapt),
+                        ('stop', mstop), ('start', mstart)):
+            manager.attach_mock(m, name)
+
+        m = mongodb.MongoDB32('upstream', '3.4.1')
+        timings = m.download('3.2.10')
+        self.assertEqual(['prepare', 'download'], list(timings))
+        mstop.assert_not_called()
+        timings = m.upgrade({'port': 27017})
+
+        packages = ['mongodb-org-server=3.4.1', 'mongodb-org-shell=3.4.1',
+                    'mongodb-org-tools=3.4.1', 'mongodb-org-mongos=3.4.1']
+        manager.assert_has_calls([
+            call.prepare(),
+            call.apt_install(packages, mongodb.APT_OPTIONS +
+                             ['--download-only'], fatal=True),
+            call.stop('mongodb'),
+            call.apt_install(packages, mongodb.APT_OPTIONS, fatal=True),
+            call.configure({'port': 27017}),
+            call.start('mongodb'),
+        ])
+        # Raised once every member upgraded, not by each of them
+        mcmd.assert_not_called()
+        self.assertEqual(['stop', 'install', 'start'], list(timings))
+
+    @patch('charms.layer.mongodb.service_start')
+    @patch('charms.layer.mongodb.service_stop')
+    @patch('charms.layer.mongodb.apt_install')
+    @patch.object(mongodb.MongoDB32, 'configure')
+    def test_upgrade_mongos(self, mconf, mapt, mstop, mstart):
+        m = mongodb.MongoDB34('upstream', '3.4.1')
+        timings = m.upgrade({'cluster_role': 'mongos', 'port': 27017})
+
+        mstop.assert_called_once_with('mongos')
+        mapt.assert_called_once_with(m.packages(), mongodb.APT_OPTIONS,
+                                     fatal=True)
+        mconf.assert_not_called()
+        mstart.assert_called_once_with('mongos')
+        self.assertEqual(['stop', 'install', 'start'], list(timings))
+
+    @patch('charms.layer.mongodb.mongodb_client.connection')
+    @patch.object(mongodb.MongoDB, 'command')
+    def test_set_feature_compatibility(self, mcmd, mconn):
+        m = mongodb.MongoDB32('upstream', '3.4.1')
+        self.assertTrue(m.set_feature_compatibility(
+            mongodb.parse_version('3.2.10')))
+        mcmd.assert_not_called()
+
+        fcv = {'setFeatureCompatibilityVersion': '3.4'}
+        mcmd.side_effect = [{'ismaster': True}, {'ok': 1}]
+        self.assertTrue(m.set_feature_compatibility(
+            mongodb.parse_version('3.4.1')))
+        mcmd.assert_called_with(fcv)
+
+        mcmd.side_effect = [{'setName': 'rs0', 'primary': '10.0.0.1:27017'}]
+        mconn.return_value.command.return_value = {'ok': 0}
+        self.assertFalse(m.set_feature_compatibility(
+            mongodb.parse_version('3.4.1')))
+        mconn.assert_called_with('10.0.0.1', 27017)
+        mconn.return_value.command.assert_called_with(fcv)
+
+        mcmd.side_effect = [{'setName': 'rs0'}]
+        self.assertFalse(m.set_feature_compatibility(
+            mongodb.parse_version('3.4.1')))
+
+    @patch('charms.layer.mongodb.service_stop')
+    @patch('charms.layer.mongodb.apt_install')
+    def test_download_unsupported(self, mapt, mstop):
+        m = mongodb.MongoDB32('upstream', '3.2.10')
+        self.assertRaises(mongodb.UnsupportedVersion, m.download, '2.6.1')
+        mapt.assert_not_called()
+        mstop.assert_not_called()
+
 
 class MongoDB20Test(unittest.TestCase):
+    @patch('charms.layer.mongodb.unitdata')
     @patch('charms.layer.mongodb.apt_key')
     @patch.object(mongodb.MongoDB, 'add_upstream')
-    def test_add_upstream(self, mup, mak):
+    def test_add_upstream(self, mup, mak, mkv):
         m = mongodb.MongoDB20('upstream', '2.0.99')
         m.add_upstream()
         mak.assert_called_with('7F0CEB10')
         mup.assert_called_once()
 
-    @patch('charms.layer.mongodb.apt_update')
+    @patch('charms.layer.mongodb.unitdata')
+    @patch('charms.layer.mongodb.apt_update_source')
     @patch.object(mongodb.MongoDB, 'install')
     @patch.object(mongodb.MongoDB20, 'add_upstream')
-    def test_install(self, mup, minstall, mau):
+    def test_install(self, mup, minstall, mau, mkv):
+        mkv.kv.return_value = unitdata.Storage(':memory:')
+        mup.return_value = True
         m = mongodb.MongoDB20('upstream', '2.0.99')
         m.install()
         mup.assert_called_once()
-        mau.assert_called_once()
+        mau.assert_called_once_with(m.upstream_list)
         minstall.assert_called_once()
 
         mup.reset_mock()
         mau.reset_mock()
         minstall.reset_mock()
 
+        mup.return_value = False
+        m.install()
+        mup.assert_called_once()
+        mau.assert_not_called()
+        minstall.assert_called_once()
+
+        mup.reset_mock()
+        minstall.reset_mock()
+
         m = mongodb.MongoDB20('archive')
         m.install()
         mup.assert_not_called()
@@ -257,16 +686,48 @@ class MongoDB20Test(unittest.TestCase):
 
 
 class MongoDB30Test(unittest.TestCase):
-    @patch('charms.layer.mongodb.apt_update')
+    @patch('charms.layer.mongodb.unitdata')
+    @patch('charms.layer.mongodb.apt_update_source')
+    @patch('charms.layer.mongodb._read')
+    def test_refresh_upstream(self, mread, mau, mkv):
+        mkv.kv.return_value = unitdata.Storage(':memory:')
+        mread.return_value = 'deb http://repo.mongodb.org/apt/ubuntu'
+        m = mongodb.MongoDB30('upstream', '3.0.99')
+
+        mau.side_effect = Exception('apt-get update failed')
+        self.assertRaises(Exception, m.refresh_upstream, True)
+
+        # The list is unchanged but was never refreshed
+        mau.side_effect = None
+        m.refresh_upstream(False)
+        mau.assert_called_with(m.upstream_list)
+
+        mau.reset_mock()
+        m.refresh_upstream(False)
+        mau.assert_not_called()
+
+        mread.return_value = 'deb file:///srv/debs ./'
+        m.refresh_upstream(False)
+        mau.assert_called_with(m.upstream_list)
+
+    @patch('charms.layer.mongodb.unitdata')
+    @patch('charms.layer.mongodb.apt_update_source')
     @patch.object(mongodb.MongoDB, 'install')
     @patch.object(mongodb.MongoDB30, 'add_upstream')
-    def test_install(self, mup, minstall, mau):
+    def test_install(self, mup, minstall, mau, mkv):
+        mkv.kv.return_value = unitdata.Storage(':memory:')
+        mup.return_value = True
         m = mongodb.MongoDB30('upstream', '3.0.99')
         m.install()
         mup.assert_called_once()
-        mau.assert_called_once()
+        mau.assert_called_once_with(m.upstream_list)
         minstall.assert_called_once()
 
+        mau.reset_mock()
+        mup.return_value = False
+        m.install()
+        mau.assert_not_called()
+
     @patch('charms.layer.mongodb.os')
     @patch.object(mongodb.MongoDB, 'uninstall')
     def test_uninstall(self, muninstall, mos):
@@ -286,20 +747,402 @@ class MongoDB30Test(unittest.TestCase):
         mos.unlink.assert_called_with(m.upstream_list)
 
 
+class MongoDB30ConfigTest(unittest.TestCase):
+    def setUp(self):
+        p = patch.object(mongodb.MongoDB30, '_read_config', return_value={})
+        p.start()
+        self.addCleanup(p.stop)
+
+    @patch.object(mongodb.MongoDB30, '_render_config')
+    def test_configure(self, mcfg):
+        m = mongodb.MongoDB30('upstream', '3.0.99')
+        m.configure({'dbpath': '/srv/db', 'logpath': '/var/log/m.log',
+                     'port': 9000, 'auth': True, 'noscripting': True,
+                     'replicaset': 'test', 'cpu': True, 'noop': True})
+        mcfg.assert_called_with({
+            'storage': {'dbPath': '/srv/db'},
+            'systemLog': {'path': '/var/log/m.log', 'destination': 'file'},
+            'net': {'port': 9000},
+            'security': {'authorization': 'enabled',
+                         'javascriptEnabled': False},
+            'replication': {'replSetName': 'test'},
+        })
+        self.assertEqual(9000, m.port)
+
+    @patch.object(mongodb.MongoDB30, '_render_config')
+    def test_configure_notablescan(self, mcfg):
+        with open('config.yaml') as f:
+            options = mongodb.yaml.safe_load(f)['options']
+        self.assertIn('notablescan', options)
+        self.assertEqual([], [k for k in mongodb.MongoDB30.yaml_map
+                              if k not in options])
+
+        m = mongodb.MongoDB30('upstream', '3.0.99')
+        changes = m.configure({'notablescan': True})
+        mcfg.assert_called_with({'setParameter': {'notablescan': True}})
+        self.assertEqual({'setParameter.notablescan': True}, changes)
+        self.assertFalse(m.needs_restart(changes))
+
+    @patch.object(mongodb.MongoDB30, '_render_config')
+    def test_configure_cluster_role(self, mcfg):
+        m = mongodb.MongoDB32('upstream', '3.2.99')
+        m.configure({'replicaset': 'cfg', 'cluster_role': 'configsvr',
+                     'storage_engine': 'mmapv1'})
+        mcfg.assert_called_with({
+            'replication': {'replSetName': 'cfg'},
+            'storage': {'engine': 'mmapv1'},
+            'sharding': {'clusterRole': 'configsvr'},
+        })
+
+        self.assertRaises(mongodb.UnsupportedVersion,
+                          mongodb.MongoDB30('upstream', '3.0.99').configure,
+                          {'cluster_role': 'shardsvr'})
+        self.assertRaises(mongodb.UnsupportedVersion,
+                          mongodb.MongoDB26('archive').configure,
+                          {'cluster_role': 'shardsvr'})
+        self.assertRaises(Exception, m.configure, {'cluster_role': 'arbiter'})
+        # mongos never runs as mongod
+        mcfg.reset_mock()
+        self.assertRaises(Exception, m.configure, {'cluster_role': 'mongos'})
+        mcfg.assert_not_called()
+
+    @patch.object(mongodb.MongoDB30, '_render_config')
+    def test_configure_log_reopen(self, mcfg):
+        m = mongodb.MongoDB30('upstream', '3.0.99')
+        m.configure({'logpath': '/var/log/m.log', 'logappend': True})
+        mcfg.assert_called_with({'systemLog': {
+            'path': '/var/log/m.log', 'destination': 'file',
+            'logAppend': True, 'logRotate': 'reopen'}})
+
+    @patch('charms.layer.mongodb.host_memory')
+    @patch.object(mongodb.MongoDB30, '_render_config')
+    def test_configure_wiredtiger(self, mcfg, mmem):
+        mmem.return_value = 16 * mongodb.GB
+        m = mongodb.MongoDB32('upstream', '3.2.99')
+        m.configure({'wiredtiger_collection_compressor': 'zlib',
+                     'wiredtiger_directory_for_indexes': True})
+        mcfg.assert_called_with({'storage': {'wiredTiger': {
+            'engineConfig': {'cacheSizeGB': 7,
+                             'journalCompressor': 'snappy',
+                             'directoryForIndexes': True},
+            'collectionConfig': {'blockCompressor': 'zlib'},
+        }}})
+
+        m.configure({'wiredtiger_cache_size': '2.5'})
+        cfg = mcfg.call_args[0][0]
+        self.assertEqual(2, cfg['storage']['wiredTiger']['engineConfig'][
+            'cacheSizeGB'])
+
+        self.assertRaises(Exception, m.configure,
+                          {'wiredtiger_journal_compressor': 'lz4'})
+
+    @patch.object(mongodb.MongoDB30, '_render_config')
+    def test_configure_engine(self, mcfg):
+        m = mongodb.MongoDB30('upstream', '3.0.99')
+        self.assertEqual({}, m.configure({}))
+        mcfg.assert_not_called()
+        m.configure({'storage_engine': 'wiredTiger',
+                     'wiredtiger_cache_size': '3'})
+        cfg = mcfg.call_args[0][0]
+        self.assertEqual('wiredTiger', cfg['storage']['engine'])
+        self.assertEqual(3, cfg['storage']['wiredTiger']['engineConfig'][
+            'cacheSizeGB'])
+
+    @patch.object(mongodb.MongoDB30, '_render_config')
+    def test_configure_profiling(self, mcfg):
+        m = mongodb.MongoDB30('upstream', '3.0.99')
+        m.configure({'slowms': 250, 'profile': 1})
+        cfg = mcfg.call_args[0][0]
+        self.assertEqual({'slowOpThresholdMs': 250, 'mode': 'slowOp'},
+                         cfg['operationProfiling'])
+        self.assertRaises(Exception, m.configure, {'profile': 3})
+
+    def test_profiling_runtime(self):
+        m = mongodb.MongoDB32('upstream', '3.2.99')
+        self.assertFalse(m.needs_restart(
+            {'operationProfiling.slowOpThresholdMs': 50}))
+        self.assertTrue(m.needs_restart({'operationProfiling.mode': 'all'}))
+        with patch.object(mongodb.MongoDB, 'command') as mcmd:
+            mcmd.return_value = {'ok': 1}
+            m.apply_runtime({'operationProfiling.slowOpThresholdMs': 50})
+            mcmd.assert_called_with({'profile': -1, 'slowms': 50})
+
+    @patch.object(mongodb.MongoDB, 'command')
+    def test_resize_oplog(self, mcmd):
+        mcmd.return_value = {'ok': 1}
+        mongodb.MongoDB32('upstream', '3.6.2').resize_oplog(2048)
+        mcmd.assert_called_with({'replSetResizeOplog': 1, 'size': 2048.0})
+
+        mcmd.return_value = {'ok': 0, 'errmsg': 'only WiredTiger'}
+        self.assertRaises(IOError, mongodb.MongoDB32('upstream', '4.0.1')
+                          .resize_oplog, 2048)
+        self.assertRaises(mongodb.UnsupportedVersion,
+                          mongodb.MongoDB32('upstream', '3.4.9').resize_oplog,
+                          2048)
+
+    @patch('charms.layer.mongodb.host_memory')
+    @patch('charms.layer.mongodb.host_cpus')
+    @patch.object(mongodb.MongoDB30, '_render_config')
+    def test_configure_concurrency(self, mcfg, mcpus, mmem):
+        mcpus.return_value = 64
+        mmem.return_value = 64 * mongodb.GB
+        config = {k: 'auto' for k in mongodb.CONCURRENCY}
+        config['storage_engine'] = 'wiredTiger'
+
+        mongodb.MongoDB32('upstream', '4.0.3').configure(config)
+        cfg = mcfg.call_args[0][0]
+        self.assertEqual({'wiredTigerConcurrentReadTransactions': 256,
+                          'wiredTigerConcurrentWriteTransactions': 128,
+                          'taskExecutorPoolSize': 8}, cfg['setParameter'])
+        self.assertEqual(32768, cfg['net']['maxIncomingConnections'])
+        self.assertEqual('adaptive', cfg['net']['serviceExecutor'])
+
+        # auto leaves out what the series or engine does not support
+        mongodb.MongoDB32('upstream', '5.0.1').configure(
+            dict(config, storage_engine='inMemory'))
+        cfg = mcfg.call_args[0][0]
+        self.assertEqual({'taskExecutorPoolSize': 8}, cfg['setParameter'])
+        self.assertNotIn('serviceExecutor', cfg['net'])
+
+        m = mongodb.MongoDB32('upstream', '5.0.1')
+        self.assertRaises(mongodb.UnsupportedVersion, m.configure,
+                          {'service_executor': 'adaptive'})
+        self.assertRaises(Exception, mongodb.MongoDB32(
+            'upstream', '4.0.3').configure, {'service_executor': 'fast'})
+
+        mongodb.MongoDB32('upstream', '3.2.9').configure(
+            {'wiredtiger_read_transactions': '512',
+             'max_incoming_connections': '2000'})
+        cfg = mcfg.call_args[0][0]
+        self.assertEqual(512, cfg['setParameter'][
+            'wiredTigerConcurrentReadTransactions'])
+        self.assertEqual(2000, cfg['net']['maxIncomingConnections'])
+
+    def test_concurrency_runtime(self):
+        m = mongodb.MongoDB32('upstream', '3.2.99')
+        read = 'setParameter.wiredTigerConcurrentReadTransactions'
+        self.assertFalse(m.needs_restart({read: 256}))
+        self.assertTrue(m.needs_restart({read: None}))
+        self.assertTrue(m.needs_restart({'net.maxIncomingConnections': 10}))
+        with patch.object(mongodb.MongoDB, 'command') as mcmd:
+            mcmd.return_value = {'ok': 1}
+            m.apply_runtime({read: 256})
+            mcmd.assert_called_with(
+                {'setParameter': 1,
+                 'wiredTigerConcurrentReadTransactions': 256})
+
+    def test_cache_size_gb(self):
+        m = mongodb.MongoDB30('upstream', '3.0.99')
+        self.assertEqual(1, m.cache_size_gb(2 * mongodb.GB))
+        self.assertEqual(31, m.cache_size_gb(64 * mongodb.GB))
+        m.fractional_cache_size = True
+        self.assertEqual(0.25, m.cache_size_gb(mongodb.GB))
+        self.assertEqual(1.5, m.cache_size_gb(4 * mongodb.GB))
+
+    def test_runtime_parameters(self):
+        m = mongodb.MongoDB32('upstream', '3.2.99')
+        changes = {'setParameter.notablescan': True,
+                   'storage.wiredTiger.engineConfig.cacheSizeGB': 7}
+        self.assertFalse(m.needs_restart(changes))
+        self.assertTrue(m.needs_restart({'net.port': 1}))
+        self.assertTrue(m.needs_restart(
+            {'storage.wiredTiger.engineConfig.cacheSizeGB': None}))
+        with patch.object(mongodb.MongoDB, 'command') as mcmd:
+            mcmd.return_value = {'ok': 1}
+            m.apply_runtime(changes)
+            mcmd.assert_has_calls([
+                call({'setParameter': 1, 'notablescan': True}),
+                call({'setParameter': 1,
+                      'wiredTigerEngineRuntimeConfig': 'cache_size=7168M'}),
+            ])
+
+    @patch('builtins.open')
+    def test_render_config(self, mopen):
+        m = mongodb.MongoDB30('upstream', '3.0.99')
+        m._render_config({'storage': {'dbPath': '/srv/db'},
+                          'net': {'port': 27017}})
+        mopen.assert_called_with(m.config_file, 'w')
+        w = mopen.return_value.__enter__.return_value.write
+        w.assert_called_with('net:\n  port: 27017\nstorage:\n'
+                             '  dbPath: /srv/db\n')
+
+
+class LogrotateTest(unittest.TestCase):
+    config = {'logpath': '/var/log/mongodb/mongodb.log',
+              'logrotate-frequency': 'daily', 'logrotate-rotate': 5,
+              'logrotate-maxsize': '500M'}
+
+    def test_policy_reopen(self):
+        policy = mongodb.logrotate_policy(self.config, '10.0.0.1', 27018)
+        self.assertTrue(policy.startswith('# Managed by juju'))
+        self.assertIn('/var/log/mongodb/mongodb.log {\n    daily\n'
+                      '    rotate 5\n', policy)
+        for line in ('maxsize 500M', 'compress', 'delaycompress',
+                     'nocreate', 'postrotate'):
+            self.assertIn('\n    {}\n'.format(line), policy)
+        self.assertIn('--host 10.0.0.1 --port 27018 --eval '
+                      '"db.adminCommand({logRotate: 1})"', policy)
+        self.assertIn('|| /usr/bin/pkill -USR1 -x mongod', policy)
+        self.assertNotIn('copytruncate', policy)
+
+    def test_policy_legacy(self):
+        config = dict(self.config, **{'logrotate-compress': False})
+        policy = mongodb.logrotate_policy(config, '127.0.0.1', 27017, False)
+        self.assertIn('\n    copytruncate\n', policy)
+        self.assertNotIn('compress', policy)
+        self.assertNotIn('postrotate', policy)
+
+    def test_policy_frequency(self):
+        config = dict(self.config, **{'logrotate-frequency': 'fortnightly'})
+        self.assertRaises(Exception, mongodb.logrotate_policy, config,
+                          '127.0.0.1', 27017)
+
+    def test_logrotate(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        m = mongodb.MongoDB30('upstream', '3.0.99')
+        m.logrotate_file = os.path.join(tmp, 'logrotate')
+        m.logrotate_cron = os.path.join(tmp, 'cron')
+        config = dict(self.config, logappend=True)
+
+        self.assertTrue(m.logrotate(config))
+        with open(m.logrotate_file) as f:
+            self.assertIn('nocreate', f.read())
+        with open(m.logrotate_cron) as f:
+            self.assertIn('/usr/sbin/logrotate {}\n'.format(
+                m.logrotate_file), f.read())
+        self.assertFalse(m.logrotate(config))
+
+        # mongod only reopens its log when appending to it
+        config['logappend'] = False
+        self.assertTrue(m.logrotate(config))
+        with open(m.logrotate_file) as f:
+            self.assertIn('copytruncate', f.read())
+
+
+class MongoDB30ReadConfigTest(unittest.TestCase):
+    @patch('charms.layer.mongodb._read')
+    def test_read_config(self, mread):
+        m = mongodb.MongoDB30('upstream', '3.0.99')
+        mread.return_value = 'net:\n  port: 27017\n'
+        self.assertEqual({'net': {'port': 27017}}, m._read_config())
+        mread.return_value = 'dbpath = /var/lib/mongodb\nport = 27017'
+        self.assertEqual({}, m._read_config())
+        mread.return_value = 'net: [\n'
+        self.assertEqual({}, m._read_config())
+        mread.return_value = None
+        self.assertEqual({}, m._read_config())
+
+
+class HostMemoryTest(unittest.TestCase):
+    @patch('charms.layer.mongodb._read')
+    def test_host_memory(self, mread):
+        files = {
+            mongodb.MEMINFO: 'MemTotal:       16318784 kB\nMemFree: 1 kB\n',
+            mongodb.CGROUP_MEMORY_LIMITS[0]: 'max\n',
+            mongodb.CGROUP_MEMORY_LIMITS[1]: '9223372036854771712\n',
+        }
+        mread.side_effect = files.get
+        self.assertEqual(16318784 * 1024, mongodb.host_memory())
+
+        files[mongodb.CGROUP_MEMORY_LIMITS[0]] = '4294967296\n'
+        self.assertEqual(4 * mongodb.GB, mongodb.host_memory())
+
+        mread.side_effect = lambda p: None
+        self.assertRaises(Exception, mongodb.host_memory)
+
+    @patch('os.sched_getaffinity', create=True)
+    @patch('charms.layer.mongodb._read')
+    def test_host_cpus(self, mread, maffinity):
+        maffinity.return_value = set(range(64))
+        files = {mongodb.CGROUP_CPU_MAX: 'max 100000\n'}
+        mread.side_effect = files.get
+        self.assertEqual(64, mongodb.host_cpus())
+
+        files[mongodb.CGROUP_CPU_MAX] = '800000 100000\n'
+        self.assertEqual(8, mongodb.host_cpus())
+
+        files = {mongodb.CGROUP_CPU_QUOTA[0]: '50000',
+                 mongodb.CGROUP_CPU_QUOTA[1]: '100000'}
+        mread.side_effect = files.get
+        self.assertEqual(1, mongodb.host_cpus())
+
+
 class MongoDB32Test(unittest.TestCase):
+    @patch('charms.layer.mongodb.unitdata')
     @patch('charms.layer.mongodb.apt_key')
     @patch.object(mongodb.MongoDB, 'add_upstream')
-    def test_add_upstream(self, mup, mak):
+    def test_add_upstream(self, mup, mak, mkv):
         m = mongodb.MongoDB32('upstream', '3.2.99')
         m.add_upstream()
         mak.assert_called_with('EA312927')
         mup.assert_called_once()
 
+    @patch('charms.layer.mongodb.unitdata')
+    @patch('charms.layer.mongodb.apt_key')
+    @patch.object(mongodb.MongoDB, 'add_upstream')
+    def test_add_upstream_later_series(self, mup, mak, mkv):
+        for cls, key, series in ((mongodb.MongoDB34, 'A15703C6', '3.4'),
+                                 (mongodb.MongoDB36, '91FA4AD5', '3.6')):
+            m = cls('upstream', series + '.1')
+            m.add_upstream()
+            mak.assert_called_with(key)
+            self.assertIn('/mongodb-org/{} '.format(series), m.upstream_repo)
+            self.assertTrue(m.fractional_cache_size)
+
+
+class MongosTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.m = mongodb.MongoDB32('upstream', '3.2.99')
+        self.m.mongos_config_file = os.path.join(tmp, 'mongos.conf')
+        self.m.mongos_unit_file = os.path.join(tmp, 'mongos.service')
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    @patch('charms.layer.mongodb.subprocess.check_call')
+    def test_configure_mongos(self, mcall):
+        config = {'bind_ip': '0.0.0.0', 'port': 27017, 'dbpath': '/srv/db',
+                  'logpath': '/var/log/mongodb/mongos.log'}
+        self.assertTrue(self.m.configure_mongos(config, 'cfg/a:1,b:1'))
+
+        self.assertEqual({
+            'net': {'bindIp': '0.0.0.0', 'port': 27017},
+            'systemLog': {'path': '/var/log/mongodb/mongos.log',
+                          'destination': 'file'},
+            'sharding': {'configDB': 'cfg/a:1,b:1'},
+        }, mongodb.yaml.safe_load(self.read(self.m.mongos_config_file)))
+        self.assertIn('ExecStart=/usr/bin/mongos --config {}\n'.format(
+            self.m.mongos_config_file), self.read(self.m.mongos_unit_file))
+        mcall.assert_has_calls([call(['systemctl', 'daemon-reload']),
+                                call(['systemctl', 'enable', 'mongos'])])
+
+        # mongos tracks config server members itself once it has a seed
+        mcall.reset_mock()
+        self.assertFalse(self.m.configure_mongos(config, 'cfg/a:1,b:1,c:1'))
+        self.assertTrue(self.m.configure_mongos(config, 'other/c:1'))
+        mcall.assert_not_called()
+
+    def test_mongos_packages(self):
+        self.assertIn('mongodb-org-mongos=3.2.10',
+                      mongodb.MongoDB32('upstream', '3.2.10').packages())
+        self.assertNotIn('mongodb-org-mongos={}',
+                         mongodb.MongoDB30.package_map['upstream'])
+
+    def test_configure_mongos_unsupported(self):
+        self.assertRaises(mongodb.UnsupportedVersion,
+                          mongodb.MongoDB30('upstream', '3.0.99')
+                          .configure_mongos, {}, 'cfg/a:1')
+
 
 class MongoDBZSeriesTest(unittest.TestCase):
+    @patch('charms.layer.mongodb.unitdata')
     @patch('charms.layer.mongodb.lsb_release')
     @patch.object(mongodb.MongoDB32, '__init__')
-    def test_init(self, minit, lsb):
+    def test_init(self, minit, lsb, mkv):
         lsb.return_value = {'DISTRIB_RELEASE': '16.04'}
         mongodb.MongoDBzSeries('archive')
         minit.assert_called_once()
@@ -311,10 +1154,11 @@ class MongoDBZSeriesTest(unittest.TestCase):
         self.assertRaises(Exception, mongodb.MongoDBzSeries, 'archive')
         minit.assert_not_called()
 
+    @patch('charms.layer.mongodb.unitdata')
     @patch('charms.layer.mongodb.apt_key')
     @patch('charms.layer.mongodb.lsb_release')
     @patch.object(mongodb.MongoDB32, 'add_upstream')
-    def test_add_upstream(self, mup, lsb, mak):
+    def test_add_upstream(self, mup, lsb, mak, mkv):
         lsb.return_value = {'DISTRIB_RELEASE': '16.04'}
         m = mongodb.MongoDBzSeries('archive')
         m.add_upstream()
@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+sys.path.append('lib')
+
+from charms.layer import mongodb_backup  # noqa: E402
+from charms.layer.mongodb_bson import Timestamp  # noqa: E402
+
+
+def rs_status(me=2):
+    return {'ok': 1, 'members': [
+        {'_id': 0, 'state': 1, 'health': 1, 'self': me == 0,
+         'optime': {'ts': Timestamp(1500, 3), 't': 2}},
+        {'_id': 1, 'state': 8, 'health': 0, 'self': me == 1},
+        {'_id': 2, 'state': 2, 'health': 1, 'self': me == 2,
+         'optime': {'ts': Timestamp(1500, 1), 't': 2}},
+        {'_id': 3, 'state': 2, 'health': 1, 'self': me == 3,
+         'optime': {'ts': Timestamp(1400, 1), 't': 2}},
+    ]}
+
+
+def fake_dump(args):
+    for a in args:
+        if a.startswith('--archive='):
+            open(a[len('--archive='):], 'w').close()
+    if '--out' in args:
+        os.mkdir(args[args.index('--out') + 1])
+
+
+class BackupTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def touch(self, *names):
+        for n in names:
+            open(os.path.join(self.dir, n), 'w').close()
+
+    def test_source(self):
+        self.assertEqual(2, mongodb_backup.source(rs_status())['_id'])
+        alone = {'ok': 1, 'members': rs_status()['members'][:2]}
+        self.assertEqual(0, mongodb_backup.source(alone)['_id'])
+        self.assertIsNone(mongodb_backup.source(
+            {'ok': 0, 'errmsg': 'not running with --replSet'}))
+
+    def test_optime(self):
+        self.assertEqual(Timestamp(1500, 1),
+                         mongodb_backup.optime(rs_status()['members'][2]))
+        self.assertEqual((7, 1),
+                         mongodb_backup.optime({'optime': Timestamp(7, 1)}))
+
+    def test_oplog_query(self):
+        self.assertEqual({'ts': {'$gt': {'$timestamp': {'t': 1, 'i': 2}},
+                                 '$lte': {'$timestamp': {'t': 3, 'i': 4}}}},
+                         json.loads(mongodb_backup.oplog_query((1, 2),
+                                                               (3, 4))))
+
+    def test_prune(self):
+        self.touch('full-20160101T030000Z.archive.gz',
+                   'oplog-20160101T040000Z.archive.gz',
+                   'full-20160102T030000Z.archive.gz',
+                   'oplog-20160102T040000Z.archive.gz',
+                   'full-20160103T030000Z.archive.gz',
+                   'full-20160104T030000Z.archive.gz.partial',
+                   'state.json')
+        removed = mongodb_backup.prune(self.dir, 2)
+        self.assertEqual(['full-20160101T030000Z.archive.gz',
+                          'oplog-20160101T040000Z.archive.gz'], removed)
+        self.assertEqual(['full-20160102T030000Z.archive.gz',
+                          'full-20160103T030000Z.archive.gz',
+                          'oplog-20160102T040000Z.archive.gz',
+                          'state.json'], sorted(os.listdir(self.dir)))
+
+    @patch('charms.layer.mongodb_backup.subprocess.check_call')
+    @patch('charms.layer.mongodb_backup.mongodb_client.connection')
+    def test_full_on_secondary(self, mconn, mcall):
+        mconn.return_value.command.return_value = rs_status(me=2)
+        mcall.side_effect = fake_dump
+        self.touch('full-20160101T030000Z.archive.gz')
+
+        path = mongodb_backup.backup('full', self.dir, port=27018, keep=1,
+                                     parallel=8)
+
+        args = mcall.call_args[0][0]
+        self.assertEqual(['mongodump', '--host', '127.0.0.1', '--port',
+                          '27018', '--numParallelCollections=8', '--oplog',
+                          '--archive={}.partial'.format(path), '--gzip'],
+                         args)
+        self.assertEqual([os.path.basename(path), 'state.json'],
+                         sorted(n for n in os.listdir(self.dir)
+                                if not n.startswith('.')))
+        with open(os.path.join(self.dir, 'state.json')) as f:
+            self.assertEqual({'ts': [1500, 1]}, json.load(f))
+
+    @patch('charms.layer.mongodb_backup.subprocess.check_call')
+    @patch('charms.layer.mongodb_backup.mongodb_client.connection')
+    def test_other_members_skip(self, mconn, mcall):
+        for me in (0, 3):
+            mconn.return_value.command.return_value = rs_status(me=me)
+            self.assertIsNone(mongodb_backup.backup('full', self.dir))
+        mcall.assert_not_called()
+
+    @patch('charms.layer.mongodb_backup.subprocess.check_call')
+    @patch('charms.layer.mongodb_backup.mongodb_client.connection')
+    def test_standalone_directory(self, mconn, mcall):
+        mconn.return_value.command.return_value = {'ok': 0}
+        mcall.side_effect = fake_dump
+
+        path = mongodb_backup.backup('full', self.dir, archive=False)
+
+        self.assertEqual(['mongodump', '--host', '127.0.0.1', '--port',
+                          '27017', '--out', path + '.partial'],
+                         mcall.call_args[0][0])
+        self.assertTrue(os.path.isdir(path))
+        self.assertIsNone(mongodb_backup.backup('oplog', self.dir))
+
+    @patch('charms.layer.mongodb_backup.subprocess.check_call')
+    @patch('charms.layer.mongodb_backup.mongodb_client.connection')
+    def test_oplog_slice(self, mconn, mcall):
+        mconn.return_value.command.return_value = rs_status(me=2)
+        mcall.side_effect = fake_dump
+        # Nothing to continue from before the first full backup
+        self.assertIsNone(mongodb_backup.backup('oplog', self.dir))
+
+        with open(os.path.join(self.dir, 'state.json'), 'w') as f:
+            json.dump({'ts': [1400, 5]}, f)
+        path = mongodb_backup.backup('oplog', self.dir)
+
+        args = mcall.call_args[0][0]
+        self.assertTrue(os.path.basename(path).startswith('oplog-'))
+        self.assertEqual(['--db', 'local', '--collection', 'oplog.rs',
+                          '--query',
+                          mongodb_backup.oplog_query((1400, 5), (1500, 1))],
+                         args[5:11])
+        with open(os.path.join(self.dir, 'state.json')) as f:
+            self.assertEqual({'ts': [1500, 1]}, json.load(f))
+
+    def test_cron(self):
+        config = {'backup_directory': '/srv/backups', 'port': 27017,
+                  'backup_copies_kept': 7, 'backup_parallel_collections': 4,
+                  'backup_schedule': '0 3 * * *', 'backup_oplog_interval': 15}
+        entries = mongodb_backup.cron(config, '10.0.0.1', False,
+                                      '/var/lib/juju/charm', '/usr/bin/py3')
+        command = ('root cd /var/lib/juju/charm && PYTHONPATH=lib '
+                   '/usr/bin/py3 -m charms.layer.mongodb_backup {} '
+                   '--directory /srv/backups --host 10.0.0.1 --port 27017 '
+                   '--keep 7 --parallel 4 --no-archive')
+        self.assertEqual(['0 3 * * * ' + command.format('full'),
+                          '*/15 * * * * ' + command.format('oplog')],
+                         entries.splitlines()[1:])
+
+        config['backup_oplog_interval'] = 0
+        self.assertEqual(2, len(mongodb_backup.cron(config, 'h').splitlines()))
+
+    def test_schedule(self):
+        cron_file = os.path.join(self.dir, 'mongodb-backup')
+        config = {'backups_enabled': True, 'backup_schedule': '0 3 * * *'}
+        with patch.object(mongodb_backup, 'CRON_FILE', cron_file):
+            self.assertTrue(mongodb_backup.schedule(config, '127.0.0.1'))
+            self.assertTrue(os.path.exists(cron_file))
+
+            config['backups_enabled'] = False
+            self.assertFalse(mongodb_backup.schedule(config, '127.0.0.1'))
+            self.assertFalse(os.path.exists(cron_file))
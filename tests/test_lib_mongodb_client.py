@@ -0,0 +1,191 @@
+import sys
+import struct
+import datetime
+import unittest
+from collections import OrderedDict
+from mock import patch
+
+sys.path.append('lib')
+
+from charms.layer import mongodb_bson as bson  # noqa: E402
+from charms.layer import mongodb_client  # noqa: E402
+
+
+class FakeSocket(object):
+    """Answers every request with the next canned reply document"""
+
+    def __init__(self, replies, opcode=mongodb_client.OP_REPLY):
+        self.replies = list(replies)
+        self.opcode = opcode
+        self.sent = []
+        self.buf = b''
+        self.closed = False
+
+    def settimeout(self, t):
+        pass
+
+    def sendall(self, data):
+        self.sent.append(data)
+        request_id = struct.unpack_from('<i', data, 4)[0]
+        reply = self.replies.pop(0)
+        # None answers a query that found nothing
+        doc = bson.encode(reply) if reply is not None else b''
+        if self.opcode == mongodb_client.OP_REPLY:
+            body = struct.pack('<iqii', 0, 0, 0, int(bool(doc))) + doc
+        else:
+            body = struct.pack('<I', 0) + b'\x00' + doc
+        self.buf += struct.pack('<iiii', 16 + len(body), 99, request_id,
+                                self.opcode) + body
+
+    def recv_into(self, view):
+        n = min(len(view), len(self.buf))
+        view[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+    def close(self):
+        self.closed = True
+
+
+class BSONTest(unittest.TestCase):
+    def test_roundtrip(self):
+        when = datetime.datetime(2016, 6, 26, 17, 41, 9,
+                                 tzinfo=datetime.timezone.utc)
+        doc = {
+            'str': 'value',
+            'int': 1,
+            'long': 2 ** 40,
+            'float': 1.5,
+            'bool': True,
+            'none': None,
+            'date': when,
+            'ts': bson.Timestamp(1466903785, 1),
+            'oid': bson.ObjectId('507f1f77bcf86cd799439011'),
+            'bin': bson.Binary(4, b'\x01\x02'),
+            'list': [1, 'two', {'three': 3}],
+            'doc': {'nested': {'deep': 'yes'}},
+        }
+        self.assertEqual(doc, bson.decode(bson.encode(doc))[0])
+
+    def test_key_order(self):
+        doc = OrderedDict([('replSetGetStatus', 1), ('a', 2)])
+        self.assertEqual(b'replSetGetStatus', bson.encode(doc)[5:21])
+
+    def test_malformed(self):
+        self.assertRaises(bson.BSONError, bson.decode, b'\x05\x00\x00')
+        self.assertRaises(bson.BSONError, bson.decode,
+                          b'\x06\x00\x00\x00\x00\x01')
+        self.assertRaises(bson.BSONError, bson.encode, {'bad': object()})
+
+
+class ConnectionTest(unittest.TestCase):
+    def tearDown(self):
+        mongodb_client.close_all()
+
+    @patch('charms.layer.mongodb_client.socket.create_connection')
+    def test_op_query(self, mcc):
+        sock = FakeSocket([{'ismaster': True, 'maxWireVersion': 4},
+                           {'ok': 1.0, 'set': 'myset'}])
+        mcc.return_value = sock
+        conn = mongodb_client.Connection('127.0.0.1', 27017)
+        self.assertEqual({'ok': 1.0, 'set': 'myset'},
+                         conn.command({'replSetGetStatus': 1}))
+        mcc.assert_called_with(('127.0.0.1', 27017), 10.0)
+        opcode = struct.unpack_from('<i', sock.sent[1], 12)[0]
+        self.assertEqual(mongodb_client.OP_QUERY, opcode)
+        self.assertIn(b'admin.$cmd\x00', sock.sent[1])
+
+    @patch('charms.layer.mongodb_client.socket.create_connection')
+    def test_op_msg(self, mcc):
+        sock = FakeSocket([{'ismaster': True, 'maxWireVersion': 6}])
+        mcc.return_value = sock
+        conn = mongodb_client.Connection()
+        conn.connect()
+        sock.opcode = mongodb_client.OP_MSG
+        sock.replies.append({'ok': 1.0})
+        self.assertEqual({'ok': 1.0}, conn.command({'ping': 1}))
+        opcode = struct.unpack_from('<i', sock.sent[1], 12)[0]
+        self.assertEqual(mongodb_client.OP_MSG, opcode)
+        sent = bson.decode(sock.sent[1], 21)[0]
+        self.assertEqual('admin', sent['$db'])
+
+    @patch('charms.layer.mongodb_client.socket.create_connection')
+    def test_reconnect(self, mcc):
+        dead = FakeSocket([{'ismaster': True}])
+        dead.recv_into = lambda view: 0
+        alive = FakeSocket([{'ismaster': True}, {'ok': 1.0}])
+        mcc.side_effect = [dead, alive]
+        conn = mongodb_client.Connection()
+        self.assertEqual({'ok': 1.0}, conn.command({'ping': 1}))
+        self.assertTrue(dead.closed)
+
+    @patch('charms.layer.mongodb_client.socket.create_connection')
+    def test_no_resend(self, mcc):
+        sock = FakeSocket([{'ismaster': True}, {'ok': 1.0}])
+        mcc.return_value = sock
+        conn = mongodb_client.Connection()
+        conn.connect()
+        # The reply is lost after the command was sent
+        sock.recv_into = lambda view: 0
+        self.assertRaises(mongodb_client.ConnectionFailure, conn.command,
+                          {'replSetStepDown': 60})
+        self.assertEqual(2, len(sock.sent))
+        self.assertEqual(1, mcc.call_count)
+        self.assertTrue(sock.closed)
+
+    @patch('charms.layer.mongodb_client.socket.create_connection')
+    def test_resend_unsent(self, mcc):
+        stale = FakeSocket([{'ismaster': True}])
+        alive = FakeSocket([{'ismaster': True}, {'ok': 1.0}])
+        mcc.side_effect = [stale, alive]
+        conn = mongodb_client.Connection()
+        conn.connect()
+
+        def reset(data):
+            raise ConnectionResetError('connection reset by peer')
+        stale.sendall = reset
+        self.assertEqual({'ok': 1.0}, conn.command({'fsync': 1}))
+        self.assertEqual(2, len(alive.sent))
+
+    @patch('charms.layer.mongodb_client.socket.create_connection')
+    def test_connection_failure(self, mcc):
+        mcc.side_effect = OSError('refused')
+        conn = mongodb_client.Connection()
+        self.assertRaises(mongodb_client.ConnectionFailure, conn.command,
+                          {'ping': 1})
+        self.assertEqual(2, mcc.call_count)
+
+    @patch('charms.layer.mongodb_client.socket.create_connection')
+    def test_find_one_op_query(self, mcc):
+        ts = bson.Timestamp(10, 1)
+        sock = FakeSocket([{'ismaster': True, 'maxWireVersion': 2},
+                           {'ts': ts}, None])
+        mcc.return_value = sock
+        conn = mongodb_client.Connection()
+        self.assertEqual({'ts': ts}, conn.find_one(
+            'oplog.rs', 'local', sort={'$natural': 1}, projection={'ts': 1}))
+        self.assertIn(b'local.oplog.rs\x00', sock.sent[1])
+        query, end = bson.decode(sock.sent[1], 43)
+        self.assertEqual({'$query': {}, '$orderby': {'$natural': 1}}, query)
+        self.assertEqual({'ts': 1}, bson.decode(sock.sent[1], end)[0])
+
+        self.assertIsNone(conn.find_one('oplog.rs', 'local'))
+
+    @patch('charms.layer.mongodb_client.socket.create_connection')
+    def test_find_one_command(self, mcc):
+        ts = bson.Timestamp(10, 1)
+        sock = FakeSocket([
+            {'ismaster': True, 'maxWireVersion': 4},
+            {'ok': 1.0, 'cursor': {'firstBatch': [{'ts': ts}]}},
+            {'ok': 0.0, 'errmsg': 'not authorized'}])
+        mcc.return_value = sock
+        conn = mongodb_client.Connection()
+        self.assertEqual({'ts': ts}, conn.find_one(
+            'oplog.rs', 'local', sort={'$natural': -1}))
+        self.assertIn(b'local.$cmd\x00', sock.sent[1])
+        self.assertRaises(IOError, conn.find_one, 'oplog.rs', 'local')
+
+    def test_pool(self):
+        a = mongodb_client.connection('127.0.0.1', 27017)
+        self.assertIs(a, mongodb_client.connection('127.0.0.1', '27017'))
+        self.assertIsNot(a, mongodb_client.connection('127.0.0.1', 27018))
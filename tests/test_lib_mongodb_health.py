@@ -0,0 +1,94 @@
+import sys
+import time
+import socket
+import struct
+import threading
+import unittest
+
+sys.path.append('lib')
+
+from charms.layer import mongodb_bson as bson  # noqa: E402
+from charms.layer import mongodb_client  # noqa: E402
+from charms.layer import mongodb_health  # noqa: E402
+
+
+class FakeServer(threading.Thread):
+    """Listens on a free port and answers OP_QUERY with canned replies"""
+
+    def __init__(self, replies, silent=False):
+        super(FakeServer, self).__init__()
+        self.daemon = True
+        self.replies = replies
+        self.silent = silent
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+        self.start()
+
+    def run(self):
+        conn, _ = self.sock.accept()
+        with conn:
+            for reply in self.replies:
+                header = conn.recv(16, socket.MSG_WAITALL)
+                if len(header) < 16:
+                    return
+                size, request_id, _, _ = struct.unpack('<iiii', header)
+                conn.recv(size - 16, socket.MSG_WAITALL)
+                if self.silent:
+                    time.sleep(1)
+                    return
+                body = struct.pack('<iqii', 0, 0, 0, 1) + bson.encode(reply)
+                conn.sendall(struct.pack('<iiii', 16 + len(body), 1,
+                                         request_id,
+                                         mongodb_client.OP_REPLY) + body)
+
+    def close(self):
+        self.sock.close()
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class HealthTest(unittest.TestCase):
+    def test_state(self):
+        self.assertEqual('mongos', mongodb_health.state({'msg': 'isdbgrid'}))
+        self.assertEqual('standalone', mongodb_health.state({'ismaster': 1}))
+        rs = {'setName': 'myset'}
+        self.assertEqual('primary', mongodb_health.state(
+            dict(rs, ismaster=True)))
+        self.assertEqual('secondary', mongodb_health.state(
+            dict(rs, secondary=True)))
+        self.assertEqual('arbiter', mongodb_health.state(
+            dict(rs, arbiterOnly=True)))
+        self.assertEqual('recovering', mongodb_health.state(rs))
+
+    def test_probe(self):
+        primary = FakeServer([{'ismaster': True, 'setName': 'myset',
+                               'maxWireVersion': 4, 'ok': 1}, {'ok': 1}])
+        wedged = FakeServer([{'ok': 1}], silent=True)
+        refused = free_port()
+        self.addCleanup(primary.close)
+        self.addCleanup(wedged.close)
+
+        start = time.monotonic()
+        health = mongodb_health.probe([('127.0.0.1', primary.port),
+                                       ('127.0.0.1', wedged.port),
+                                       ('127.0.0.1', refused)], timeout=0.5)
+        self.assertLess(time.monotonic() - start, 0.9)
+
+        self.assertEqual([True, False, False], [h.ok for h in health])
+        self.assertEqual('primary', health[0].state)
+        self.assertGreaterEqual(health[0].latency, 0)
+        self.assertIsNone(health[0].error)
+        self.assertEqual('timed out', health[1].error)
+        self.assertEqual(refused, health[2].port)
+        self.assertTrue(health[2].error)
+
+    def test_probe_nothing(self):
+        self.assertEqual([], mongodb_health.probe([]))
@@ -0,0 +1,174 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+sys.path.append('lib')
+
+from charmhelpers.core import unitdata  # noqa: E402
+
+from charms.layer import mongodb_log  # noqa: E402
+
+
+TEXT = [
+    b'2019-03-01T10:00:00.000+0000 I NETWORK  [listener] connection '
+    b'accepted from 10.0.0.2:51234 #12 (3 connections now open)',
+    b'2019-03-01T10:00:01.000+0000 I COMMAND  [conn12] command app.users '
+    b'command: find { find: "users", filter: { age: 3 } } '
+    b'planSummary: COLLSCAN docsExamined:90000 protocol:op_msg 412ms',
+    b'2019-03-01T10:00:02.000+0000 I REPL     [replexec-3] transition to '
+    b'PRIMARY from SECONDARY',
+    b'2019-03-01T10:00:03.000+0000 W NETWORK  [conn12] Unable to reach '
+    b'10.0.0.3:27017',
+    b'2019-03-01T10:00:04.000+0000 E STORAGE  [conn12] Assertion: 28595:'
+    b'No such file or directory',
+    b'2019-03-01T10:00:05.000+0000 I COMMAND  [conn12] command app.users '
+    b'command: find { find: "users" } with 12ms in the query',
+]
+
+JSON = [
+    b'{"t":{"$date":"2021-03-01T10:00:00.000+00:00"},"s":"I",  '
+    b'"c":"NETWORK",  "id":22943,   "ctx":"listener","msg":"Connection '
+    b'accepted","attr":{"remote":"10.0.0.2:51234","connectionCount":3}}',
+    b'{"t":{"$date":"2021-03-01T10:00:01.000+00:00"},"s":"I",  '
+    b'"c":"COMMAND",  "id":51803,   "ctx":"conn12","msg":"Slow query",'
+    b'"attr":{"ns":"app.users","durationMillis":412}}',
+    b'{"t":{"$date":"2021-03-01T10:00:02.000+00:00"},"s":"I",  '
+    b'"c":"REPL",     "id":21358,   "ctx":"ReplCoord-0","msg":"Replica set '
+    b'state transition","attr":{"newState":"PRIMARY",'
+    b'"oldState":"SECONDARY"}}',
+    b'{"t":{"$date":"2021-03-01T10:00:03.000+00:00"},"s":"I",  '
+    b'"c":"REPL",     "id":21358,   "ctx":"ReplCoord-0","msg":"Replica set '
+    b'state transition","attr":{"newState":"SECONDARY",'
+    b'"oldState":"PRIMARY"}}',
+    b'{"t":{"$date":"2021-03-01T10:00:04.000+00:00"},"s":"E",  '
+    b'"c":"ASSERT",   "id":23077,   "ctx":"conn12","msg":"Assertion",'
+    b'"attr":{"error":"NotWritablePrimary: not primary"}}',
+    b'{"t":{"$date":"2021-03-01T10:00:05.000+00:00"},"s":"W",  '
+    b'"c":"NETWORK",  "id":23019,   "ctx":"conn12","msg":"Said \\"Slow '
+    b'query\\" here"}',
+]
+
+EXPECTED = {'lines': 6, 'errors': 1, 'warnings': 1, 'slow_queries': 1,
+            'elections': 1, 'assertions': 1, 'connections': 1}
+
+
+def counted(lines):
+    counters = mongodb_log.new_counters()
+    for line in lines:
+        mongodb_log.count(line, counters)
+    return dict(counters)
+
+
+class CountTest(unittest.TestCase):
+    def test_text(self):
+        self.assertEqual(EXPECTED, counted(TEXT))
+
+    def test_json(self):
+        self.assertEqual(EXPECTED, counted(JSON))
+
+    def test_before_severities(self):
+        self.assertEqual(
+            dict(mongodb_log.new_counters(), lines=1, connections=1),
+            counted([b'Fri Mar  1 10:00:00.000 [initandlisten] connection '
+                     b'accepted from 127.0.0.1:51234 #1']))
+
+
+class ScanTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'mongodb.log')
+        self.append(TEXT[:1])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def append(self, lines, path=None, partial=b''):
+        with open(path or self.path, 'ab') as f:
+            f.write(b''.join(line + b'\n' for line in lines) + partial)
+
+    def test_starts_at_the_end(self):
+        counters, checkpoint = mongodb_log.scan(self.path)
+        self.assertEqual(0, counters['lines'])
+        self.assertEqual(os.path.getsize(self.path), checkpoint['offset'])
+        self.assertEqual(os.stat(self.path).st_ino, checkpoint['inode'])
+
+    def test_reads_new_lines(self):
+        _, checkpoint = mongodb_log.scan(self.path)
+        self.append(TEXT[1:3], partial=b'2019-03-01T10:00:05.000+0000 I')
+
+        counters, checkpoint = mongodb_log.scan(self.path, checkpoint)
+        self.assertEqual(2, counters['lines'])
+        self.assertEqual(1, counters['slow_queries'])
+        # The partial line is left for the next scan
+        self.assertEqual(os.path.getsize(self.path) - 30,
+                         checkpoint['offset'])
+
+        self.append([b' REPL     [replexec-3] transition to PRIMARY'])
+        counters, _ = mongodb_log.scan(self.path, checkpoint)
+        self.assertEqual(1, counters['lines'])
+        self.assertEqual(1, counters['elections'])
+
+    def test_mmap(self):
+        _, checkpoint = mongodb_log.scan(self.path)
+        self.append(TEXT * 20)
+        with patch.object(mongodb_log, 'MMAP_THRESHOLD', 1024):
+            with patch('charms.layer.mongodb_log.mmap.mmap',
+                       wraps=mongodb_log.mmap.mmap) as m:
+                counters, checkpoint = mongodb_log.scan(self.path, checkpoint)
+        self.assertTrue(m.called)
+        self.assertEqual(120, counters['lines'])
+        self.assertEqual(20, counters['slow_queries'])
+        self.assertEqual(os.path.getsize(self.path), checkpoint['offset'])
+
+    def test_limit(self):
+        _, checkpoint = mongodb_log.scan(self.path)
+        self.append(TEXT)
+        counters, checkpoint = mongodb_log.scan(
+            self.path, checkpoint, limit=len(TEXT[1]) + 10)
+        self.assertEqual(1, counters['lines'])
+        counters, _ = mongodb_log.scan(self.path, checkpoint)
+        self.assertEqual(5, counters['lines'])
+
+    def test_rotated(self):
+        _, checkpoint = mongodb_log.scan(self.path)
+        self.append(TEXT[1:2])
+        os.rename(self.path, self.path + mongodb_log.ROTATED)
+        self.append(TEXT[2:3])
+
+        counters, checkpoint = mongodb_log.scan(self.path, checkpoint)
+        self.assertEqual(2, counters['lines'])
+        self.assertEqual(1, counters['slow_queries'])
+        self.assertEqual(1, counters['elections'])
+        self.assertEqual(os.stat(self.path).st_ino, checkpoint['inode'])
+        self.assertEqual(os.path.getsize(self.path), checkpoint['offset'])
+
+    def test_truncated(self):
+        self.append(TEXT[1:])
+        _, checkpoint = mongodb_log.scan(self.path)
+        with open(self.path, 'wb'):
+            pass
+        self.append(TEXT[3:4])
+
+        counters, _ = mongodb_log.scan(self.path, checkpoint)
+        self.assertEqual(1, counters['lines'])
+        self.assertEqual(1, counters['warnings'])
+
+    def test_missing(self):
+        counters, checkpoint = mongodb_log.scan(
+            os.path.join(self.dir, 'missing.log'), {'inode': 1, 'offset': 5})
+        self.assertEqual(0, counters['lines'])
+        self.assertEqual({'inode': 1, 'offset': 5}, checkpoint)
+
+    @patch('charms.layer.mongodb_log.unitdata')
+    def test_ingest(self, mkv):
+        mkv.kv.return_value = unitdata.Storage(':memory:')
+        self.assertEqual(0, mongodb_log.ingest(self.path)['lines'])
+        self.append(TEXT[1:])
+
+        self.assertEqual(5, mongodb_log.ingest(self.path)['lines'])
+        self.assertEqual(1, mongodb_log.stored()['assertions'])
+        self.assertIsNotNone(
+            mkv.kv().get(mongodb_log.COUNTERS_KEY)['seconds'])
@@ -0,0 +1,130 @@
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+from mock import patch, MagicMock
+
+sys.path.append('lib')
+
+from charmhelpers.core import unitdata  # noqa: E402
+from charms.layer import mongodb_metrics  # noqa: E402
+
+
+def server_status(ops=0, faults=0):
+    return {
+        'opcounters': {'insert': ops, 'query': ops, 'update': 0,
+                       'delete': 0, 'getmore': 0, 'command': ops},
+        'extra_info': {'page_faults': faults},
+        'connections': {'current': 12, 'available': 800},
+        'globalLock': {'currentQueue': {'readers': 1, 'writers': 2,
+                                        'total': 3}},
+        'wiredTiger': {'cache': {
+            'maximum bytes configured': 1000,
+            'bytes currently in the cache': 800,
+            'tracked dirty bytes in the cache': 50,
+        }},
+        'ok': 1,
+    }
+
+
+def rs_status(lag):
+    now = datetime.datetime(2016, 6, 26, 17, 41, 9)
+    return {
+        'members': [
+            {'state': 1, 'optimeDate': now},
+            {'state': 2, 'self': True,
+             'optimeDate': now - datetime.timedelta(seconds=lag)},
+        ],
+        'ok': 1,
+    }
+
+
+class MetricsTest(unittest.TestCase):
+    def test_sample(self):
+        s = mongodb_metrics.sample(server_status(5, 2), rs_status(4))
+        self.assertEqual(5, s['counters']['opcounters_insert'])
+        self.assertEqual(2, s['counters']['page_faults'])
+        self.assertEqual({
+            'connections_current': 12,
+            'connections_available': 800,
+            'queue_readers': 1,
+            'queue_writers': 2,
+            'queue_total': 3,
+            'cache_used_ratio': 0.8,
+            'cache_dirty_ratio': 0.05,
+            'replication_lag_seconds': 4.0,
+        }, s['gauges'])
+
+    def test_sample_standalone_mmapv1(self):
+        status = server_status()
+        del status['wiredTiger']
+        s = mongodb_metrics.sample(status, {'ok': 0, 'errmsg': 'no set'})
+        self.assertNotIn('cache_used_ratio', s['gauges'])
+        self.assertNotIn('replication_lag_seconds', s['gauges'])
+
+    def test_replication_lag(self):
+        self.assertIsNone(mongodb_metrics.replication_lag(None))
+        self.assertEqual(0.0, mongodb_metrics.replication_lag(rs_status(-3)))
+        status = rs_status(1)
+        status['members'][0]['state'] = 2
+        self.assertIsNone(mongodb_metrics.replication_lag(status))
+
+    def test_rates(self):
+        prev = {'time': 100.0, 'counters': {'opcounters_insert': 10,
+                                            'opcounters_query': 50,
+                                            'page_faults': 5}}
+        cur = {'time': 110.0, 'counters': {'opcounters_insert': 30,
+                                           'opcounters_query': 40,
+                                           'page_faults': 25}}
+        self.assertEqual({'opcounters_insert': 2.0,
+                          'opcounters_total': 2.0,
+                          'page_faults': 2.0},
+                         mongodb_metrics.rates(prev, cur))
+        self.assertEqual({}, mongodb_metrics.rates(None, cur))
+        self.assertEqual({}, mongodb_metrics.rates(cur, cur))
+
+    @patch('charms.layer.mongodb_metrics.time')
+    @patch('charms.layer.mongodb_metrics.unitdata')
+    def test_collect(self, mkv, mtime):
+        mkv.kv.return_value = unitdata.Storage(':memory:')
+        m = MagicMock()
+        m.command.side_effect = [server_status(0), rs_status(2),
+                                 server_status(600), rs_status(0)]
+        mtime.time.side_effect = [1000.0, 1300.0]
+
+        first = mongodb_metrics.collect(m)
+        self.assertNotIn('opcounters_total', first)
+        self.assertEqual(2.0, first['replication_lag_seconds'])
+
+        second = mongodb_metrics.collect(m)
+        self.assertEqual(6.0, second['opcounters_total'])
+        self.assertEqual(second, mongodb_metrics.stored())
+        m.command.assert_called_with({'replSetGetStatus': 1})
+
+    def test_prometheus(self):
+        self.assertEqual('# TYPE mongodb_a gauge\nmongodb_a 1.0\n'
+                         '# TYPE mongodb_b gauge\nmongodb_b 0.5\n',
+                         mongodb_metrics.prometheus({'b': 0.5, 'a': 1}))
+
+    def test_write_textfile(self):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        path = os.path.join(d, 'node-exporter', 'mongodb.prom')
+        mongodb_metrics.write_textfile(path, {'a': 1})
+        with open(path) as f:
+            self.assertEqual(mongodb_metrics.prometheus({'a': 1}), f.read())
+        self.assertEqual(['mongodb.prom'], os.listdir(os.path.dirname(path)))
+
+    @patch('charms.layer.mongodb_metrics.subprocess')
+    def test_add_metrics(self, msp):
+        mongodb_metrics.add_metrics({'connections_current': 12,
+                                     'opcounters_total': 2.5,
+                                     'queue_readers': 1})
+        msp.check_call.assert_called_with(['add-metric',
+                                           'ops-per-second=2.5',
+                                           'connections=12'])
+        msp.reset_mock()
+        mongodb_metrics.add_metrics({})
+        msp.check_call.assert_not_called()
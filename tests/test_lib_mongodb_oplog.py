@@ -0,0 +1,62 @@
+import sys
+import unittest
+from mock import patch, MagicMock
+
+sys.path.append('lib')
+
+from charmhelpers.core import unitdata  # noqa: E402
+
+from charms.layer import mongodb_oplog  # noqa: E402
+from charms.layer.mongodb_bson import Timestamp  # noqa: E402
+
+MB = mongodb_oplog.MB
+
+
+class OplogTest(unittest.TestCase):
+    def test_stats(self):
+        conn = MagicMock()
+        conn.command.side_effect = [
+            {'ok': 1, 'size': 360 * MB, 'maxSize': 1024 * MB}]
+        conn.find_one.side_effect = [{'ts': Timestamp(0, 1)},
+                                     {'ts': Timestamp(3600, 4)}]
+        oplog = mongodb_oplog.stats(conn)
+        conn.find_one.assert_called_with('oplog.rs', 'local',
+                                         sort={'$natural': -1},
+                                         projection={'ts': 1})
+        self.assertEqual(3600, oplog.window)
+        self.assertEqual(0.1 * MB, oplog.rate)
+        self.assertEqual(1024 * MB, oplog.max_size)
+
+        conn.command.side_effect = [{'ok': 0, 'errmsg': 'ns not found'}]
+        self.assertIsNone(mongodb_oplog.stats(conn))
+
+    def test_rate_without_window(self):
+        oplog = mongodb_oplog.Oplog(100, MB, Timestamp(5, 1), Timestamp(5, 2))
+        self.assertIsNone(oplog.rate)
+
+    @patch('charms.layer.mongodb_oplog.unitdata')
+    def test_sample(self, mkv):
+        mkv.kv.return_value = unitdata.Storage(':memory:')
+        oplog = mongodb_oplog.Oplog(100, MB, Timestamp(0, 1), Timestamp(10, 1))
+        with patch.object(mongodb_oplog, 'MAX_SAMPLES', 2):
+            for _ in range(3):
+                samples = mongodb_oplog.sample(oplog)
+        self.assertEqual([10.0, 10.0], [rate for _, rate in samples])
+
+        idle = mongodb_oplog.Oplog(100, MB, Timestamp(0, 1), Timestamp(0, 1))
+        self.assertEqual(samples, mongodb_oplog.sample(idle))
+
+    def test_recommend(self):
+        # 1MB/s peak for 48h with 20% headroom
+        samples = [[0, 0.5 * MB], [300, 1.0 * MB]]
+        self.assertEqual(207360, mongodb_oplog.recommend(samples, 48))
+        self.assertEqual(mongodb_oplog.MIN_SIZE_MB,
+                         mongodb_oplog.recommend([[0, 1]], 48))
+        self.assertIsNone(mongodb_oplog.recommend(samples, 0))
+        self.assertIsNone(mongodb_oplog.recommend([], 48))
+
+    def test_needs_resize(self):
+        self.assertFalse(mongodb_oplog.needs_resize(1000, 1200))
+        self.assertTrue(mongodb_oplog.needs_resize(1000, 1300))
+        self.assertTrue(mongodb_oplog.needs_resize(4000, 990))
+        self.assertFalse(mongodb_oplog.needs_resize(1000, None))
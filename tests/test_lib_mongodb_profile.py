@@ -0,0 +1,96 @@
+import sys
+import json
+import unittest
+from mock import MagicMock
+
+sys.path.append('lib')
+
+from charms.layer import mongodb_profile  # noqa: E402
+
+
+def find(ns, filter, millis, examined, returned, plan):
+    return {'op': 'query', 'ns': ns, 'millis': millis,
+            'command': {'find': ns.split('.')[1], 'filter': filter},
+            'docsExamined': examined, 'nreturned': returned,
+            'planSummary': plan}
+
+
+class ProfileTest(unittest.TestCase):
+    def test_normalize(self):
+        self.assertEqual(
+            {'a': '?', 'b': {'$in': '?'}, '$or': [{'c': {'$gt': '?'}}]},
+            mongodb_profile.normalize({'b': {'$in': [1, 2, 3]}, 'a': 'x',
+                                       '$or': [{'c': {'$gt': 4}}]}))
+
+    def test_shape(self):
+        self.assertEqual(
+            mongodb_profile.shape(find('db.c', {'a': 1}, 1, 1, 1, '')),
+            mongodb_profile.shape(find('db.c', {'a': 2}, 1, 1, 1, '')))
+        # Legacy opcodes and the find command of 3.2 and 3.4
+        self.assertEqual({'filter': {'a': '?'}, 'sort': {'b': -1}},
+                         json.loads(mongodb_profile.shape({
+                             'op': 'query', 'query': {
+                                 '$query': {'a': 5}, '$orderby': {'b': -1}}})))
+        self.assertEqual({'filter': {'a': '?'}},
+                         json.loads(mongodb_profile.shape({
+                             'op': 'update', 'query': {'a': 5}})))
+        self.assertEqual({'command': 'aggregate',
+                          'pipeline': [{'$match': {'a': '?'}}]},
+                         json.loads(mongodb_profile.shape({
+                             'op': 'command', 'command': {
+                                 'aggregate': 'c',
+                                 'pipeline': [{'$match': {'a': 1}}]}})))
+
+    def test_index_used(self):
+        self.assertTrue(mongodb_profile.index_used('IXSCAN { a: 1 }'))
+        self.assertFalse(mongodb_profile.index_used('COLLSCAN'))
+        self.assertIsNone(mongodb_profile.index_used(None))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, mongodb_profile.percentile(values, 50))
+        self.assertEqual(99, mongodb_profile.percentile(values, 99))
+        self.assertEqual(7, mongodb_profile.percentile([7], 99))
+        self.assertIsNone(mongodb_profile.percentile([], 50))
+
+    def test_aggregate(self):
+        entries = [find('db.users', {'name': n}, 300 + n, 10000, 1,
+                        'COLLSCAN') for n in range(3)]
+        entries += [find('db.users', {'_id': n}, 120, 1, 1, 'IDHACK')
+                    for n in range(2)]
+        entries.append(find('db.other', {'x': 1}, 5, 1, 1, 'IXSCAN { x: 1 }'))
+
+        rows = mongodb_profile.aggregate(entries, top=2)
+        self.assertEqual(2, len(rows))
+        scan = rows[0]
+        self.assertEqual('db.users', scan['ns'])
+        self.assertEqual('{"filter":{"name":"?"}}', scan['shape'])
+        self.assertEqual(3, scan['count'])
+        self.assertEqual(301, scan['p50_ms'])
+        self.assertEqual(302, scan['p99_ms'])
+        self.assertEqual(30000, scan['docs_examined'])
+        self.assertEqual(3, scan['docs_returned'])
+        self.assertFalse(scan['index'])
+        self.assertTrue(rows[1]['index'])
+        self.assertEqual(2, rows[1]['count'])
+
+    def test_entries(self):
+        conn = MagicMock()
+        conn.command.side_effect = [
+            {'ok': 1, 'databases': [{'name': 'app'}, {'name': 'local'}]},
+            {'ok': 1, 'cursor': {'firstBatch': [{'op': 'query'}]}},
+        ]
+        self.assertEqual([{'op': 'query'}], mongodb_profile.entries(conn))
+        spec, db = conn.command.call_args[0]
+        self.assertEqual('app', db)
+        self.assertEqual(['find', 'sort', 'limit', 'singleBatch'],
+                         list(spec))
+
+        conn.command.side_effect = [{'ok': 0, 'errmsg': 'no such cmd'}]
+        self.assertRaises(IOError, mongodb_profile.entries, conn, ['app'])
+
+    def test_results(self):
+        rows = mongodb_profile.aggregate([find('db.c', {}, 1, 1, 1, None)])
+        shape = mongodb_profile.results(rows)['shape-1']
+        self.assertEqual('unknown', shape['index'])
+        self.assertEqual('1', shape['p99-ms'])
@@ -0,0 +1,195 @@
+import sys
+import unittest
+from mock import patch
+
+sys.path.append('lib')
+
+from charms.layer import mongodb_replicaset as rs  # noqa: E402
+
+
+def hosts(n):
+    return ['10.0.0.{}:27017'.format(i) for i in range(1, n + 1)]
+
+
+def votes(cfg):
+    return [(m['host'], m['votes'], m['priority']) for m in cfg['members']]
+
+
+class ReplicaSetPlanTest(unittest.TestCase):
+    def test_voters(self):
+        self.assertEqual([0, 1, 1, 3, 3, 5, 5, 7, 7, 7],
+                         [rs.voters(n) for n in range(10)])
+
+    def test_initiate(self):
+        cfg = rs.plan('myset', hosts(3))
+        self.assertEqual('myset', cfg['_id'])
+        self.assertEqual(1, cfg['version'])
+        self.assertEqual([0, 1, 2], [m['_id'] for m in cfg['members']])
+        self.assertEqual([1, 1, 1], [m['votes'] for m in cfg['members']])
+
+    def test_configsvr(self):
+        cfg = rs.plan('cfg', hosts(3), configsvr=True)
+        self.assertTrue(cfg['configsvr'])
+        self.assertTrue(rs.plan('cfg', hosts(4), cfg)['configsvr'])
+        self.assertNotIn('configsvr', rs.plan('myset', hosts(1)))
+
+    def test_unchanged(self):
+        cfg = rs.plan('myset', hosts(3))
+        self.assertIsNone(rs.plan('myset', hosts(3), cfg))
+
+    def test_scale_out_in_one_reconfig(self):
+        current = rs.plan('myset', hosts(3))
+        current['settings'] = {'heartbeatTimeoutSecs': 10}
+        cfg = rs.plan('myset', hosts(7), current, '10.0.0.2:27017')
+
+        self.assertEqual(2, cfg['version'])
+        self.assertEqual({'heartbeatTimeoutSecs': 10}, cfg['settings'])
+        self.assertEqual(list(range(7)), [m['_id'] for m in cfg['members']])
+        self.assertEqual(7, sum(m['votes'] for m in cfg['members']))
+        # Nothing about the existing members changes
+        self.assertEqual(current['members'], cfg['members'][:3])
+
+    def test_even_members(self):
+        cfg = rs.plan('myset', hosts(4))
+        self.assertEqual([('10.0.0.1:27017', 1, 1), ('10.0.0.2:27017', 1, 1),
+                          ('10.0.0.3:27017', 1, 1), ('10.0.0.4:27017', 0, 0)],
+                         votes(cfg))
+
+    def test_beyond_voting_limit(self):
+        cfg = rs.plan('myset', hosts(9))
+        self.assertEqual(7, sum(m['votes'] for m in cfg['members']))
+        self.assertEqual([0, 0], [m['priority'] for m in cfg['members'][7:]])
+
+    def test_scale_in_keeps_primary_voting(self):
+        current = rs.plan('myset', hosts(3))
+        current['members'][2]['priority'] = 5
+        cfg = rs.plan('myset', hosts(3)[1:], current, '10.0.0.3:27017')
+
+        self.assertEqual([1, 2], [m['_id'] for m in cfg['members']])
+        self.assertEqual([('10.0.0.2:27017', 0, 0), ('10.0.0.3:27017', 1, 5)],
+                         votes(cfg))
+
+    def test_new_ids_after_removal(self):
+        current = rs.plan('myset', hosts(3))
+        cfg = rs.plan('myset', hosts(2) + ['10.0.0.9:27017'], current)
+        self.assertEqual([0, 1, 3], [m['_id'] for m in cfg['members']])
+
+    def test_too_many(self):
+        self.assertRaises(ValueError, rs.plan, 'myset', hosts(51))
+
+    def test_parse_roles(self):
+        roles = rs.parse_roles('mongodb/3: analytics\n'
+                               '4: {role: delayed, delay: 3600}\n'
+                               'mongodb/5: {tags: {dc: east}}\n')
+        self.assertEqual({3: {'role': 'analytics', 'delay': 0, 'tags': {}},
+                          4: {'role': 'delayed', 'delay': 3600, 'tags': {}},
+                          5: {'role': None, 'delay': 0,
+                              'tags': {'dc': 'east'}}}, roles)
+        self.assertEqual({}, rs.parse_roles(''))
+
+        for bad in ('mongodb/1: arbiter', 'mongodb/1: delayed',
+                    'mongodb/1: {role: hidden, delay: 60}',
+                    '- mongodb/1', 'mongodb/1: {tags: east}', '{'):
+            self.assertRaises(ValueError, rs.parse_roles, bad)
+
+    def test_plan_roles(self):
+        roles = rs.parse_roles('mongodb/2: {role: hidden, tags: {dc: b}}\n'
+                               'mongodb/4: analytics\n'
+                               'mongodb/5: {role: delayed, delay: 600}')
+        roles = {'10.0.0.{}:27017'.format(u): r for u, r in roles.items()}
+        cfg = rs.plan('myset', hosts(5), roles=roles)
+
+        self.assertEqual([('10.0.0.1:27017', 1, 1), ('10.0.0.2:27017', 1, 0),
+                          ('10.0.0.3:27017', 1, 1), ('10.0.0.4:27017', 0, 0),
+                          ('10.0.0.5:27017', 0, 0)], votes(cfg))
+        m = cfg['members']
+        self.assertEqual({'nodeType': 'ELECTABLE'}, m[0]['tags'])
+        self.assertEqual((True, {'dc': 'b'}), (m[1]['hidden'], m[1]['tags']))
+        self.assertEqual({'nodeType': 'ANALYTICS'}, m[3]['tags'])
+        self.assertEqual((True, 600), (m[4]['hidden'], m[4]['slaveDelay']))
+        self.assertIsNone(rs.plan('myset', hosts(5), cfg, roles=roles))
+
+        # Dropping the roles turns them back into ordinary members
+        cfg = rs.plan('myset', hosts(5), cfg)
+        self.assertEqual([1, 1, 1, 1, 1], [m['votes'] for m in cfg['members']])
+        self.assertEqual([1, 1, 1, 1, 1],
+                         [m['priority'] for m in cfg['members']])
+        m = cfg['members']
+        self.assertEqual((False, {}), (m[1]['hidden'], m[1]['tags']))
+        self.assertEqual((False, 0), (m[4]['hidden'], m[4]['slaveDelay']))
+
+        delayed = {'10.0.0.1:27017': roles['10.0.0.5:27017']}
+        cfg = rs.plan('myset', hosts(2), roles=delayed)
+        self.assertEqual(600, cfg['members'][0]['slaveDelay'])
+        self.assertRaises(ValueError, rs.plan, 'myset', hosts(1),
+                          roles=delayed)
+
+    def test_client_settings_roles(self):
+        roles = {'10.0.0.4:27017': {'role': 'analytics'},
+                 '10.0.0.5:27017': {'role': 'hidden'}}
+        settings = rs.client_settings(hosts(5), 'myset', roles=roles)
+        self.assertEqual('10.0.0.1:27017,10.0.0.2:27017,10.0.0.3:27017,'
+                         '10.0.0.4:27017', settings['hosts'])
+        self.assertIn('readPreference=secondaryPreferred&readPreferenceTags='
+                      'nodeType%3AELECTABLE&w=majority', settings['uri'])
+        self.assertEqual('mongodb://10.0.0.1:27017,10.0.0.2:27017,'
+                         '10.0.0.3:27017,10.0.0.4:27017/?replicaSet=myset'
+                         '&readPreference=secondary&readPreferenceTags='
+                         'nodeType%3AANALYTICS&w=majority&maxPoolSize=100',
+                         settings['analytics_uri'])
+        self.assertEqual('', rs.client_settings(hosts(3))['analytics_uri'])
+
+    def test_client_settings(self):
+        settings = rs.client_settings(hosts(3), 'myset', clients=4)
+        self.assertEqual('10.0.0.1:27017,10.0.0.2:27017,10.0.0.3:27017',
+                         settings['hosts'])
+        self.assertEqual('secondaryPreferred', settings['read_preference'])
+        self.assertEqual('majority', settings['write_concern'])
+        self.assertEqual(100, settings['max_pool_size'])
+        self.assertEqual('mongodb://10.0.0.1:27017,10.0.0.2:27017,'
+                         '10.0.0.3:27017/?replicaSet=myset&readPreference='
+                         'secondaryPreferred&w=majority&maxPoolSize=100',
+                         settings['uri'])
+
+    def test_client_settings_sizes(self):
+        single = rs.client_settings(hosts(1))
+        self.assertEqual('', single['replset'])
+        self.assertEqual('primary', single['read_preference'])
+        self.assertEqual('1', single['write_concern'])
+        self.assertEqual('mongodb://10.0.0.1:27017/?readPreference=primary'
+                         '&w=1&maxPoolSize=100', single['uri'])
+
+        pair = rs.client_settings(hosts(2), 'myset', clients=50)
+        self.assertEqual('primaryPreferred', pair['read_preference'])
+        self.assertEqual(40, pair['max_pool_size'])
+        self.assertEqual(5, rs.client_settings(hosts(1), 'myset',
+                                               clients=1000)['max_pool_size'])
+
+    @patch('charms.layer.mongodb_replicaset.hookenv')
+    def test_members(self, mhookenv):
+        mhookenv.local_unit.return_value = 'mongodb/2'
+        mhookenv.relation_ids.return_value = ['replica-set:0']
+        mhookenv.related_units.return_value = ['mongodb/10', 'mongodb/1',
+                                               'mongodb/3']
+        published = {'mongodb/10': '10.0.0.10:27017',
+                     'mongodb/1': '10.0.0.1:27017'}
+        mhookenv.relation_get.side_effect = (
+            lambda key, unit, rid: published.get(unit))
+
+        self.assertEqual(['10.0.0.1:27017', '10.0.0.2:27017',
+                          '10.0.0.10:27017'],
+                         rs.members('10.0.0.2:27017'))
+        mhookenv.relation_ids.assert_called_with('replica-set')
+
+        published.update({'mongodb/10': '3.4.1', 'mongodb/1': '3.2.10'})
+        self.assertEqual({'mongodb/2': '3.4.2', 'mongodb/10': '3.4.1',
+                          'mongodb/1': '3.2.10', 'mongodb/3': None},
+                         rs.versions('3.4.2'))
+
+        published.update({'mongodb/10': '10.0.0.10:27017',
+                          'mongodb/1': '10.0.0.1:27017'})
+        spec = {2: {'role': 'hidden'}, 10: {'role': 'analytics'},
+                3: {'role': 'hidden'}}
+        self.assertEqual({'10.0.0.2:27017': {'role': 'hidden'},
+                          '10.0.0.10:27017': {'role': 'analytics'}},
+                         rs.roles('10.0.0.2:27017', spec))
@@ -0,0 +1,165 @@
+import sys
+import unittest
+from mock import patch, MagicMock
+
+sys.path.append('lib')
+
+from charms.layer import mongodb_restart  # noqa: E402
+from charms.layer.mongodb_bson import Timestamp  # noqa: E402
+from charms.layer.mongodb_client import ConnectionFailure  # noqa: E402
+
+
+def member(state, seconds, health=1):
+    return {'state': state, 'health': health,
+            'optime': {'ts': Timestamp(seconds, 1), 't': 3}}
+
+
+def status(*members):
+    return {'ok': 1, 'members': list(members)}
+
+
+class TurnTest(unittest.TestCase):
+    def setUp(self):
+        p = patch('charms.layer.mongodb_restart.hookenv')
+        self.hookenv = p.start()
+        self.addCleanup(p.stop)
+        self.relation = {'mongodb/0': None, 'mongodb/1': None,
+                         'mongodb/2': None}
+        self.leader = {}
+        self.hookenv.local_unit.return_value = 'mongodb/0'
+        self.hookenv.relation_ids.return_value = ['replica-set:1']
+        self.hookenv.related_units.return_value = ['mongodb/1', 'mongodb/2']
+        self.hookenv.relation_get.side_effect = (
+            lambda key, unit, rid: self.relation[unit])
+        self.hookenv.relation_set.side_effect = self.relation_set
+        self.hookenv.leader_get.side_effect = self.leader.get
+        self.hookenv.leader_set.side_effect = self.leader.update
+
+    def relation_set(self, rid, settings):
+        self.relation['mongodb/0'] = settings[mongodb_restart.REQUEST]
+
+    def test_grant(self):
+        self.relation.update({'mongodb/1': '20.5', 'mongodb/2': '10.5'})
+        self.assertEqual('mongodb/2', mongodb_restart.grant())
+        self.assertEqual({mongodb_restart.TURN: 'mongodb/2'}, self.leader)
+
+        # The turn stays with its holder until it is given back
+        self.relation['mongodb/1'] = '5.5'
+        self.assertEqual('mongodb/2', mongodb_restart.grant())
+
+        self.relation['mongodb/2'] = None
+        self.assertEqual('mongodb/1', mongodb_restart.grant())
+
+        self.relation['mongodb/1'] = None
+        self.assertIsNone(mongodb_restart.grant())
+        self.assertEqual({mongodb_restart.TURN: None}, self.leader)
+
+    def test_take_turn(self):
+        self.relation['mongodb/1'] = '10.5'
+        self.leader[mongodb_restart.TURN] = 'mongodb/1'
+
+        self.assertFalse(mongodb_restart.take_turn(True))
+        self.assertIsNotNone(self.relation['mongodb/0'])
+
+        self.relation['mongodb/1'] = None
+        self.assertTrue(mongodb_restart.take_turn(True))
+
+        mongodb_restart.release(True)
+        self.assertIsNone(self.relation['mongodb/0'])
+        self.assertEqual({mongodb_restart.TURN: None}, self.leader)
+
+    def test_take_turn_not_leader(self):
+        self.assertFalse(mongodb_restart.take_turn(False))
+        self.hookenv.leader_set.assert_not_called()
+
+    def test_take_turn_without_peers(self):
+        self.hookenv.relation_ids.return_value = []
+        self.assertTrue(mongodb_restart.take_turn(False))
+        self.hookenv.relation_set.assert_not_called()
+
+
+@patch('charms.layer.mongodb_restart.time.sleep')
+class StepDownTest(unittest.TestCase):
+    def conn(self, *statuses, **kwargs):
+        conn = MagicMock()
+        hello = [{'ismaster': True}, {'ismaster': kwargs.get('after')}]
+        replies = list(statuses)
+
+        def command(spec):
+            if 'isMaster' in spec:
+                return hello.pop(0)
+            if 'replSetGetStatus' in spec:
+                return replies.pop(0)
+            return kwargs.get('step_down', {'ok': 1})
+        conn.command.side_effect = command
+        return conn
+
+    def test_step_down(self, msleep):
+        conn = self.conn(
+            status(member(1, 100), member(2, 70), member(2, 95, health=0)),
+            status(member(1, 100), member(2, 95)))
+
+        self.assertTrue(mongodb_restart.step_down(conn, 10, 60))
+
+        self.assertEqual(1, msleep.call_count)
+        spec = conn.command.call_args[0][0]
+        self.assertEqual(['replSetStepDown', 'secondaryCatchUpPeriodSecs'],
+                         list(spec))
+        self.assertEqual(10, spec['secondaryCatchUpPeriodSecs'])
+
+    def test_not_primary(self, msleep):
+        conn = MagicMock()
+        conn.command.return_value = {'ismaster': False, 'secondary': True}
+        self.assertFalse(mongodb_restart.step_down(conn, 10, 60))
+
+        conn = self.conn(status(member(1, 100)))
+        self.assertFalse(mongodb_restart.step_down(conn, 10, 60))
+
+    def test_lagging(self, msleep):
+        conn = self.conn(*[status(member(1, 100), member(2, 50))] * 3)
+        with patch('charms.layer.mongodb_restart.time.monotonic') as mt:
+            mt.side_effect = [0, 30, 61]
+            with self.assertRaises(IOError) as e:
+                mongodb_restart.step_down(conn, 10, 60)
+        self.assertIn('50s behind', str(e.exception))
+
+    def test_connection_closed(self, msleep):
+        conn = self.conn(status(member(1, 100), member(2, 100)),
+                         step_down={'ok': 0, 'errmsg': 'not primary'},
+                         after=False)
+        self.assertTrue(mongodb_restart.step_down(conn, 10, 60))
+
+        conn = self.conn(status(member(1, 100), member(2, 100)), after=True)
+        conn.command.side_effect = [
+            {'ismaster': True}, status(member(1, 100), member(2, 100)),
+            ConnectionFailure('connection closed by server'),
+            {'ismaster': True}]
+        with self.assertRaises(IOError):
+            mongodb_restart.step_down(conn, 10, 60)
+
+
+@patch('charms.layer.mongodb_restart.time.sleep')
+@patch('charms.layer.mongodb_restart.mongodb_client')
+class WaitServingTest(unittest.TestCase):
+    def test_wait_serving(self, mclient, msleep):
+        command = mclient.connection.return_value.command
+        command.side_effect = [IOError('connection refused'),
+                               {'ok': 1, 'myState': 5},
+                               {'ok': 1, 'myState': 2}]
+        mongodb_restart.wait_serving('127.0.0.1', 27017, 60)
+        self.assertEqual(2, msleep.call_count)
+
+        command.side_effect = None
+        command.return_value = {'ok': 0, 'code': 94,
+                                'errmsg': 'no replset config has been '
+                                          'received'}
+        mongodb_restart.wait_serving('127.0.0.1', 27017, 60)
+
+    def test_timeout(self, mclient, msleep):
+        command = mclient.connection.return_value.command
+        command.return_value = {'ok': 1, 'myState': 3}
+        with patch('charms.layer.mongodb_restart.time.monotonic') as mt:
+            mt.side_effect = [0, 30, 61]
+            with self.assertRaises(IOError) as e:
+                mongodb_restart.wait_serving('127.0.0.1', 27017, 60)
+        self.assertEqual('not serving after 60s: state 3', str(e.exception))
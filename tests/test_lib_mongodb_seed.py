@@ -0,0 +1,122 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from mock import patch, MagicMock, call
+
+sys.path.append('lib')
+
+from charms.layer import mongodb_seed  # noqa: E402
+from charms.layer.mongodb_bson import Timestamp  # noqa: E402
+
+
+def rs_status(state=2):
+    return {'ok': 1, 'set': 'rs0', 'members': [
+        {'_id': 0, 'state': 1, 'optime': {'ts': Timestamp(9000, 1)}},
+        {'_id': 1, 'state': state, 'self': True,
+         'optime': {'ts': Timestamp(8000, 4), 't': 1}},
+    ]}
+
+
+class SeedTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_check(self):
+        meta = {'replset': 'rs0', 'optime': [8000, 4]}
+        mongodb_seed.check(meta, 'rs0', Timestamp(4000, 1))
+        self.assertRaises(mongodb_seed.StaleSnapshot, mongodb_seed.check,
+                          meta, 'rs1', Timestamp(4000, 1))
+        self.assertRaises(mongodb_seed.StaleSnapshot, mongodb_seed.check,
+                          meta, 'rs0', Timestamp(7000, 1))
+
+    def test_oplog_start(self):
+        conn = MagicMock()
+        conn.find_one.return_value = {'ts': Timestamp(10, 1)}
+        self.assertEqual(Timestamp(10, 1), mongodb_seed.oplog_start(conn))
+        conn.find_one.assert_called_with('oplog.rs', 'local',
+                                         sort={'$natural': 1},
+                                         projection={'ts': 1})
+
+        conn.find_one.return_value = None
+        self.assertRaises(IOError, mongodb_seed.oplog_start, conn)
+
+    @patch('charms.layer.mongodb_seed.subprocess')
+    def test_take(self, msp):
+        conn = MagicMock(max_wire_version=4)
+        conn.command.side_effect = [rs_status(), {'ok': 1}, rs_status(),
+                                    {'ok': 1}]
+        msp.check_call.side_effect = lambda args: open(args[2], 'w').close()
+
+        path = mongodb_seed.take(conn, '/srv/db', self.dir)
+
+        self.assertTrue(path.endswith('.tar.gz'))
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual({'replset': 'rs0', 'optime': [8000, 4],
+                          'taken': mongodb_seed.metadata(path)['taken']},
+                         mongodb_seed.metadata(path))
+        self.assertEqual(call({'fsyncUnlock': 1}), conn.command.call_args)
+
+    @patch('charms.layer.mongodb_seed.subprocess')
+    def test_take_unlocks(self, msp):
+        conn = MagicMock(max_wire_version=4)
+        conn.command.side_effect = [rs_status(), {'ok': 1}, rs_status(),
+                                    {'ok': 1}]
+        msp.check_call.side_effect = OSError('disk full')
+
+        self.assertRaises(OSError, mongodb_seed.take, conn, '/srv/db',
+                          self.dir)
+        self.assertEqual(call({'fsyncUnlock': 1}), conn.command.call_args)
+
+        conn.command.side_effect = [rs_status(state=1)]
+        self.assertRaises(IOError, mongodb_seed.take, conn, '/srv/db',
+                          self.dir)
+
+    def test_unlock(self):
+        conn = MagicMock(max_wire_version=4)
+        conn.command.side_effect = [{'ok': 1, 'lockCount': 2},
+                                    {'ok': 1, 'lockCount': 1},
+                                    {'ok': 1, 'lockCount': 0}]
+        mongodb_seed.unlock(conn)
+        self.assertEqual(3, conn.command.call_count)
+
+        # Before 3.4 the reply has no lockCount
+        conn.command.reset_mock()
+        conn.command.side_effect = [{'ok': 1, 'info': 'unlock completed'}]
+        mongodb_seed.unlock(conn)
+        self.assertEqual(1, conn.command.call_count)
+
+    def test_unlock_before_3_2(self):
+        conn = MagicMock(max_wire_version=3)
+        conn.find_one.return_value = {'ok': 1, 'info': 'unlock completed'}
+        mongodb_seed.unlock(conn)
+        conn.find_one.assert_called_once_with('$cmd.sys.unlock', 'admin')
+        conn.command.assert_not_called()
+
+    def test_take_lost_lock_reply(self):
+        conn = MagicMock(max_wire_version=4)
+        conn.command.side_effect = [
+            rs_status(), IOError('connection closed by server'),
+            {'ok': 1, 'lockCount': 0}]
+        self.assertRaises(IOError, mongodb_seed.take, conn, '/srv/db',
+                          self.dir)
+        self.assertEqual(call({'fsyncUnlock': 1}), conn.command.call_args)
+
+    @patch('charms.layer.mongodb_seed.subprocess')
+    def test_restore(self, msp):
+        dbpath = os.path.join(self.dir, 'db')
+        os.mkdir(dbpath)
+        open(os.path.join(dbpath, 'WiredTiger'), 'w').close()
+
+        mongodb_seed.restore('/srv/snap.tar.gz', dbpath)
+
+        self.assertEqual([], os.listdir(dbpath))
+        aside = [n for n in os.listdir(self.dir) if n.startswith('db.pre')]
+        self.assertEqual(['WiredTiger'],
+                         os.listdir(os.path.join(self.dir, aside[0])))
+        msp.check_call.assert_has_calls([
+            call(['tar', '-xzf', '/srv/snap.tar.gz', '-C', dbpath]),
+            call(['chown', '-R', 'mongodb:mongodb', dbpath]),
+        ])
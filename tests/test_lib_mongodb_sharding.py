@@ -0,0 +1,57 @@
+import sys
+import unittest
+from mock import patch, MagicMock, call
+
+sys.path.append('lib')
+
+from charms.layer import mongodb_sharding as sharding  # noqa: E402
+
+
+class ShardingTest(unittest.TestCase):
+    def related(self, mhookenv, data):
+        mhookenv.relation_ids.side_effect = lambda r: sorted(data)
+        mhookenv.related_units.side_effect = lambda rid: sorted(data[rid])
+        mhookenv.relation_get.side_effect = (
+            lambda unit, rid: data[rid][unit])
+
+    @patch('charms.layer.mongodb_sharding.hookenv')
+    def test_replica_sets(self, mhookenv):
+        self.related(mhookenv, {
+            'shard:1': {'a/0': {'replset': 'rs1', 'member': 'a0:27017'},
+                        'a/1': {'replset': 'rs1', 'member': 'a1:27017'},
+                        'a/2': {}},
+            'shard:2': {'b/0': {'replset': 'rs2', 'member': 'b0:27017'}},
+        })
+        self.assertEqual({'rs1': ['a0:27017', 'a1:27017'],
+                          'rs2': ['b0:27017']},
+                         sharding.replica_sets('shards'))
+
+    @patch('charms.layer.mongodb_sharding.hookenv')
+    def test_config_db(self, mhookenv):
+        self.related(mhookenv, {})
+        self.assertIsNone(sharding.config_db())
+
+        self.related(mhookenv, {'config-server:3': {
+            'c/1': {'replset': 'cfg', 'member': 'c1:27019'},
+            'c/0': {'replset': 'cfg', 'member': 'c0:27019'}}})
+        self.assertEqual('cfg/c0:27019,c1:27019', sharding.config_db())
+        mhookenv.relation_ids.assert_called_with('config-server')
+
+    def test_add_shards(self):
+        m = MagicMock()
+        m.command.side_effect = [
+            {'ok': 1, 'shards': [{'_id': 'rs1', 'host': 'rs1/a0:27017'}]},
+            {'ok': 1, 'shardAdded': 'rs2'},
+        ]
+        added = sharding.add_shards(m, {'rs1': ['a0:27017'],
+                                        'rs2': ['b0:27017', 'b1:27017']})
+        self.assertEqual(['rs2'], added)
+        m.command.assert_has_calls([
+            call({'listShards': 1}),
+            call({'addShard': 'rs2/b0:27017,b1:27017', 'name': 'rs2'}),
+        ])
+        self.assertEqual('addShard', list(m.command.call_args[0][0])[0])
+
+        m.command.side_effect = [{'ok': 1, 'shards': []},
+                                 {'ok': 0, 'errmsg': 'not a replica set'}]
+        self.assertRaises(IOError, sharding.add_shards, m, {'rs3': ['c:1']})
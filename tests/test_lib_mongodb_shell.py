@@ -0,0 +1,92 @@
+import os
+import sys
+import datetime
+import decimal
+import unittest
+
+sys.path.append('lib')
+
+from charms.layer import mongodb_bson as bson  # noqa: E402
+from charms.layer import mongodb_shell  # noqa: E402
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks', 'data')
+UTC = datetime.timezone.utc
+
+
+class ShellDecodeTest(unittest.TestCase):
+    def check(self, out, expected):
+        self.assertEqual(expected, mongodb_shell.loads(out))
+        if isinstance(out, bytes):
+            out = out.decode('utf-8')
+        # The exact parser must agree with the fast path
+        self.assertEqual(expected, mongodb_shell._decode(out))
+
+    def test_helpers(self):
+        out = '''{
+            "date" : ISODate("2016-06-26T17:41:09.214Z"),
+            "optime" : Timestamp(1466903785, 3),
+            "term" : NumberLong(7),
+            "big" : NumberLong("9007199254740993"),
+            "int" : NumberInt(4),
+            "dec" : NumberDecimal("1.10"),
+            "_id" : ObjectId("507f1f77bcf86cd799439011"),
+            "bin" : BinData(0, "AQI="),
+            "uuid" : UUID("0123456789abcdef0123456789abcdef"),
+            "ok" : 1
+        }'''
+        self.check(out, {
+            'date': datetime.datetime(2016, 6, 26, 17, 41, 9, 214000, UTC),
+            'optime': bson.Timestamp(1466903785, 3),
+            'term': 7,
+            'big': 9007199254740993,
+            'int': 4,
+            'dec': decimal.Decimal('1.10'),
+            '_id': bson.ObjectId('507f1f77bcf86cd799439011'),
+            'bin': bson.Binary(0, b'\x01\x02'),
+            'uuid': bson.Binary(4, bytes.fromhex(
+                '0123456789abcdef0123456789abcdef')),
+            'ok': 1,
+        })
+
+    def test_strings_untouched(self):
+        out = b'{"msg": "Timestamp(1, 2) failed, 1)", "ok": 0}'
+        self.check(out, {'msg': 'Timestamp(1, 2) failed, 1)', 'ok': 0})
+
+    def test_escaped_strings(self):
+        out = r'{"msg": "say \"ISODate(\"x\")\"", "d": new Date(0)}'
+        self.assertEqual({'msg': 'say "ISODate("x")"',
+                          'd': datetime.datetime(1970, 1, 1, tzinfo=UTC)},
+                         mongodb_shell.loads(out))
+
+    def test_literals(self):
+        self.check('[true, false, null, undefined, -1.5e3, {a: 1}]',
+                   [True, False, None, None, -1500.0, {'a': 1}])
+
+    def test_isodate_offsets(self):
+        expected = datetime.datetime(2016, 6, 26, 15, 41, 9, 500000, UTC)
+        self.assertEqual(expected,
+                         mongodb_shell.isodate('2016-06-26T17:41:09.5+0200'))
+        self.assertRaises(ValueError, mongodb_shell.isodate, 'yesterday')
+
+    def test_errors(self):
+        for out in ('{"a" : Bogus(1)}', '{"a" 1}', '[1, 2', '{} {}',
+                    '{"a": ISODate("never")}', ''):
+            self.assertRaises(mongodb_shell.DecodeError, mongodb_shell.loads,
+                              out)
+        with self.assertRaises(ValueError) as e:
+            mongodb_shell.loads('{"a": 1,\n "b" 2}')
+        self.assertEqual((14, 2, 6), (e.exception.pos, e.exception.lineno,
+                                      e.exception.colno))
+        self.assertRaises(mongodb_shell.DecodeError, mongodb_shell.loads,
+                          '{"a": "unterminated\\')
+
+    def test_recorded(self):
+        with open(os.path.join(DATA, 'rs_status_32.txt'), 'rb') as f:
+            status = mongodb_shell.loads(f.read())
+        self.assertEqual(7, status['term'])
+        self.assertEqual(bson.Timestamp(1478077962, 11),
+                         status['members'][2]['optime']['ts'])
+        self.assertEqual(datetime.datetime(2016, 11, 2, 9, 12, 43,
+                                           tzinfo=UTC),
+                         status['members'][0]['optimeDate'])
@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+sys.path.append('lib')
+
+from charms.layer import mongodb_trace as trace  # noqa: E402
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.spans = os.path.join(self.tmp, 'spans.jsonl')
+        p = patch.object(trace, 'SPANS_FILE', self.spans)
+        p.start()
+        self.addCleanup(p.stop)
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    @patch('charms.layer.mongodb_trace.hookenv.hook_name')
+    def test_span(self, mhook):
+        mhook.return_value = 'config-changed'
+
+        @trace.traced()
+        def configure():
+            with trace.span('apt_install'):
+                pass
+
+        configure()
+        with self.assertRaises(ValueError):
+            with trace.span('failing'):
+                raise ValueError()
+
+        spans = trace.read()
+        self.assertEqual(['apt_install', 'configure', 'failing'],
+                         [s['span'] for s in spans])
+        self.assertEqual('configure', spans[0]['parent'])
+        self.assertIsNone(spans[1]['parent'])
+        self.assertEqual([True, True, False], [s['ok'] for s in spans])
+        self.assertEqual('config-changed', spans[0]['hook'])
+        self.assertEqual(os.getpid(), spans[0]['pid'])
+
+    def test_traced_action_id(self):
+        def handler():
+            pass
+        wrapped = trace.traced()(handler)
+        self.assertEqual('handler', wrapped.__name__)
+        self.assertIn(':handler', wrapped._action_id)
+        self.assertNotEqual(trace.traced()(lambda: None)._action_id,
+                            wrapped._action_id)
+
+    def test_rotate(self):
+        with open(self.spans, 'w') as f:
+            f.write(json.dumps({'span': 'old'}) + '\n{"trunc')
+        with patch.object(trace, 'MAX_SIZE', 1):
+            with trace.span('new'):
+                pass
+        self.assertTrue(os.path.exists(self.spans + trace.ROTATED))
+        self.assertEqual(['old', 'new'], [s['span'] for s in trace.read()])
+
+    def test_unwritable(self):
+        with patch.object(trace, 'SPANS_FILE', '/nonexistent/spans.jsonl'):
+            with trace.span('dropped'):
+                pass
+            self.assertEqual([], trace.read())
+
+    def test_summarize(self):
+        def span(hook, pid, name, seconds, ok=True):
+            return {'hook': hook, 'pid': pid, 'span': name,
+                    'seconds': seconds, 'ok': ok}
+
+        spans = [
+            span('install', 1, 'apt_install', 80.0),
+            span('config-changed', 2, 'service_restart', 20.0),
+            span('config-changed', 2, 'configure', 25.0),
+            span('update-status', 3, 'mongo', 1.0, ok=False),
+            span('config-changed', 4, 'service_restart', 40.0),
+            span('config-changed', 4, 'configure', 45.0),
+        ]
+        rows = trace.summarize(spans, hooks=3, top=2)
+        self.assertEqual(['configure', 'service_restart'],
+                         [r['span'] for r in rows])
+        self.assertEqual(2, rows[1]['count'])
+        self.assertEqual(60.0, rows[1]['total_seconds'])
+        self.assertEqual(30.0, rows[1]['mean_seconds'])
+        self.assertEqual(40.0, rows[1]['max_seconds'])
+        self.assertEqual('config-changed', rows[1]['slowest_hook'])
+
+        rows = trace.summarize(spans, hooks=1, top=0)
+        self.assertEqual(['configure', 'service_restart'],
+                         [r['span'] for r in rows])
+        failed = trace.summarize(spans, hooks=0, top=0)[-1]
+        self.assertEqual(('mongo', 1), (failed['span'], failed['failed']))
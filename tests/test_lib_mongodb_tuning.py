@@ -0,0 +1,142 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+sys.path.append('lib')
+
+from charms.layer import mongodb_tuning as tuning  # noqa: E402
+
+
+class TuningTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+        # A host with THP on, two NUMA nodes and dbpath on sda1
+        st = os.stat(self.tmp)
+        disk = self.path('devices/sda')
+        os.makedirs(os.path.join(disk, 'sda1'))
+        os.makedirs(os.path.join(disk, 'queue'))
+        os.makedirs(self.path('dev'))
+        os.symlink(os.path.join(disk, 'sda1'), self.path(
+            'dev/{}:{}'.format(os.major(st.st_dev), os.minor(st.st_dev))))
+        self.write('devices/sda/queue/read_ahead_kb', '128\n')
+        for name in tuning.THP_FILES:
+            self.write('thp/' + name, 'always madvise [never]\n')
+        self.write('thp/enabled', '[always] madvise never\n')
+        for node in ('node0', 'node1', 'possible'):
+            os.makedirs(self.path('node/' + node))
+        self.write('zone_reclaim_mode', '1\n')
+
+        patches = {
+            'THP': self.path('thp/{0}'),
+            'NUMA_NODES': self.path('node/node[0-9]*'),
+            'SYS_DEV_BLOCK': self.path('dev/{0}:{1}'),
+            'ZONE_RECLAIM': self.path('zone_reclaim_mode'),
+            'DROP_IN': self.path('etc/mongodb.service.d/juju-tuning.conf'),
+            'UDEV_RULE': self.path('etc/60-mongodb-readahead.rules'),
+            'SYSCTL_FILE': self.path('etc/60-mongodb.conf'),
+        }
+        for name, value in patches.items():
+            p = patch.object(tuning, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def write(self, name, content):
+        if not os.path.isdir(os.path.dirname(self.path(name))):
+            os.makedirs(os.path.dirname(self.path(name)))
+        with open(self.path(name), 'w') as f:
+            f.write(content)
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+    def test_detect(self):
+        self.assertEqual({'enabled': 'always', 'defrag': 'never'},
+                         tuning.hugepages())
+        self.assertEqual(2, tuning.numa_nodes())
+        device = tuning.block_device(self.tmp)
+        self.assertEqual(self.path('devices/sda'), device)
+        self.assertEqual(128, tuning.readahead(device))
+        self.assertIsNone(tuning.block_device(self.path('missing')))
+
+    @patch('charms.layer.mongodb_tuning.mongod_limits')
+    @patch('charms.layer.mongodb_tuning.shutil.which')
+    def test_check(self, mwhich, mlimits):
+        mwhich.return_value = None
+        mlimits.return_value = {'Max open files': 1024,
+                                'Max processes': None}
+        self.assertEqual(['transparent hugepages always', 'readahead 128KB',
+                          'numactl missing', 'zone_reclaim_mode',
+                          'open files 1024'],
+                         tuning.check(self.tmp))
+
+    @patch('charms.layer.mongodb_tuning.subprocess.check_call')
+    @patch('charms.layer.mongodb_tuning.init_is_systemd')
+    @patch('charms.layer.mongodb_tuning.shutil.which')
+    def test_tune(self, mwhich, msystemd, mcall):
+        mwhich.return_value = '/usr/bin/numactl'
+        msystemd.return_value = True
+
+        self.assertTrue(tuning.tune('/etc/mongodb.conf', self.tmp))
+
+        self.assertEqual('never', self.read('thp/enabled'))
+        self.assertEqual('never', self.read('thp/defrag'))
+        self.assertEqual('8', self.read('devices/sda/queue/read_ahead_kb'))
+        self.assertIn('KERNEL=="sda", ATTR{bdi/read_ahead_kb}="8"',
+                      self.read('etc/60-mongodb-readahead.rules'))
+        self.assertIn('vm.zone_reclaim_mode = 0',
+                      self.read('etc/60-mongodb.conf'))
+        drop_in = self.read('etc/mongodb.service.d/juju-tuning.conf')
+        self.assertIn('LimitNOFILE=64000\n', drop_in)
+        self.assertIn('ExecStart=/usr/bin/numactl --interleave=all '
+                      '/usr/bin/mongod --config /etc/mongodb.conf', drop_in)
+        mcall.assert_called_with(['systemctl', 'daemon-reload'])
+
+        mcall.reset_mock()
+        self.assertFalse(tuning.tune('/etc/mongodb.conf', self.tmp))
+        mcall.assert_not_called()
+
+    @patch('charms.layer.mongodb_tuning.subprocess.check_call')
+    @patch('charms.layer.mongodb_tuning.init_is_systemd')
+    def test_tune_upstart(self, msystemd, mcall):
+        msystemd.return_value = False
+        shutil.rmtree(self.path('node/node1'))
+
+        self.assertFalse(tuning.tune('/etc/mongodb.conf', self.tmp))
+
+        self.assertFalse(os.path.exists(self.path('etc/60-mongodb.conf')))
+        self.assertFalse(os.path.exists(
+            self.path('etc/mongodb.service.d/juju-tuning.conf')))
+        mcall.assert_not_called()
+
+    def test_drop_in(self):
+        drop_in = tuning.drop_in('/etc/mongodb.conf')
+        self.assertIn("ExecStartPre=-/bin/sh -c 'echo never > ", drop_in)
+        self.assertNotIn('ExecStart=', drop_in.replace('ExecStartPre', ''))
+
+    @patch('charms.layer.mongodb_tuning.subprocess.check_output')
+    def test_mongod_limits(self, mout):
+        mout.return_value = b'4242\n'
+        self.write('proc/4242/limits',
+                   'Limit                     Soft Limit           Hard Limit'
+                   '           Units\n'
+                   'Max processes             64000                64000    '
+                   '            processes\n'
+                   'Max open files            unlimited            unlimited'
+                   '            files\n')
+        with patch.object(tuning, 'PROC_LIMITS',
+                          self.path('proc/{0}/limits')):
+            self.assertEqual({'Max processes': 64000,
+                              'Max open files': None},
+                             tuning.mongod_limits())
+
+        mout.side_effect = OSError('no pidof')
+        self.assertEqual({}, tuning.mongod_limits())
@@ -7,6 +7,11 @@ sys.path.append('.')
 sys.path.append('lib')
 
 from reactive import mongodb  # noqa: E402
+from charms.layer.mongodb import (  # noqa: E402
+    UnsupportedVersion,
+    parse_version,
+)
+from charms.layer.mongodb_health import Health  # noqa: E402
 
 
 class MockConfig(MagicMock):
@@ -29,7 +34,26 @@ class ReactiveTestCase(unittest.TestCase):
         'remove_state',
         'status_set',
         'open_port',
-        'close_port'
+        'close_port',
+        'log',
+        'service_running',
+        'mongodb_metrics',
+        'is_leader',
+        'relation_ids',
+        'relation_set',
+        'unit_private_ip',
+        'mongodb_replicaset',
+        'mongodb_backup',
+        'mongodb_tuning',
+        'mongodb_sharding',
+        'related_units',
+        'mongodb_health',
+        'mongodb_seed',
+        'mongodb_client',
+        'is_state',
+        'mongodb_oplog',
+        'mongodb_log',
+        'mongodb_restart',
     ]
 
     callables = {
@@ -42,6 +66,7 @@ class ReactiveTestCase(unittest.TestCase):
             a = 'reactive.mongodb.{}'.format(p)
             setattr(self, '{}_mock'.format(p),
                     patch(a, new_callable=c).start())
+        self.is_state_mock.return_value = False
         super(ReactiveTestCase, self).setUp()
 
     def tearDown(self):
@@ -54,11 +79,13 @@ class ReactiveTest(ReactiveTestCase):
     @patch('reactive.mongodb.mongodb')
     def test_install(self, mgo):
         mgo.installed.return_value = False
-        self.config_mock._d['cur'] = {'version': 'archive'}
+        self.config_mock._d['cur'] = {'version': 'archive',
+                                      'package_cache': '/srv/debs'}
 
         mongodb.install()
 
         mgo.mongodb.assert_called_with('archive')
+        self.assertEqual('/srv/debs', mgo.mongodb.return_value.package_cache)
         mgo.mongodb.return_value.install.assert_called()
         self.set_state_mock.assert_called_with('mongodb.installed')
 
@@ -83,6 +110,81 @@ class ReactiveTest(ReactiveTestCase):
         ])
         self.set_state_mock.assert_called_with('mongodb.installed')
 
+    @patch('reactive.mongodb.mongodb')
+    def test_install_in_place(self, mgo):
+        mgo.installed.return_value = True
+        self.config_mock._d['cur'] = {'version': '3.2.10'}
+
+        mongodb.install()
+
+        self.set_state_mock.assert_called_with('mongodb.upgrade.pending')
+        self.remove_state_mock.assert_called_with(
+            'mongodb.upgrade.downloaded')
+        mgo.mongodb.return_value.uninstall.assert_not_called()
+        mgo.mongodb.return_value.install.assert_not_called()
+
+    @patch('reactive.mongodb.mongodb')
+    def test_upgrade(self, mgo):
+        mgo.version.return_value = '3.0.12'
+        mgo.mongodb.return_value.download.return_value = {'download': 3.5}
+        mgo.mongodb.return_value.upgrade.return_value = {'stop': 1.5}
+        self.config_mock._d['cur'] = {'version': '3.2.10'}
+
+        mongodb.upgrade()
+
+        mgo.mongodb.assert_called_once_with('3.2.10')
+        mgo.mongodb.return_value.download.assert_called_with('3.0.12')
+        mgo.mongodb.return_value.upgrade.assert_called_with(
+            self.config_mock.return_value)
+        self.remove_state_mock.assert_has_calls([
+            call('mongodb.upgrade.pending'),
+            call('mongodb.upgrade.downloaded'),
+            call('mongodb.ready'),
+        ])
+        self.set_state_mock.assert_has_calls([
+            call('mongodb.upgrade.downloaded'),
+            call('mongodb.installed'),
+        ])
+
+    @patch('reactive.mongodb.mongodb')
+    def test_upgrade_unsupported(self, mgo):
+        mgo.version.return_value = '2.4.14'
+        mgo.UnsupportedVersion = Exception
+        mgo.mongodb.return_value.download.side_effect = Exception('hop')
+        self.config_mock._d['cur'] = {'version': '3.2.10'}
+
+        mongodb.upgrade()
+
+        self.status_set_mock.assert_called_with('blocked', 'hop')
+        self.remove_state_mock.assert_called_with('mongodb.upgrade.pending')
+        self.set_state_mock.assert_not_called()
+        mgo.mongodb.return_value.upgrade.assert_not_called()
+
+    @patch('reactive.mongodb.mongodb')
+    def test_upgrade_rolling(self, mgo):
+        mgo.version.return_value = '3.0.12'
+        self.config_mock._d['cur'] = {'version': '3.2.10',
+                                      'replicaset': 'rs0'}
+        self.service_running_mock.return_value = True
+        self.mongodb_restart_mock.take_turn.return_value = False
+
+        mongodb.upgrade()
+
+        # Downloaded while waiting, only the swap needs the turn
+        mgo.mongodb.return_value.download.assert_called_with('3.0.12')
+        self.set_state_mock.assert_called_with('mongodb.upgrade.downloaded')
+        mgo.mongodb.return_value.upgrade.assert_not_called()
+        self.remove_state_mock.assert_not_called()
+        self.status_set_mock.assert_called_with(
+            'waiting', 'waiting for a turn to restart mongodb')
+
+        # A later hook does not download again
+        mgo.mongodb.return_value.download.reset_mock()
+        self.is_state_mock.side_effect = (
+            lambda s: s == 'mongodb.upgrade.downloaded')
+        mongodb.upgrade()
+        mgo.mongodb.return_value.download.assert_not_called()
+
     @patch('reactive.mongodb.mongodb')
     @patch('reactive.mongodb.service_restart')
     def test_configure(self, msr, mgo):
@@ -117,10 +219,563 @@ class ReactiveTest(ReactiveTestCase):
 
         self.set_state_mock.assert_called_with('mongodb.ready')
 
+    def seeding(self, *health):
+        self.config_mock._d['cur'] = {'replicaset': 'rs0', 'port': 27017,
+                                      'seed_snapshot': '/srv/snap.tar.gz',
+                                      'dbpath': '/srv/db'}
+        self.is_state_mock.return_value = False
+        self.unit_private_ip_mock.return_value = '10.0.0.3'
+        self.mongodb_replicaset_mock.members.return_value = [
+            '10.0.0.1:27017', '10.0.0.2:27017', '10.0.0.3:27017']
+        self.mongodb_health_mock.probe.return_value = list(health)
+        conn = self.mongodb_client_mock.connection.return_value
+        conn.command.return_value = {'ok': 1, 'config': {'members': [
+            {'host': '10.0.0.1:27017'}, {'host': '10.0.0.2:27017'}]}}
+        return conn
+
+    @patch('reactive.mongodb.service_stop')
+    def test_seed_member(self, mstop):
+        self.seeding(
+            Health('10.0.0.1', '27017', True, 'primary', 0.001, None),
+            Health('10.0.0.2', '27017', True, 'secondary', 0.001, None))
+        seed = self.mongodb_seed_mock
+
+        self.assertTrue(mongodb.seed_member(self.config_mock()))
+
+        self.mongodb_client_mock.connection.assert_called_with('10.0.0.1',
+                                                               '27017')
+        seed.check.assert_called_with(seed.metadata.return_value, 'rs0',
+                                      seed.oplog_start.return_value)
+        mstop.assert_called_with('mongodb')
+        seed.restore.assert_called_with('/srv/snap.tar.gz', '/srv/db')
+        self.set_state_mock.assert_called_with('replicaset.seeded')
+
+    @patch('reactive.mongodb.service_stop')
+    def test_seed_member_stale(self, mstop):
+        self.seeding(Health('10.0.0.1', '27017', True, 'primary', 0.1, None))
+        self.mongodb_seed_mock.StaleSnapshot = ValueError
+        self.mongodb_seed_mock.check.side_effect = ValueError('too old')
+
+        self.assertFalse(mongodb.seed_member(self.config_mock()))
+
+        self.status_set_mock.assert_called_with(
+            'blocked', 'unable to seed from /srv/snap.tar.gz: too old')
+        mstop.assert_not_called()
+        self.set_state_mock.assert_not_called()
+
+    @patch('reactive.mongodb.service_stop')
+    def test_seed_member_existing(self, mstop):
+        conn = self.seeding(
+            Health('10.0.0.1', '27017', True, 'primary', 0.1, None))
+        conn.command.return_value['config']['members'].append(
+            {'host': '10.0.0.3:27017'})
+
+        self.assertTrue(mongodb.seed_member(self.config_mock()))
+
+        self.mongodb_seed_mock.restore.assert_not_called()
+        self.set_state_mock.assert_called_with('replicaset.seeded')
+
+    def test_seed_member_no_primary(self):
+        self.seeding(Health('10.0.0.1', '27017', True, 'secondary', 0.1,
+                            None))
+        self.assertFalse(mongodb.seed_member(self.config_mock()))
+        self.status_set_mock.assert_called_with(
+            'waiting', 'waiting for a primary to seed from')
+
+        # Peers that were never initiated mean a new set
+        self.seeding(Health('10.0.0.1', '27017', True, 'standalone', 0.1,
+                            None))
+        self.assertTrue(mongodb.seed_member(self.config_mock()))
+        self.mongodb_seed_mock.restore.assert_not_called()
+        self.set_state_mock.assert_called_with('replicaset.seeded')
+
+    def test_seed_member_no_peers(self):
+        self.seeding()
+        self.mongodb_replicaset_mock.members.return_value = [
+            '10.0.0.3:27017']
+        self.is_leader_mock.return_value = False
+
+        self.assertFalse(mongodb.seed_member(self.config_mock()))
+        self.status_set_mock.assert_called_with(
+            'waiting', 'waiting for replica set peers to seed from')
+        self.set_state_mock.assert_not_called()
+
+        # The first unit of a new deployment leads it
+        self.is_leader_mock.return_value = True
+        self.assertTrue(mongodb.seed_member(self.config_mock()))
+        self.set_state_mock.assert_called_with('replicaset.seeded')
+
+    def test_replicaset_changed_before_seeding(self):
+        self.config_mock._d['cur'] = {'seed_snapshot': '/srv/snap.tar.gz'}
+        mongodb.replicaset_changed()
+        self.remove_state_mock.assert_any_call('mongodb.ready')
+
+        self.remove_state_mock.reset_mock()
+        self.is_state_mock.return_value = True
+        mongodb.replicaset_changed()
+        self.assertNotIn(call('mongodb.ready'),
+                         self.remove_state_mock.call_args_list)
+
+    @patch('reactive.mongodb.mongodb')
+    def test_configure_invalid_roles(self, mgo):
+        self.config_mock._d['cur'] = {'member_roles': 'mongodb/1: arbiter'}
+        mgo.UnsupportedVersion = UnsupportedVersion
+        self.mongodb_replicaset_mock.parse_roles.side_effect = ValueError(
+            'arbiter is not a valid member role')
+
+        mongodb.configure()
+
+        self.status_set_mock.assert_called_with(
+            'blocked', 'arbiter is not a valid member role')
+        mgo.mongodb.return_value.configure.assert_not_called()
+        self.set_state_mock.assert_not_called()
+
+    @patch('reactive.mongodb.service_restart')
+    def test_apply_config_unchanged(self, msr):
+        m = MagicMock()
+        m.needs_restart.return_value = False
+        mongodb.apply_config(m, {})
+        msr.assert_not_called()
+        m.apply_runtime.assert_not_called()
+
+    @patch('reactive.mongodb.service_restart')
+    def test_apply_config_runtime(self, msr):
+        m = MagicMock()
+        m.needs_restart.return_value = False
+        changes = {'setParameter.notablescan': True}
+        mongodb.apply_config(m, changes)
+        m.apply_runtime.assert_called_with(changes)
+        msr.assert_not_called()
+
+        m.apply_runtime.side_effect = IOError('unreachable')
+        mongodb.apply_config(m, changes)
+        msr.assert_called_with('mongodb')
+
+    @patch('reactive.mongodb.service_restart')
+    def test_apply_config_restart(self, msr):
+        m = MagicMock()
+        m.needs_restart.return_value = True
+        mongodb.apply_config(m, {'net.port': 1})
+        m.apply_runtime.assert_not_called()
+        msr.assert_called_with('mongodb')
+
+        msr.reset_mock()
+        self.service_running_mock.return_value = False
+        mongodb.apply_config(m, {})
+        msr.assert_called_with('mongodb')
+
+    @patch('reactive.mongodb.service_restart')
+    def test_apply_config_pending(self, msr):
+        m = MagicMock()
+        m.needs_restart.return_value = False
+        self.is_state_mock.side_effect = lambda f: f == (
+            'mongodb.restart.pending')
+
+        self.assertTrue(mongodb.apply_config(m, {}))
+
+        msr.assert_called_with('mongodb')
+        self.remove_state_mock.assert_called_with('mongodb.restart.pending')
+
+    def rolling(self, rejoining=False):
+        self.config_mock._d['cur'] = {'replicaset': 'rs0',
+                                      'step_down_max_lag': 10.0,
+                                      'restart_timeout': 30}
+        self.service_running_mock.return_value = True
+        self.is_leader_mock.return_value = False
+        self.is_state_mock.side_effect = lambda f: rejoining and f == (
+            'mongodb.restart.rejoining')
+        self.mongodb_restart_mock.take_turn.return_value = True
+        return MagicMock()
+
+    @patch('reactive.mongodb.mongodb')
+    def test_rolling_restart(self, mgo):
+        restart = self.rolling()
+        m = mgo.server.return_value
+        m.host, m.port = '127.0.0.1', 27017
+
+        self.assertTrue(mongodb.rolling_restart(self.config_mock(), restart))
+
+        self.mongodb_restart_mock.take_turn.assert_called_with(False)
+        self.mongodb_restart_mock.step_down.assert_called_with(
+            self.mongodb_client_mock.connection.return_value, 10.0, 30)
+        restart.assert_called_with()
+        self.mongodb_restart_mock.wait_serving.assert_called_with(
+            '127.0.0.1', 27017, 30)
+        self.set_state_mock.assert_called_with('mongodb.restart.rejoining')
+        self.remove_state_mock.assert_called_with(
+            'mongodb.restart.rejoining')
+        self.mongodb_restart_mock.release.assert_called_with(False)
+
+    @patch('reactive.mongodb.mongodb')
+    def test_rolling_restart_waits(self, mgo):
+        restart = self.rolling()
+        self.mongodb_restart_mock.take_turn.return_value = False
+
+        self.assertFalse(mongodb.rolling_restart(self.config_mock(), restart))
+        restart.assert_not_called()
+        self.mongodb_restart_mock.step_down.assert_not_called()
+
+        self.mongodb_restart_mock.take_turn.return_value = True
+        self.mongodb_restart_mock.step_down.side_effect = IOError(
+            'no secondary within 10.0s of the primary')
+        self.assertFalse(mongodb.rolling_restart(self.config_mock(), restart))
+        restart.assert_not_called()
+        self.mongodb_restart_mock.release.assert_called_with(False)
+        self.status_set_mock.assert_called_with(
+            'waiting', 'not restarting the primary: no secondary within '
+            '10.0s of the primary')
+
+    @patch('reactive.mongodb.mongodb')
+    def test_rolling_restart_rejoining(self, mgo):
+        restart = self.rolling(rejoining=True)
+        wait = self.mongodb_restart_mock.wait_serving
+        wait.side_effect = IOError('not serving after 30s: state 5')
+
+        self.assertFalse(mongodb.rolling_restart(self.config_mock(), restart))
+        restart.assert_not_called()
+        self.mongodb_restart_mock.release.assert_not_called()
+        self.status_set_mock.assert_called_with(
+            'waiting', 'waiting for mongodb to rejoin the replica set: not '
+            'serving after 30s: state 5')
+
+        wait.side_effect = None
+        self.assertTrue(mongodb.rolling_restart(self.config_mock(), restart))
+        restart.assert_not_called()
+        self.mongodb_restart_mock.release.assert_called_with(False)
+
+    def test_rolling_restart_standalone(self):
+        restart = self.rolling()
+        self.config_mock._d['cur'] = {'replicaset': ''}
+
+        self.assertTrue(mongodb.rolling_restart(self.config_mock(), restart))
+        restart.assert_called_with()
+        self.mongodb_restart_mock.take_turn.assert_not_called()
+
+    @patch('reactive.mongodb.mongodb')
+    def test_feature_compatibility(self, mgo):
+        self.config_mock._d['cur'] = {'replicaset': 'myset'}
+        self.is_leader_mock.return_value = True
+        mgo.version.return_value = '3.4.1'
+        mgo.parse_version = parse_version
+        versions = self.mongodb_replicaset_mock.versions
+        versions.return_value = {'mongodb/0': '3.4.1', 'mongodb/1': '3.2.10'}
+        set_fcv = mgo.server.return_value.set_feature_compatibility
+
+        mongodb.feature_compatibility()
+
+        versions.assert_called_with('3.4.1')
+        set_fcv.assert_not_called()
+        self.set_state_mock.assert_not_called()
+
+        versions.return_value['mongodb/1'] = '3.4.2'
+        set_fcv.return_value = False
+        mongodb.feature_compatibility()
+        set_fcv.assert_called_with(parse_version('3.4.1'))
+        self.set_state_mock.assert_not_called()
+
+        set_fcv.return_value = True
+        mongodb.feature_compatibility()
+        self.set_state_mock.assert_called_with('mongodb.fcv.current')
+
+    @patch('reactive.mongodb.mongodb')
+    def test_feature_compatibility_unknown_version(self, mgo):
+        self.config_mock._d['cur'] = {'replicaset': 'myset'}
+        self.is_leader_mock.return_value = True
+        mgo.version.return_value = '3.4.1'
+        mgo.parse_version = parse_version
+        mgo.UnsupportedVersion = UnsupportedVersion
+        self.mongodb_replicaset_mock.versions.return_value = {
+            'mongodb/0': '3.4.1', 'mongodb/1': 'git version: 865b4f6'}
+
+        mongodb.feature_compatibility()
+
+        mgo.server.assert_not_called()
+        self.set_state_mock.assert_not_called()
+
+    @patch('reactive.mongodb.mongodb')
+    def test_feature_compatibility_follower(self, mgo):
+        self.config_mock._d['cur'] = {'replicaset': 'myset'}
+        self.is_leader_mock.return_value = False
+
+        mongodb.feature_compatibility()
+
+        mgo.server.assert_not_called()
+        self.set_state_mock.assert_called_with('mongodb.fcv.current')
+
+    def test_restart_turns(self):
+        self.is_leader_mock.return_value = False
+        mongodb.restart_turns()
+        self.mongodb_restart_mock.grant.assert_not_called()
+
+        self.is_leader_mock.return_value = True
+        mongodb.restart_turns()
+        self.mongodb_restart_mock.grant.assert_called_with()
+
+    @patch('reactive.mongodb.service_restart')
+    @patch('reactive.mongodb.service_pause')
+    @patch('reactive.mongodb.mongodb')
+    def test_configure_mongos(self, mgo, mpause, msr):
+        self.config_mock._d['cur'] = {'cluster_role': 'mongos',
+                                      'port': 27017}
+        self.config_mock._d['prev'] = {'port': 27017}
+        self.mongodb_sharding_mock.config_db.return_value = None
+
+        mongodb.configure()
+
+        self.status_set_mock.assert_called_with(
+            'blocked', 'mongos needs a config-server relation')
+        self.set_state_mock.assert_not_called()
+
+        self.mongodb_sharding_mock.config_db.return_value = 'cfg/a:1,b:1'
+        self.service_running_mock.return_value = True
+        m = mgo.mongodb.return_value
+        m.configure_mongos.return_value = True
+
+        mongodb.configure()
+
+        m.configure_mongos.assert_called_with(self.config_mock.return_value,
+                                              'cfg/a:1,b:1')
+        m.configure.assert_not_called()
+        mpause.assert_called_with('mongodb')
+        msr.assert_called_with('mongos')
+        self.set_state_mock.assert_called_with('mongodb.ready')
+
+    @patch('charms.layer.mongodb.unitdata')
+    @patch('charms.layer.mongodb.service_start')
+    @patch('charms.layer.mongodb.service_stop')
+    @patch('charms.layer.mongodb.apt_install')
+    @patch('charms.layer.mongodb.MongoDB34.configure')
+    @patch('charms.layer.mongodb.MongoDB34.prepare')
+    @patch('charms.layer.mongodb.version')
+    def test_upgrade_mongos(self, mv, mprep, mconf, mapt, mstop, mstart,
+                            mkv):
+        mv.return_value = '3.2.10'
+        self.config_mock._d['cur'] = {'version': '3.4.1',
+                                      'cluster_role': 'mongos',
+                                      'replicaset': 'myset', 'port': 27017}
+        self.service_running_mock.return_value = True
+
+        mongodb.upgrade()
+
+        # The router is restarted in place, mongod is left alone
+        self.mongodb_restart_mock.take_turn.assert_not_called()
+        mstop.assert_called_once_with('mongos')
+        mstart.assert_called_once_with('mongos')
+        mconf.assert_not_called()
+        self.assertIn('mongodb-org-mongos=3.4.1', mapt.call_args[0][0])
+        self.set_state_mock.assert_called_with('mongodb.installed')
+
+    @patch('reactive.mongodb.mongodb')
+    def test_configure_unsupported_role(self, mgo):
+        self.config_mock._d['cur'] = {'cluster_role': 'configsvr'}
+        mgo.UnsupportedVersion = UnsupportedVersion
+        mgo.mongodb.return_value.configure.side_effect = UnsupportedVersion(
+            'The configsvr role needs MongoDB 3.2 or later')
+
+        mongodb.configure()
+
+        self.status_set_mock.assert_called_with(
+            'blocked', 'The configsvr role needs MongoDB 3.2 or later')
+        self.set_state_mock.assert_not_called()
+
+    def test_publish(self):
+        self.config_mock._d['cur'] = {'cluster_role': 'shardsvr',
+                                      'replicaset': 'rs1', 'port': 27018}
+        self.unit_private_ip_mock.return_value = '10.0.0.5'
+        self.relation_ids_mock.side_effect = lambda r: ['{}:1'.format(r)]
+        self.mongodb_sharding_mock.ROLE_RELATIONS = {'shardsvr': 'shard'}
+        self.related_units_mock.return_value = ['app/0', 'app/1']
+        members = self.mongodb_replicaset_mock.members
+        members.return_value = ['10.0.0.4:27018', '10.0.0.5:27018']
+        settings = self.mongodb_replicaset_mock.client_settings
+        settings.return_value = {'uri': 'mongodb://...'}
+
+        mongodb.publish()
+
+        members.assert_called_with('10.0.0.5:27018')
+        roles = self.mongodb_replicaset_mock.roles
+        roles.assert_called_with(
+            '10.0.0.5:27018',
+            self.mongodb_replicaset_mock.parse_roles.return_value)
+        settings.assert_called_with(members.return_value, 'rs1', 2,
+                                    roles.return_value)
+        self.relation_set_mock.assert_has_calls([
+            call('database:1', hostname='10.0.0.5', port=27018,
+                 uri='mongodb://...'),
+            call('shard:1', replset='rs1', member='10.0.0.5:27018'),
+        ])
+        self.set_state_mock.assert_called_with('mongodb.published')
+
+    def test_publish_mongos(self):
+        self.config_mock._d['cur'] = {'cluster_role': 'mongos',
+                                      'replicaset': 'myset', 'port': 27017}
+        self.relation_ids_mock.side_effect = lambda r: ['{}:1'.format(r)]
+        self.mongodb_sharding_mock.ROLE_RELATIONS = {}
+        self.related_units_mock.return_value = ['app/0']
+        settings = self.mongodb_replicaset_mock.client_settings
+        settings.return_value = {}
+
+        mongodb.publish()
+
+        settings.assert_called_with(
+            self.mongodb_replicaset_mock.members.return_value, None, 1, None)
+
+    @patch('reactive.mongodb.mongodb')
+    def test_register_shards(self, mgo):
+        self.config_mock._d['cur'] = {'cluster_role': 'mongos'}
+        self.is_leader_mock.return_value = True
+        sharding = self.mongodb_sharding_mock
+        sharding.replica_sets.return_value = {'rs1': ['a:1']}
+        sharding.add_shards.return_value = ['rs1']
+
+        mongodb.register_shards()
+
+        sharding.replica_sets.assert_called_with(sharding.SHARDS)
+        sharding.add_shards.assert_called_with(mgo.server.return_value,
+                                               {'rs1': ['a:1']})
+        self.set_state_mock.assert_called_with('sharding.registered')
+
+        self.set_state_mock.reset_mock()
+        sharding.add_shards.side_effect = IOError('no config servers')
+        mongodb.register_shards()
+        self.set_state_mock.assert_not_called()
+
+        self.config_mock._d['cur'] = {'cluster_role': 'shardsvr'}
+        sharding.reset_mock()
+        mongodb.register_shards()
+        sharding.add_shards.assert_not_called()
+        self.set_state_mock.assert_called_with('sharding.registered')
+
     def test_check_config(self):
         mongodb.check_config()
+        self.remove_state_mock.assert_any_call('mongodb.ready')
+        self.remove_state_mock.assert_any_call('replicaset.configured')
+
+    def test_replicaset_changed(self):
+        mongodb.replicaset_changed()
+        self.remove_state_mock.assert_any_call('replicaset.configured')
+        self.remove_state_mock.assert_any_call('mongodb.published')
+
+    @patch('reactive.mongodb.mongodb')
+    def test_configure_replicaset_follower(self, mgo):
+        self.config_mock._d['cur'] = {'port': 27017, 'replicaset': 'myset'}
+        self.unit_private_ip_mock.return_value = '10.0.0.2'
+        self.relation_ids_mock.return_value = ['replica-set:0']
+        self.is_leader_mock.return_value = False
+        mgo.version.return_value = '3.2.10'
+
+        mongodb.configure_replicaset()
+
+        self.relation_set_mock.assert_called_with(
+            'replica-set:0', member='10.0.0.2:27017', version='3.2.10')
+        mgo.server.assert_not_called()
+        self.set_state_mock.assert_called_with('replicaset.configured')
+
+    @patch('reactive.mongodb.mongodb')
+    def test_configure_replicaset_leader(self, mgo):
+        self.config_mock._d['cur'] = {'port': 27017, 'replicaset': 'myset'}
+        self.unit_private_ip_mock.return_value = '10.0.0.1'
+        self.relation_ids_mock.return_value = []
+        self.is_leader_mock.return_value = True
+        members = self.mongodb_replicaset_mock.members
+        members.return_value = ['10.0.0.1:27017', '10.0.0.2:27017']
+        reconfigure = mgo.server.return_value.reconfigure_replicaset
+        reconfigure.return_value = {'_id': 'myset', 'version': 2,
+                                    'members': [{'host': '10.0.0.1:27017'},
+                                                {'host': '10.0.0.2:27017'}]}
+
+        mongodb.configure_replicaset()
+
+        members.assert_called_with('10.0.0.1:27017')
+        reconfigure.assert_called_with(
+            'myset', members.return_value, configsvr=False,
+            roles=self.mongodb_replicaset_mock.roles.return_value)
+        self.set_state_mock.assert_called_with('replicaset.configured')
+
+        self.set_state_mock.reset_mock()
+        reconfigure.side_effect = IOError('Replica set myset has no primary')
+        mongodb.configure_replicaset()
+        self.set_state_mock.assert_not_called()
+
+    @patch('reactive.mongodb.mongodb')
+    def test_configure_backups(self, mgo):
+        self.config_mock._d['cur'] = {'version': '3.2.10',
+                                      'backups_enabled': True}
+        mgo.local_address.return_value = ('127.0.0.1', 27017)
+
+        mongodb.configure_backups()
+
+        self.mongodb_backup_mock.schedule.assert_called_with(
+            self.config_mock.return_value, '127.0.0.1',
+            mgo.mongodb.return_value.archive_dumps)
+
+    @patch('reactive.mongodb.mongodb')
+    def test_configure_logrotate(self, mgo):
+        self.config_mock._d['cur'] = {'logpath': '/var/log/m.log'}
+        mgo.server.return_value.logrotate.return_value = True
+
+        mongodb.configure_logrotate()
+
+        mgo.server.return_value.logrotate.assert_called_with(
+            self.config_mock.return_value)
+        self.log_mock.assert_called_with(
+            'Installed logrotate policy for /var/log/m.log')
+
+    @patch('reactive.mongodb.service_restart')
+    @patch('reactive.mongodb.mongodb')
+    def test_tune_host(self, mgo, msr):
+        self.config_mock._d['cur'] = {'host_tuning': True,
+                                      'dbpath': '/srv/db'}
+        self.mongodb_tuning_mock.tune.return_value = True
+        self.service_running_mock.return_value = True
+
+        mongodb.tune_host()
+
+        self.mongodb_tuning_mock.tune.assert_called_with(
+            mgo.mongodb.return_value.config_file, '/srv/db')
+        # configure() restarts it, in this unit's turn
+        msr.assert_not_called()
+        self.set_state_mock.assert_called_with('mongodb.restart.pending')
         self.remove_state_mock.assert_called_with('mongodb.ready')
 
+        self.set_state_mock.reset_mock()
+        self.mongodb_tuning_mock.tune.return_value = False
+        mongodb.tune_host()
+        self.set_state_mock.assert_not_called()
+
+        self.config_mock._d['cur'] = {'host_tuning': False}
+        self.mongodb_tuning_mock.reset_mock()
+        mongodb.tune_host()
+        self.mongodb_tuning_mock.tune.assert_not_called()
+
+    def healthy(self, mgo, *peers):
+        mgo.installed.return_value = True
+        mgo.version.return_value = '3.2.10'
+        mgo.local_address.return_value = ('127.0.0.1', 27017)
+        self.unit_private_ip_mock.return_value = '10.0.0.1'
+        self.mongodb_replicaset_mock.members.return_value = [
+            '10.0.0.1:27017'] + ['{}:27017'.format(p[0]) for p in peers]
+        self.mongodb_health_mock.probe.return_value = [
+            Health('127.0.0.1', 27017, True, 'primary', 0.0004, None)] + [
+            Health(host, '27017', ok, None, None, None) for host, ok in peers]
+        self.mongodb_oplog_mock.stats.return_value = None
+        self.mongodb_log_mock.ingest.return_value = {}
+
+    @patch('reactive.mongodb.mongodb')
+    def test_update_status_untuned(self, mgo):
+        self.config_mock._d['cur'] = {'host_tuning': True,
+                                      'dbpath': '/srv/db'}
+        self.healthy(mgo)
+        self.mongodb_tuning_mock.check.return_value = [
+            'transparent hugepages always', 'readahead 128KB']
+
+        mongodb.update_status()
+
+        self.mongodb_tuning_mock.check.assert_called_with('/srv/db')
+        self.status_set_mock.assert_called_with(
+            'active', 'mongodb 3.2.10 primary, ping 0.4ms, untuned: '
+            'transparent hugepages always, readahead 128KB')
+
     @patch('reactive.mongodb.mongodb')
     def test_update_status(self, mgo):
         mgo.installed.return_value = False
@@ -132,9 +787,117 @@ class ReactiveTest(ReactiveTestCase):
 
     @patch('reactive.mongodb.mongodb')
     def test_update_status_installed(self, mgo):
-        mgo.installed.return_value = True
-        mgo.version.return_value = '99.99'
+        self.config_mock._d['cur'] = {'health_timeout': 2.5}
+        self.healthy(mgo, ('10.0.0.2', True), ('10.0.0.3', False))
+
+        mongodb.update_status()
+
+        self.mongodb_health_mock.probe.assert_called_with(
+            [('127.0.0.1', 27017), ['10.0.0.2', '27017'],
+             ['10.0.0.3', '27017']], 2.5)
+        self.status_set_mock.assert_called_with(
+            'active', 'mongodb 3.2.10 primary, ping 0.4ms, '
+            'unreachable: 10.0.0.3:27017')
+        self.mongodb_metrics_mock.collect.assert_called_with(
+            mgo.server.return_value)
+
+    @patch('reactive.mongodb.mongodb')
+    def test_update_status_not_responding(self, mgo):
+        self.healthy(mgo)
+        self.mongodb_health_mock.probe.return_value = [
+            Health('127.0.0.1', 27017, False, None, None, 'timed out')]
 
         mongodb.update_status()
 
-        self.status_set_mock.assert_called_with('active', 'mongodb 99.99')
+        self.status_set_mock.assert_called_with(
+            'blocked', 'mongodb 3.2.10 not responding: timed out')
+        self.mongodb_metrics_mock.collect.assert_not_called()
+
+    def oplog(self, window_hours, max_mb, recommended, samples=12):
+        oplog = MagicMock(window=window_hours * 3600,
+                          max_size=max_mb * 1024 ** 2)
+        self.mongodb_oplog_mock.MB = 1024 ** 2
+        self.mongodb_oplog_mock.MIN_SAMPLES = 12
+        self.mongodb_oplog_mock.stats.return_value = oplog
+        self.mongodb_oplog_mock.sample.return_value = [[0, 1]] * samples
+        self.mongodb_oplog_mock.recommend.return_value = recommended
+        self.mongodb_oplog_mock.needs_resize.return_value = (
+            recommended != max_mb)
+
+    @patch('reactive.mongodb.mongodb')
+    def test_oplog_status(self, mgo):
+        self.config_mock._d['cur'] = {'oplog_window': 48}
+        self.oplog(30, 2048, 2048)
+        self.assertEqual(', oplog 30.0h',
+                         mongodb.oplog_status(self.config_mock()))
+
+        self.oplog(30, 2048, 3300)
+        self.assertEqual(', oplog 30.0h (48h needs 3300MB)',
+                         mongodb.oplog_status(self.config_mock()))
+        mgo.server.return_value.resize_oplog.assert_not_called()
+
+        self.mongodb_oplog_mock.stats.return_value = None
+        self.assertEqual('', mongodb.oplog_status(self.config_mock()))
+
+    @patch('reactive.mongodb.mongodb')
+    def test_oplog_status_autosize(self, mgo):
+        self.config_mock._d['cur'] = {'oplog_window': 48,
+                                      'oplog_autosize': True}
+        m = mgo.server.return_value
+        self.oplog(30, 2048, 3300, samples=3)
+        self.assertEqual(', oplog 30.0h (48h needs 3300MB)',
+                         mongodb.oplog_status(self.config_mock()))
+        m.resize_oplog.assert_not_called()
+
+        self.oplog(30, 2048, 3300)
+        self.assertEqual(', oplog 30.0h',
+                         mongodb.oplog_status(self.config_mock()))
+        m.resize_oplog.assert_called_with(3300)
+
+        mgo.UnsupportedVersion = UnsupportedVersion
+        m.resize_oplog.side_effect = UnsupportedVersion('3.4')
+        self.assertEqual(', oplog 30.0h (48h needs 3300MB)',
+                         mongodb.oplog_status(self.config_mock()))
+
+    def test_log_status(self):
+        self.config_mock._d['cur'] = {'logpath': '/var/log/mongodb/m.log'}
+        ingest = self.mongodb_log_mock.ingest
+        ingest.return_value = {'lines': 40, 'slow_queries': 3,
+                               'elections': 1, 'errors': 0}
+
+        self.assertEqual(', log: 1 elections, 3 slow',
+                         mongodb.log_status(self.config_mock()))
+        ingest.assert_called_with('/var/log/mongodb/m.log')
+
+        ingest.return_value = {'lines': 40, 'slow_queries': 0}
+        self.assertEqual('', mongodb.log_status(self.config_mock()))
+
+        ingest.side_effect = IOError('permission denied')
+        self.assertEqual('', mongodb.log_status(self.config_mock()))
+
+        ingest.reset_mock()
+        self.config_mock._d['cur'] = {'logpath': ''}
+        self.assertEqual('', mongodb.log_status(self.config_mock()))
+        ingest.assert_not_called()
+
+    @patch('reactive.mongodb.mongodb')
+    def test_sample_metrics(self, mgo):
+        self.config_mock._d['cur'] = {'metrics_textfile': '/tmp/m.prom'}
+        collect = self.mongodb_metrics_mock.collect
+        collect.return_value = {'queue_total': 0}
+        self.mongodb_log_mock.stored.return_value = {'slow_queries': 3}
+
+        mongodb.sample_metrics()
+
+        self.mongodb_metrics_mock.write_textfile.assert_called_with(
+            '/tmp/m.prom', {'queue_total': 0, 'log_slow_queries': 3})
+
+        self.mongodb_metrics_mock.reset_mock()
+        collect.side_effect = IOError('connection refused')
+        mongodb.sample_metrics()
+        self.mongodb_metrics_mock.write_textfile.assert_not_called()
+
+    def test_collect_metrics(self):
+        mongodb.collect_metrics()
+        self.mongodb_metrics_mock.add_metrics.assert_called_with(
+            self.mongodb_metrics_mock.stored.return_value)